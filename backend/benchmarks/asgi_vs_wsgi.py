@@ -0,0 +1,142 @@
+"""
+Throughput and tail latency of the read endpoints under WSGI and ASGI.
+
+Both stacks are driven in-process, without a network in between, by the same
+number of concurrent clients replaying the same mix of requests:
+
+- WSGI: the synchronous DRF views behind a pool of ``--workers`` threads,
+  the way a threaded WSGI server would run them;
+- ASGI: the views in expenses.async_views on one event loop.
+
+Latency includes any time a request waits for a free worker. The benchmark
+creates and seeds its own test database. Run from the backend directory:
+
+    python -m benchmarks.asgi_vs_wsgi --clients 500 --requests 10000
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dung_backend.settings')
+
+
+def seed(members, expenses):
+    from django.contrib.auth.models import User
+    from rest_framework.authtoken.models import Token
+
+    from expenses import ledger
+    from expenses.models import Expense, ExpenseShare, Group
+
+    User.objects.bulk_create([User(username=f'bench{i}') for i in range(members)])
+    users = list(User.objects.filter(username__startswith='bench').order_by('id'))
+    group = Group.objects.create(name='bench', created_by=users[0])
+    group.members.add(*users)
+    created = Expense.objects.bulk_create([
+        Expense(title=f'expense {i}', amount=Decimal('10.00'), group=group, paid_by=users[i % members])
+        for i in range(expenses)
+    ])
+    ExpenseShare.objects.bulk_create([
+        ExpenseShare(expense=expense, user=user, amount_owed=ledger.to_cents(expense.amount / members))
+        for expense in created for user in users
+    ], batch_size=2000)
+    ledger.rebuild_group(group)
+    return group.id, Token.objects.create(user=users[0]).key
+
+
+def paths(group_id, prefix):
+    return [f'/api/{prefix}groups/', f'/api/{prefix}groups/{group_id}/details/',
+            f'/api/{prefix}groups/{group_id}/balances/', f'/api/{prefix}expenses/?group={group_id}',
+            f'/api/{prefix}auth/profile/']
+
+
+def summarize(latencies, elapsed):
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1),
+    }
+
+
+def run_wsgi(urls, token, clients, per_client, workers):
+    from django.test import Client
+
+    latencies, errors = [], []
+    # Requests queue up FIFO for the workers, like connections waiting on a threaded server
+    with ThreadPoolExecutor(max_workers=workers) as server:
+        def client_loop(index):
+            client = Client(HTTP_AUTHORIZATION=f'Token {token}')
+            for n in range(per_client):
+                start = time.perf_counter()
+                response = server.submit(client.get, urls[(index + n) % len(urls)]).result()
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+
+        threads = [threading.Thread(target=client_loop, args=(index,)) for index in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return {**summarize(latencies, time.perf_counter() - start), 'errors': len(errors)}
+
+
+async def run_asgi(urls, token, clients, per_client):
+    from django.test import AsyncClient
+
+    latencies, errors = [], []
+
+    async def client_loop(index):
+        client = AsyncClient()
+        for n in range(per_client):
+            start = time.perf_counter()
+            response = await client.get(urls[(index + n) % len(urls)], headers={'Authorization': f'Token {token}'})
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop(index) for index in range(clients)))
+    return {**summarize(latencies, time.perf_counter() - start), 'errors': len(errors)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=10000, help='total requests per stack')
+    parser.add_argument('--workers', type=int, default=16, help='WSGI worker threads')
+    parser.add_argument('--members', type=int, default=20)
+    parser.add_argument('--expenses', type=int, default=200)
+    args = parser.parse_args()
+
+    django.setup()
+    from django.test.utils import setup_databases, setup_test_environment, teardown_databases
+
+    setup_test_environment()
+    databases = setup_databases(verbosity=0, interactive=False)
+    try:
+        group_id, token = seed(args.members, args.expenses)
+        per_client = max(1, args.requests // args.clients)
+        results = {
+            'clients': args.clients,
+            'wsgi_workers': args.workers,
+            'wsgi': run_wsgi(paths(group_id, ''), token, args.clients, per_client, args.workers),
+            'asgi': asyncio.run(run_asgi(paths(group_id, 'async/'), token, args.clients, per_client)),
+        }
+    finally:
+        teardown_databases(databases, verbosity=0)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
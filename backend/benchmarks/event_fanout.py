@@ -0,0 +1,157 @@
+"""
+Cost of idle event stream connections, and of fanning an event out to them.
+
+Opens ``--connections`` Server-Sent Events streams against the ASGI
+application in this process (expenses.push), spread over ``--groups`` groups,
+and reports the memory they hold while idle (from /proc, so Linux only).
+Then a writer thread publishes ``--events`` events per group, the way a
+request thread does after commit, and the time from publishing to each
+connection's send is measured.
+
+No sockets are involved, so the numbers are the application's own cost per
+connection; the server adds its buffers on top. The benchmark creates and
+seeds its own test database. Run from the backend directory:
+
+    python -m benchmarks.event_fanout --connections 10000 --groups 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dung_backend.settings')
+
+
+def resident_bytes():
+    with open('/proc/self/statm') as stream:
+        return int(stream.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def seed(users, groups):
+    from django.contrib.auth.models import User
+    from rest_framework.authtoken.models import Token
+
+    from expenses.models import Group
+
+    User.objects.bulk_create([User(username=f'fanout{i}') for i in range(users)])
+    members = list(User.objects.filter(username__startswith='fanout').order_by('id'))
+    created = []
+    for index in range(groups):
+        group = Group.objects.create(name=f'fanout {index}', created_by=members[0])
+        group.members.add(*members)
+        created.append(group.id)
+    Token.objects.bulk_create([Token(user=user, key=f'{user.id:040d}') for user in members])
+    return created, [f'{user.id:040d}' for user in members]
+
+
+async def open_streams(application, group_ids, tokens, count, latencies, published):
+    disconnects, tasks = [], []
+    opened = asyncio.Event()
+    started = 0
+
+    def sender():
+        async def send(message):
+            nonlocal started
+            body = message.get('body', b'')
+            if message['type'] == 'http.response.start':
+                started += 1
+                if started == count:
+                    opened.set()
+            elif body.startswith(b'event:'):
+                # Every connection of a group gets the same bytes for an event
+                latencies.append(time.perf_counter() - published[body])
+        return send
+
+    for index in range(count):
+        disconnect = asyncio.Event()
+
+        async def receive(disconnect=disconnect):
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/events/', 'headers': [],
+                 'query_string': f'token={tokens[index % len(tokens)]}&group={group_ids[index % len(group_ids)]}'
+                 .encode()}
+        tasks.append(asyncio.create_task(application(scope, receive, sender())))
+        disconnects.append(disconnect)
+    await opened.wait()
+    return tasks, disconnects
+
+
+async def run(args, group_ids, tokens):
+    from expenses import events
+    from expenses.push import with_event_stream
+
+    application = with_event_stream(None)
+    latencies, published = [], {}
+    results = {'connections': args.connections, 'groups': args.groups}
+
+    before = resident_bytes()
+    start = time.perf_counter()
+    tasks, disconnects = await open_streams(application, group_ids, tokens, args.connections, latencies,
+                                               published)
+    # Includes authenticating and looking up the groups of every connection
+    results['connect_seconds'] = round(time.perf_counter() - start, 2)
+    results['idle_bytes_per_connection'] = round((resident_bytes() - before) / args.connections)
+    results['rss_mb'] = round(resident_bytes() / 2 ** 20, 1)
+    results['hub'] = events.hub.stats()
+
+    expected = args.connections * args.events
+
+    def writer():
+        for number in range(args.events):
+            for group_id in group_ids:
+                event = {'group': group_id, 'type': 'expense_added', 'data': {'id': number}}
+                published[f'event: expense_added\ndata: {json.dumps(event)}\n\n'.encode()] = time.perf_counter()
+                events.hub.dispatch(event)
+
+    start = time.perf_counter()
+    threading.Thread(target=writer).start()
+    while len(latencies) < expected:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    results['fanout'] = {
+        'events_published': args.events * len(group_ids),
+        'deliveries': len(latencies),
+        'deliveries_per_second': round(len(latencies) / elapsed),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1),
+        'max_ms': round(latencies[-1] * 1000, 1),
+    }
+
+    for disconnect in disconnects:
+        disconnect.set()
+    await asyncio.gather(*tasks)
+    results['hub_after_disconnect'] = events.hub.stats()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--users', type=int, default=200, help='users the connections log in as')
+    parser.add_argument('--events', type=int, default=5, help='events published per group')
+    args = parser.parse_args()
+
+    django.setup()
+    from django.test.utils import setup_databases, setup_test_environment, teardown_databases
+
+    setup_test_environment()
+    databases = setup_databases(verbosity=0, interactive=False)
+    try:
+        group_ids, tokens = seed(args.users, args.groups)
+        results = asyncio.run(run(args, group_ids, tokens))
+    finally:
+        teardown_databases(databases, verbosity=0)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
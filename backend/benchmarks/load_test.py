@@ -0,0 +1,188 @@
+"""
+Load test that replays the frontend's request flows against a running server.
+
+Each virtual user logs in as one of the accounts made by ``manage.py
+seed_load``, then sends what Dashboard.js sends: one dashboard request for the
+profile, groups, friends and friend requests, then for each group it opens a
+ticket for the group's event stream and the first page of its expenses. When
+it adds an expense it reloads the expenses, as the expense form does. It
+repeats this until the time runs out.
+
+The JSON report has throughput and p50/p95/p99 latency per endpoint. Save it
+with ``--output`` and pass an earlier report as ``--baseline`` to compare two
+commits. Run from the backend directory, with the server already running:
+
+    python manage.py seed_load --users 1000
+    python -m benchmarks.load_test --concurrency 50 --duration 60 --output after.json --baseline before.json
+"""
+import argparse
+import http.client
+import json
+import math
+import random
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    return ordered[max(0, math.ceil(len(ordered) * fraction) - 1)]
+
+
+class Session:
+    """One virtual user, on its own keep-alive connection."""
+
+    def __init__(self, base_url, record):
+        url = urlsplit(base_url)
+        connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(url.netloc, timeout=30)
+        self.prefix = url.path.rstrip('/')
+        self.record = record
+        self.token = None
+
+    def request(self, method, path, endpoint, body=None):
+        headers = {'Accept': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f'Token {self.token}'
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, self.prefix + path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            payload = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            payload, status = b'', 0
+        self.record(endpoint, time.perf_counter() - start, status)
+        if not 200 <= status < 300:
+            return None
+        return json.loads(payload) if payload else {}
+
+    def run_flow(self, rng, username, password, groups_opened, write_ratio):
+        login = self.request('POST', '/auth/login/', 'POST /auth/login/',
+                             {'username': username, 'password': password})
+        if login is None:
+            return
+        self.token = login['token']
+        dashboard = self.request('GET', '/dashboard/', 'GET /dashboard/') or {}
+        groups = dashboard.get('groups', [])
+        for group in rng.sample(groups, min(groups_opened, len(groups))):
+            group_id = group['id']
+            self.request('POST', '/events/ticket/', 'POST /events/ticket/')
+            self.request('GET', f'/expenses/?group={group_id}', 'GET /expenses/?group={id}')
+            if rng.random() < write_ratio:
+                self.request('POST', '/expenses/', 'POST /expenses/',
+                             {'title': 'load test', 'amount': rng.randint(100, 10000) / 100, 'group': group_id})
+                self.request('GET', f'/expenses/?group={group_id}', 'GET /expenses/?group={id}')
+
+
+def run(args):
+    samples = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+
+    def record(endpoint, seconds, status):
+        with lock:
+            samples[endpoint].append(seconds)
+            if not 200 <= status < 300:
+                errors[endpoint] += 1
+
+    deadline = time.monotonic() + args.duration
+    sessions = [0] * args.concurrency
+
+    def virtual_user(index):
+        rng = random.Random(args.seed + index)
+        session = Session(args.base_url, record)
+        while time.monotonic() < deadline:
+            username = f'{args.prefix}{rng.randrange(args.users)}'
+            session.run_flow(rng, username, args.password, args.groups_opened, args.write_ratio)
+            sessions[index] += 1
+
+    threads = [threading.Thread(target=virtual_user, args=(index,)) for index in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    endpoints = {}
+    for endpoint, latencies in sorted(samples.items()):
+        latencies.sort()
+        endpoints[endpoint] = {
+            'requests': len(latencies),
+            'errors': errors[endpoint],
+            'throughput_rps': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        }
+    total = sum(len(latencies) for latencies in samples.values())
+    return {
+        'label': args.label,
+        'base_url': args.base_url,
+        'concurrency': args.concurrency,
+        'duration_s': round(elapsed, 1),
+        'sessions': sum(sessions),
+        'requests': total,
+        'errors': sum(errors.values()),
+        'throughput_rps': round(total / elapsed, 1),
+        'endpoints': endpoints,
+    }
+
+
+def compare(report, baseline):
+    """Relative change of each endpoint's throughput and percentiles against an earlier report."""
+    changes = {}
+    for endpoint, stats in report['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(endpoint)
+        if before:
+            changes[endpoint] = {key: f'{(stats[key] - before[key]) / before[key]:+.1%}'
+                                 for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms') if before[key]}
+    return {'label': baseline.get('label'), 'endpoints': changes}
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--base-url', default='http://localhost:8000/api')
+    parser.add_argument('--concurrency', type=int, default=50, help='virtual users')
+    parser.add_argument('--duration', type=float, default=60, help='seconds')
+    parser.add_argument('--users', type=int, default=1000, help='how many seeded accounts to log in as')
+    parser.add_argument('--prefix', default='load', help='username prefix given to seed_load')
+    parser.add_argument('--password', default='load-test', help='password given to seed_load')
+    parser.add_argument('--groups-opened', type=int, default=2, help='groups each session opens')
+    parser.add_argument('--write-ratio', type=float, default=0.0,
+                        help='chance of adding an expense to each opened group')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--label', default=current_commit(), help='name for this run (default: git commit)')
+    parser.add_argument('--output', help='also write the report to this file')
+    parser.add_argument('--baseline', help='earlier report to compare against')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.baseline:
+        with open(args.baseline) as stream:
+            report['compared_to'] = compare(report, json.load(stream))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Benchmark for the settlement planner.
+
+Run from the backend directory:
+
+    python -m benchmarks.settle_plan --members 10000 --repeat 5
+"""
+import argparse
+import random
+import time
+from decimal import Decimal
+
+from expenses.settlement import plan_settlements
+
+
+def random_balances(members, seed):
+    rng = random.Random(seed)
+    balances = {user_id: Decimal(rng.randint(-500000, 500000)) / 100 for user_id in range(1, members)}
+    # The last member absorbs the remainder so the group nets out to zero
+    balances[members] = -sum(balances.values())
+    return balances
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--members', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    balances = random_balances(args.members, args.seed)
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        transfers = plan_settlements(balances)
+        timings.append(time.perf_counter() - start)
+
+    settled = dict(balances)
+    for transfer in transfers:
+        settled[transfer.from_user] += transfer.amount
+        settled[transfer.to_user] -= transfer.amount
+    assert not any(settled.values()), 'plan does not clear every balance'
+
+    print(f'members:   {args.members}')
+    print(f'transfers: {len(transfers)}')
+    print(f'best:      {min(timings) * 1000:.1f} ms')
+    print(f'worst:     {max(timings) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
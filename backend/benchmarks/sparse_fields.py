@@ -0,0 +1,127 @@
+"""
+Payload size and CPU cost of a group's expenses with and without sparse fieldsets.
+
+Seeds a group with ``--expenses`` expenses shared by ``--members`` members in
+a fresh test database, then fetches all of its expenses, page by page, the
+way the full client does and with ``?fields=`` as a mobile client would. For
+each variant it reports the bytes sent, the queries run and the CPU time of
+the requests, and how long rendering the same data takes with JSONRenderer
+and with FastJSONRenderer (orjson). Run from the backend directory:
+
+    python -m benchmarks.sparse_fields --expenses 1000 --members 20
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from decimal import Decimal
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dung_backend.settings')
+
+VARIANTS = {
+    'full': '',
+    'ids': '&fields=id,title,amount,date,paid_by,participants',
+    'amounts': '&fields=id,amount,paid_by',
+    'expand_payer': '&fields=id,title,amount,paid_by&expand=paid_by',
+}
+
+
+def seed(expenses, members):
+    from django.contrib.auth.models import User
+
+    from expenses import splits
+    from expenses.models import Expense, ExpenseShare, Group
+
+    User.objects.bulk_create([User(username=f'sparse{i}', first_name=f'First{i}', last_name=f'Last{i}',
+                                   email=f'sparse{i}@example.com') for i in range(members)])
+    users = list(User.objects.filter(username__startswith='sparse').order_by('id'))
+    group = Group.objects.create(name='sparse', created_by=users[0])
+    group.members.add(*users)
+    created = Expense.objects.bulk_create([
+        Expense(title=f'expense {i}', amount=Decimal('10.00') + i, group=group, paid_by=users[i % members])
+        for i in range(expenses)
+    ])
+    ExpenseShare.objects.bulk_create([share for expense in created
+                                      for share in splits.equal_shares(expense, [user.id for user in users])],
+                                     batch_size=500)
+    return users[0], group
+
+
+def fetch_all(client, url):
+    """Every page of ``url``; returns the pages' data, the bytes sent and the queries run."""
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    pages, size, queries = [], 0, 0
+    while url:
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        queries += len(context)
+        assert response.status_code == 200, response.content
+        size += len(response.content)
+        pages.append(response.data)
+        url = response.data['next']
+    return pages, size, queries
+
+
+def cpu_ms(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.process_time()
+        function()
+        timings.append(time.process_time() - start)
+    return round(statistics.median(timings) * 1000, 1)
+
+
+def run(args):
+    from rest_framework.renderers import JSONRenderer
+    from rest_framework.test import APIClient
+
+    from expenses.renderers import FastJSONRenderer, orjson
+
+    user, group = seed(args.expenses, args.members)
+    client = APIClient()
+    client.force_authenticate(user)
+    results = {'expenses': args.expenses, 'members': args.members, 'orjson': orjson is not None, 'variants': {}}
+    for name, query in VARIANTS.items():
+        url = f'/api/groups/{group.id}/expenses/?page_size=200{query}'
+        pages, size, queries = fetch_all(client, url)
+        results['variants'][name] = {
+            'bytes': size,
+            'queries': queries,
+            'request_cpu_ms': cpu_ms(lambda: fetch_all(client, url), args.repeat),
+            'render_ms': {renderer.__name__: cpu_ms(lambda: [renderer().render(page) for page in pages],
+                                                    args.repeat)
+                          for renderer in (JSONRenderer, FastJSONRenderer)},
+        }
+    full = results['variants']['full']
+    for variant in results['variants'].values():
+        variant['bytes_vs_full'] = round(variant['bytes'] / full['bytes'], 3)
+        variant['cpu_vs_full'] = round(variant['request_cpu_ms'] / full['request_cpu_ms'], 3)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--expenses', type=int, default=1000)
+    parser.add_argument('--members', type=int, default=20, help='members of the group, all in every expense')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    django.setup()
+    from django.test.utils import setup_databases, setup_test_environment, teardown_databases
+
+    setup_test_environment()
+    databases = setup_databases(verbosity=0, interactive=False)
+    try:
+        results = run(args)
+    finally:
+        teardown_databases(databases, verbosity=0)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,8 @@
 ASGI config for dung_backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Besides Django it serves the group event stream at /api/events/, over
+Server-Sent Events or WebSocket (see expenses.push).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -13,4 +15,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dung_backend.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once the app registry is ready
+from expenses.push import with_event_stream  # noqa: E402
+
+application = with_event_stream(django_application)
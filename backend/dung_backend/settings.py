@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'expenses.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -53,6 +55,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'expenses.middleware.ReplicaRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'dung_backend.urls'
@@ -90,6 +93,15 @@ DATABASES = {
     }
 }
 
+# Read replicas, as a comma separated list of hosts mirroring the default database.
+# Safe requests read from them; see expenses.routers.
+for _index, _host in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_HOSTS', '').split(','))):
+    DATABASES[f'replica{_index + 1}'] = {**DATABASES['default'], 'HOST': _host.strip(), 'TEST': {'MIRROR': 'default'}}
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['expenses.routers.ReplicaRouter']
+# After a write, that client's reads stay on the primary for this many seconds
+REPLICA_PIN_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -111,13 +123,62 @@ AUTH_PASSWORD_VALIDATORS = [
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'expenses.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
 }
 
+# orjson-backed rendering for large JSON responses (see expenses.renderers.FastJSONRenderer)
+if os.environ.get('FAST_JSON_RENDERER'):
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'] = [
+        'expenses.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ]
+
+# Cache for resolved auth tokens (see expenses.authentication). Set ALIAS to a
+# shared Django cache alias when running more than one worker process.
+TOKEN_CACHE = {
+    'MAX_SIZE': 10000,
+    'TTL': 300,
+    'ALIAS': None,
+}
+
+# Rendered groups and users that group responses are assembled from (see expenses.fragments)
+FRAGMENT_CACHE = {
+    'MAX_GROUPS': 5000,
+    'MAX_USERS': 20000,
+    'TTL': 300,
+}
+
+# Log requests slower than this many milliseconds, with their slowest SQL, to the
+# expenses.slow_requests logger (see expenses.metrics). None turns the log off.
+SLOW_REQUEST_MS = None
+
+# Threads that run password hashing for the async login view (see expenses.async_views)
+AUTH_THREAD_POOL_SIZE = 4
+
+# Group events pushed at /api/events/ (see expenses.events and expenses.push). The local
+# broker only reaches clients of the same process; with several processes, or writes
+# made by WSGI workers, use 'expenses.events.PostgresBroker'.
+EVENT_BROKER = os.environ.get('EVENT_BROKER', 'expenses.events.LocalBroker')
+EVENT_QUEUE_SIZE = 100
+EVENT_HEARTBEAT_SECONDS = 25
+# Lifetime of the single-use tickets that authenticate event streams opened from a browser
+EVENT_TICKET_SECONDS = 30
+
+# Seconds a stored Idempotency-Key response is replayed for (see expenses.idempotency);
+# `manage.py purge_idempotency_keys` deletes older keys
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+
+# Delivery channels used by `manage.py run_notifier` (see expenses.notifications)
+NOTIFICATION_TRANSPORTS = {
+    'email': 'expenses.notifications.EmailTransport',
+    'telegram': 'expenses.notifications.TelegramTransport',
+}
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
+
 
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",  # React development server
@@ -0,0 +1,22 @@
+"""
+Settings for running the test suite without the Postgres container:
+
+    python manage.py test --settings=dung_backend.test_settings
+
+Two SQLite databases stand in for the primary and a read replica. Replication
+is not simulated, so the replica stays empty unless a test writes to it; the
+router only uses it in tests that list it in DATABASE_REPLICAS.
+"""
+from .settings import *  # noqa: F401,F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',  # noqa: F405
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db_replica.sqlite3',  # noqa: F405
+    },
+}
+DATABASE_REPLICAS = []
@@ -0,0 +1,111 @@
+"""
+Archival of old expenses behind a per-group balance snapshot.
+
+``compact()`` moves a group's expenses dated before a cutoff, with their
+shares, to ArchivedExpense/ArchivedExpenseShare, and adds what they
+contributed to each member's balance and to the group total to the group's
+BalanceSnapshot. The live ledger (GroupBalance, Group.total_expenses) and the
+rollups already account for them and are left as they are; rebuilding them
+starts from the snapshot, or the archive, instead of the full history.
+
+The work is done in chunks of the oldest expenses, each in its own
+transaction with the group row locked, so an interrupted run leaves every
+group consistent and the next run picks up where it stopped.
+
+Archived expenses no longer appear in the expense endpoints and cannot be
+edited, but are still part of the group's export (see expenses.exporter).
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import ledger, versioning
+from .models import (ArchivedExpense, ArchivedExpenseShare, BalanceSnapshot, BalanceSnapshotEntry, Expense,
+                     ExpenseShare, Group)
+from .signals import archiving
+
+CHUNK_SIZE = 1000
+_COPIED = ['id', 'title', 'icon', 'amount', 'group_id', 'paid_by_id', 'date', 'description']
+
+
+def archive_chunk(group, before, chunk_size=CHUNK_SIZE):
+    """Archive up to ``chunk_size`` of the group's oldest expenses dated before ``before``; returns how many."""
+    with transaction.atomic():
+        # Serializes with other compactions and ledger rebuilds of the group
+        list(Group.objects.select_for_update().filter(pk=group.pk).values_list('pk', flat=True))
+        expenses = list(Expense.objects.filter(group=group, date__lt=before)
+                        .order_by('date', 'id').values(*_COPIED)[:chunk_size])
+        if not expenses:
+            return 0
+        expense_ids = [expense['id'] for expense in expenses]
+        shares = list(ExpenseShare.objects.filter(expense_id__in=expense_ids)
+                      .order_by('id').values_list('expense_id', 'user_id', 'amount_owed'))
+
+        ArchivedExpense.objects.bulk_create([ArchivedExpense(**expense) for expense in expenses])
+        ArchivedExpenseShare.objects.bulk_create([
+            ArchivedExpenseShare(expense_id=expense_id, user_id=user_id, amount_owed=amount_owed)
+            for expense_id, user_id, amount_owed in shares
+        ], batch_size=CHUNK_SIZE)
+
+        deltas = defaultdict(Decimal)
+        paid_by = {expense['id']: expense['paid_by_id'] for expense in expenses}
+        for expense in expenses:
+            if expense['paid_by_id'] is not None:
+                deltas[expense['paid_by_id']] += ledger.to_cents(expense['amount'])
+        for expense_id, user_id, amount_owed in shares:
+            # Expenses without a payer are out of the ledger (see expenses.ledger)
+            if paid_by[expense_id] is not None:
+                deltas[user_id] -= ledger.to_cents(amount_owed)
+        snapshot, _ = BalanceSnapshot.objects.get_or_create(group=group)
+        _add_to_snapshot(snapshot, deltas)
+        snapshot.total_expenses += sum((ledger.to_cents(expense['amount']) for expense in expenses), ledger.ZERO)
+        snapshot.expense_count += len(expenses)
+        snapshot.save(update_fields=['total_expenses', 'expense_count', 'updated_at'])
+
+        with archiving(group.pk, expense_ids):
+            Expense.objects.filter(pk__in=expense_ids).delete()
+        versioning.bump(group.pk)
+    return len(expenses)
+
+
+def _add_to_snapshot(snapshot, deltas):
+    deltas = {user_id: amount for user_id, amount in deltas.items() if amount}
+    updated = []
+    for entry in snapshot.entries.filter(user_id__in=deltas):
+        entry.balance += deltas.pop(entry.user_id)
+        updated.append(entry)
+    if updated:
+        BalanceSnapshotEntry.objects.bulk_update(updated, ['balance'])
+    if deltas:
+        BalanceSnapshotEntry.objects.bulk_create([
+            BalanceSnapshotEntry(snapshot=snapshot, user_id=user_id, balance=amount)
+            for user_id, amount in deltas.items()
+        ])
+
+
+def compact(group, before, chunk_size=CHUNK_SIZE, max_chunks=None):
+    """
+    Archive the group's expenses dated before ``before``; returns ``(archived, done)``.
+
+    Stops after ``max_chunks`` chunks when given; ``done`` is False while
+    expenses before the cutoff are left. Once there are none, the cutoff is
+    recorded as the snapshot's ``archived_before``.
+    """
+    archived = chunks = 0
+    while max_chunks is None or chunks < max_chunks:
+        count = archive_chunk(group, before, chunk_size)
+        archived += count
+        chunks += 1
+        if count < chunk_size:
+            break
+    else:
+        if Expense.objects.filter(group=group, date__lt=before).exists():
+            return archived, False
+
+    (BalanceSnapshot.objects.filter(group=group)
+     .filter(Q(archived_before__isnull=True) | Q(archived_before__lt=before))
+     .update(archived_before=before, updated_at=timezone.now()))
+    return archived, True
@@ -0,0 +1,143 @@
+"""
+Async versions of the read-heavy endpoints, mounted under /api/async/.
+
+These are plain Django async views rather than DRF views (DRF 3.14 has no
+async support). They authenticate with the same token cache, return the same
+payloads as their synchronous counterparts and read through the async ORM,
+so under ASGI a slow request does not hold a worker thread.
+
+``login`` runs the password hash, which is CPU bound, in a small dedicated
+thread pool (settings.AUTH_THREAD_POOL_SIZE) so a burst of logins cannot
+starve everything else.
+"""
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.db import close_old_connections
+from django.http import JsonResponse
+from rest_framework import exceptions
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+
+from .authentication import aauthenticate
+from .models import Expense, Group
+from .pagination import ExpenseCursorPagination
+from .queries import visible_groups
+from .serializers import ExpenseSerializer, GroupSerializer, UserSerializer
+
+_auth_pool = ThreadPoolExecutor(max_workers=getattr(settings, 'AUTH_THREAD_POOL_SIZE', 4),
+                                thread_name_prefix='authenticate')
+
+
+def _error(detail, status):
+    return JsonResponse({'detail': detail}, status=status)
+
+
+def async_api_view(methods=('GET',), authenticated=True):
+    """Method check, token authentication and DRF-style error bodies for an async view."""
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return _error(f'Method "{request.method}" not allowed.', 405)
+            if authenticated:
+                try:
+                    credentials = await aauthenticate(request)
+                except exceptions.AuthenticationFailed as exc:
+                    return _error(str(exc.detail), 401)
+                if credentials is None:
+                    return _error('Authentication credentials were not provided.', 401)
+                request.user, request.auth = credentials
+            try:
+                return await view(request, *args, **kwargs)
+            except exceptions.APIException as exc:
+                return _error(str(exc.detail), exc.status_code)
+            except Group.DoesNotExist:
+                return _error('Not found.', 404)
+        # Token authenticated like the DRF views; Django 4.2's csrf_exempt cannot wrap coroutines
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+@async_api_view()
+async def group_list(request):
+    groups = visible_groups(request.user).select_related('created_by').prefetch_related('members')
+    return JsonResponse(GroupSerializer([group async for group in groups], many=True).data, safe=False)
+
+
+@async_api_view()
+async def group_details(request, pk):
+    group = await (visible_groups(request.user).select_related('created_by').prefetch_related('members')
+                   .aget(pk=pk))
+    return JsonResponse(GroupSerializer(group).data)
+
+
+@async_api_view()
+async def group_balances(request, pk):
+    group = await visible_groups(request.user).aget(pk=pk)
+    entries = group.balance_entries.select_related('user').order_by('user__username')
+    return JsonResponse({
+        'group': group.name,
+        'total_expenses': str(group.get_total_expenses()),
+        'balances': [{
+            'user': UserSerializer(entry.user).data,
+            'balance': str(entry.balance),
+            'status': 'owes' if entry.balance < 0 else 'owed' if entry.balance > 0 else 'settled'
+        } async for entry in entries],
+    })
+
+
+@async_api_view()
+async def expense_list(request):
+    queryset = Expense.objects.filter(group__members=request.user)
+    group_id = request.GET.get('group')
+    if group_id is not None:
+        try:
+            queryset = queryset.filter(group_id=int(group_id))
+        except ValueError:
+            raise exceptions.NotFound()
+    queryset = queryset.distinct().select_related('paid_by').prefetch_related('participants')
+
+    paginator = ExpenseCursorPagination()
+    page = await paginator.apaginate_queryset(queryset, Request(request))
+    return JsonResponse(paginator.get_paginated_response(ExpenseSerializer(page, many=True).data).data)
+
+
+@async_api_view()
+async def profile(request):
+    return JsonResponse({'user': UserSerializer(request.user).data})
+
+
+def _authenticate(**credentials):
+    # Runs on a pool thread, outside any request cycle that would close its connection
+    close_old_connections()
+    try:
+        return authenticate(**credentials)
+    finally:
+        close_old_connections()
+
+
+@async_api_view(methods=('POST',), authenticated=False)
+async def login(request):
+    try:
+        data = json.loads(request.body) if request.content_type == 'application/json' else request.POST
+    except ValueError:
+        data = None
+    if not hasattr(data, 'get'):
+        return JsonResponse({'error': 'Expected a JSON object or form data'}, status=400)
+    username = data.get('username')
+    password = data.get('password')
+    if not username or not password:
+        return JsonResponse({'error': 'Username and password required'}, status=400)
+
+    user = await asyncio.get_running_loop().run_in_executor(
+        _auth_pool, partial(_authenticate, username=username, password=password))
+    if user is None:
+        return JsonResponse({'error': 'Invalid credentials'}, status=401)
+    token, _ = await Token.objects.aget_or_create(user=user)
+    return JsonResponse({'token': token.key, 'user': UserSerializer(user).data})
@@ -0,0 +1,175 @@
+"""
+Token authentication with a cache in front of the Token + User lookup.
+
+Resolved tokens are kept in a bounded LRU cache with a TTL, held in-process by
+default. Setting ``TOKEN_CACHE['ALIAS']`` to a Django cache alias stores them
+there instead, which lets every worker process see invalidations; use that
+whenever more than one process serves the API.
+
+Entries are dropped as soon as a token is deleted (logout) or its user is
+saved (deactivation, profile changes), see expenses.signals.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+from rest_framework.authtoken.models import Token
+
+DEFAULTS = {
+    'MAX_SIZE': 10000,
+    'TTL': 300,
+    'ALIAS': None,
+}
+
+# The password hash is never cached; it is loaded lazily if anything asks for it
+USER_FIELDS = [field.attname for field in User._meta.concrete_fields if field.attname != 'password']
+
+
+class TokenCache:
+    def __init__(self, max_size, ttl, alias=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.alias = alias
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _cache_key(self, key):
+        return f'auth-token:{key}'
+
+    def get(self, key):
+        if self.alias:
+            entry = caches[self.alias].get(self._cache_key(key))
+        else:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    if entry[0] < time.monotonic():
+                        del self._entries[key]
+                        entry = None
+                    else:
+                        self._entries.move_to_end(key)
+                        entry = entry[1]
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def set(self, key, value):
+        if self.alias:
+            caches[self.alias].set(self._cache_key(key), value, self.ttl)
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        if self.alias:
+            caches[self.alias].delete(self._cache_key(key))
+        with self._lock:
+            if self._entries.pop(key, None) is not None or self.alias:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+            }
+
+
+def _build_cache():
+    options = {**DEFAULTS, **getattr(settings, 'TOKEN_CACHE', {})}
+    return TokenCache(options['MAX_SIZE'], options['TTL'], options['ALIAS'])
+
+
+token_cache = _build_cache()
+
+
+def _cache_entry(token):
+    return (token.created, [getattr(token.user, name) for name in USER_FIELDS])
+
+
+def _credentials(key, entry):
+    # Fresh instances per request, so nothing a view does leaks into the cache
+    created, user_values = entry
+    user = User.from_db(DEFAULT_DB_ALIAS, USER_FIELDS, user_values)
+    token = Token.from_db(DEFAULT_DB_ALIAS, ['key', 'user_id', 'created'], [key, user.pk, created])
+    token.user = user
+
+    if not user.is_active:
+        raise exceptions.AuthenticationFailed('User inactive or deleted.')
+    return (user, token)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """Drop-in replacement for TokenAuthentication that skips the database on cache hits."""
+
+    def authenticate_credentials(self, key):
+        entry = token_cache.get(key)
+        if entry is None:
+            try:
+                token = Token.objects.select_related('user').get(key=key)
+            except Token.DoesNotExist:
+                raise exceptions.AuthenticationFailed('Invalid token.')
+            entry = _cache_entry(token)
+            token_cache.set(key, entry)
+        return _credentials(key, entry)
+
+
+async def aauthenticate(request):
+    """
+    CachedTokenAuthentication for plain Django async views (see expenses.async_views).
+
+    Returns ``(user, token)``, or None when the request carries no token.
+    """
+    auth = get_authorization_header(request).split()
+    if not auth or auth[0].lower() != TokenAuthentication.keyword.lower().encode():
+        return None
+    if len(auth) != 2:
+        raise exceptions.AuthenticationFailed('Invalid token header.')
+    try:
+        key = auth[1].decode()
+    except UnicodeError:
+        raise exceptions.AuthenticationFailed('Invalid token header. Token string should not contain invalid characters.')
+    return await aauthenticate_key(key)
+
+
+async def aauthenticate_key(key):
+    """Returns ``(user, token)`` for a token key, or raises AuthenticationFailed."""
+    # A shared cache alias means network I/O, which must not block the event loop
+    entry = await sync_to_async(token_cache.get)(key) if token_cache.alias else token_cache.get(key)
+    if entry is None:
+        try:
+            token = await Token.objects.select_related('user').aget(key=key)
+        except Token.DoesNotExist:
+            raise exceptions.AuthenticationFailed('Invalid token.')
+        entry = _cache_entry(token)
+        if token_cache.alias:
+            await sync_to_async(token_cache.set)(key, entry)
+        else:
+            token_cache.set(key, entry)
+    return _credentials(key, entry)
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.checks import Error, register
+
+from . import renderers
+
+FAST_JSON_RENDERER = 'expenses.renderers.FastJSONRenderer'
+
+
+@register()
+def fast_json_renderer_check(app_configs, **kwargs):
+    """FastJSONRenderer falls back to JSONRenderer without orjson, so configuring it then does nothing."""
+    configured = getattr(settings, 'REST_FRAMEWORK', {}).get('DEFAULT_RENDERER_CLASSES', ())
+    if FAST_JSON_RENDERER in configured and renderers.orjson is None:
+        return [Error(f'{FAST_JSON_RENDERER} is configured but orjson is not installed',
+                      hint='pip install -r requirements.txt, or unset FAST_JSON_RENDERER', id='expenses.E001')]
+    return []
@@ -0,0 +1,362 @@
+"""
+Group events pushed to connected clients (see expenses.push).
+
+Writes call ``publish()``; the event goes out when the surrounding transaction
+commits, and not at all if it rolls back. Events of one transaction are sent
+together, with repeated ``balances_changed`` events for a group merged into
+one.
+
+Sent events go through the broker named by settings.EVENT_BROKER:
+
+- ``LocalBroker`` (the default) hands them straight to this process's hub, so
+  only clients connected to the same process hear about a change;
+- ``PostgresBroker`` sends them with NOTIFY and has every process LISTEN, so
+  any number of ASGI processes, plus WSGI workers and management commands
+  that publish, share one stream. It needs PostgreSQL. Events too large for
+  a NOTIFY payload are stored in EventPayload and sent by id.
+
+Events are sent after the write has committed, so a broker that fails is
+logged and never turns the write into an error response.
+
+The hub keeps the subscriptions of this process: a small bounded queue per
+connection, filled from whatever thread published. A client that falls
+behind by more than settings.EVENT_QUEUE_SIZE events is disconnected rather
+than buffered without limit; it reconnects and refetches. A ``member_left``
+event also takes its group away from the removed members' subscriptions, and
+``group_deleted`` from everyone's. ``revoked`` (sent when a user's token is
+deleted, on logout, or the user is deactivated or deleted) closes every
+stream of the users it names.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import select
+import threading
+import time
+import weakref
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import EventPayload
+
+logger = logging.getLogger(__name__)
+
+EXPENSE_ADDED = 'expense_added'
+EXPENSES_ADDED = 'expenses_added'
+EXPENSE_UPDATED = 'expense_updated'
+EXPENSE_DELETED = 'expense_deleted'
+MEMBER_JOINED = 'member_joined'
+MEMBER_LEFT = 'member_left'
+BALANCES_CHANGED = 'balances_changed'
+GROUP_DELETED = 'group_deleted'
+# Not tied to a group: ``data['users']`` lose all their streams
+REVOKED = 'revoked'
+# Events whose payloads are merged per group and transaction
+MERGED = {BALANCES_CHANGED}
+# Queued for a connection that has been idle for a heartbeat interval
+PING = ('ping', None)
+# Seconds PostgresBroker waits before listening again after losing its connection
+RECONNECT_DELAY = 5
+# PostgreSQL rejects NOTIFY payloads of this many bytes or more
+NOTIFY_LIMIT = 8000
+# Stored payloads older than this are deleted; a listener that has not read one by then never will
+PAYLOAD_SECONDS = 300
+
+
+class Subscription:
+    """One connected client: the groups it follows and its pending events."""
+
+    def __init__(self, group_ids, max_size, user_id=None):
+        self.group_ids = frozenset(group_ids)
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(max_size)
+        self.overflowed = False
+        # Set once the user may no longer see any group the stream followed
+        self.revoked = False
+
+    def deliver(self, message):
+        # Runs on the subscriber's loop
+        if self.overflowed or self.revoked:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            self._hang_up()
+
+    def revoke(self):
+        """End the stream after the events already queued; runs on the subscriber's loop."""
+        if not self.overflowed and not self.revoked:
+            self.revoked = True
+            self._hang_up()
+
+    def _hang_up(self):
+        # Wake the stream so it can hang up
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    def ping(self):
+        """Queue a PING, unless events are already waiting to be sent."""
+        if self.queue.empty():
+            self.queue.put_nowait(PING)
+
+    async def get(self):
+        """The next ``(type, JSON)`` event, PING, or None once the client has fallen too far behind."""
+        return await self.queue.get()
+
+
+class Hub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_group = defaultdict(set)
+        self._by_user = defaultdict(set)
+        self._broker_started = False
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, group_ids, max_size=None, user_id=None):
+        subscription = Subscription(group_ids, max_size or getattr(settings, 'EVENT_QUEUE_SIZE', 100), user_id)
+        with self._lock:
+            for group_id in subscription.group_ids:
+                self._by_group[group_id].add(subscription)
+            if subscription.user_id is not None:
+                self._by_user[subscription.user_id].add(subscription)
+            start_broker = not self._broker_started
+            self._broker_started = True
+        if start_broker:
+            get_broker().start(self)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for group_id in subscription.group_ids:
+                subscribers = self._by_group.get(group_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._by_group[group_id]
+            streams = self._by_user.get(subscription.user_id)
+            if streams is not None:
+                streams.discard(subscription)
+                if not streams:
+                    del self._by_user[subscription.user_id]
+            if subscription.overflowed:
+                self.dropped += 1
+
+    def dispatch(self, event):
+        """Hand ``event`` to the subscribers of its group, or of the users it revokes; safe from any thread."""
+        # Encoded once here rather than once per connection
+        message = (event['type'], json.dumps(event))
+        by_loop = defaultdict(list)
+        revoked = []
+        with self._lock:
+            if event['type'] == REVOKED:
+                receivers = {subscription for user_id in event['data'].get('users', ())
+                             for subscription in self._by_user.get(user_id, ())}
+            else:
+                receivers = self._by_group.get(event['group'], ())
+            for subscription in receivers:
+                by_loop[subscription.loop].append(subscription)
+                self.delivered += 1
+            if event['type'] == REVOKED:
+                revoked = list(receivers)
+            elif event['type'] == MEMBER_LEFT:
+                revoked = self._leave(event['group'], event['data'].get('users', ()))
+            elif event['type'] == GROUP_DELETED:
+                revoked = self._leave(event['group'])
+        # One wake-up per event loop, however many of its connections follow the group
+        for loop, subscribers in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(_deliver, subscribers, message)
+            except RuntimeError:
+                # The loop has shut down
+                pass
+        for subscription in revoked:
+            # Queued after the event that ended the stream
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.revoke)
+            except RuntimeError:
+                pass
+
+    def _leave(self, group_id, user_ids=None):
+        """Stop the subscriptions of ``user_ids``, or all, following the group; returns those left with no groups."""
+        user_ids = None if user_ids is None else set(user_ids)
+        subscribers = self._by_group.get(group_id, set())
+        leaving = [subscription for subscription in subscribers
+                   if user_ids is None or subscription.user_id in user_ids]
+        for subscription in leaving:
+            subscribers.discard(subscription)
+            subscription.group_ids = subscription.group_ids - {group_id}
+        if not subscribers:
+            self._by_group.pop(group_id, None)
+        return [subscription for subscription in leaving if not subscription.group_ids]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'connections': len({subscription for group in self._by_group.values() for subscription in group}),
+                'groups': len(self._by_group),
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+            }
+
+
+def _deliver(subscribers, message):
+    for subscription in subscribers:
+        subscription.deliver(message)
+
+
+hub = Hub()
+
+
+class LocalBroker:
+    """Delivers events to the clients of this process only."""
+
+    def start(self, hub):
+        pass
+
+    def publish(self, events):
+        for event in events:
+            hub.dispatch(event)
+
+
+class PostgresBroker:
+    """
+    Shares events between processes through PostgreSQL LISTEN/NOTIFY.
+
+    Each process that has subscribers keeps one extra connection listening on
+    settings.EVENT_CHANNEL, in a background thread.
+    """
+
+    def __init__(self):
+        self.channel = getattr(settings, 'EVENT_CHANNEL', 'dung_events')
+
+    def publish(self, events):
+        with connection.cursor() as cursor:
+            for event in events:
+                cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, self.encode(event)])
+
+    def encode(self, event):
+        """The NOTIFY payload for ``event``: the event itself, or the id of its stored copy if it is too large."""
+        payload = json.dumps(event)
+        if len(payload.encode()) < NOTIFY_LIMIT:
+            return payload
+        # e.g. the balances of a group with a few hundred members
+        EventPayload.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=PAYLOAD_SECONDS)).delete()
+        stored = EventPayload.objects.create(event=event)
+        return json.dumps({'group': event['group'], 'type': event['type'], 'payload': stored.pk})
+
+    def decode(self, payload):
+        """The event sent by encode(), or None if its stored copy is gone."""
+        event = json.loads(payload)
+        if 'payload' in event:
+            return EventPayload.objects.filter(pk=event['payload']).values_list('event', flat=True).first()
+        return event
+
+    def start(self, hub):
+        threading.Thread(target=self.listen, args=(hub,), name='event-listener', daemon=True).start()
+
+    def listen(self, hub):
+        while True:
+            listener = connections.create_connection('default')
+            try:
+                listener.ensure_connection()
+                raw = listener.connection
+                raw.autocommit = True
+                with raw.cursor() as cursor:
+                    cursor.execute(f'LISTEN {listener.ops.quote_name(self.channel)}')
+                while True:
+                    if select.select([raw], [], [], 60) == ([], [], []):
+                        continue
+                    raw.poll()
+                    while raw.notifies:
+                        self.dispatch(hub, raw.notifies.pop(0).payload)
+            except Exception:
+                # Events sent while reconnecting are lost; clients refetch when they reconnect anyway
+                logger.exception('Event listener lost its connection, reconnecting')
+                time.sleep(RECONNECT_DELAY)
+            finally:
+                listener.close()
+
+    def dispatch(self, hub, payload):
+        try:
+            event = self.decode(payload)
+            if event is None:
+                logger.warning('Ignoring event %r, its stored payload has expired', payload)
+                return
+            hub.dispatch(event)
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Ignoring malformed event %r', payload)
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = import_string(getattr(settings, 'EVENT_BROKER', 'expenses.events.LocalBroker'))()
+    return _broker
+
+
+class _Batch:
+    """Events of one transaction, sent by a single on_commit callback."""
+
+    def __init__(self):
+        self.events = []
+        self.merged = {}
+
+    def add(self, event):
+        key = (event['group'], event['type'])
+        if event['type'] not in MERGED:
+            self.events.append(event)
+        elif key in self.merged:
+            self.merged[key]['data'].update(event['data'])
+        else:
+            self.merged[key] = event
+
+    def send(self):
+        if _pending_batch() is self:
+            _pending.set(None)
+        # Merged events go last, after whatever caused them
+        _send(self.events + list(self.merged.values()))
+
+
+# A weak reference to the batch of the current transaction. Only its on_commit callback holds the batch,
+# so the reference is cleared when the callback runs and when a rollback drops the callback with it.
+_pending = contextvars.ContextVar('pending_event_batch', default=None)
+
+
+def _pending_batch():
+    reference = _pending.get()
+    return reference() if reference is not None else None
+
+
+def _send(events):
+    # The write the events describe has committed by now; clients refetch when they reconnect anyway
+    try:
+        get_broker().publish(events)
+    except Exception:
+        logger.exception('Could not publish %d event(s)', len(events))
+
+
+def publish(group_id, kind, data=None):
+    """Send an event to the group's subscribers once the current transaction commits."""
+    event = {'group': group_id, 'type': kind, 'data': data or {}}
+    if not connection.in_atomic_block:
+        _send([event])
+        return
+    batch = _pending_batch()
+    if batch is None:
+        batch = _Batch()
+        _pending.set(weakref.ref(batch))
+        transaction.on_commit(batch.send)
+    batch.add(event)
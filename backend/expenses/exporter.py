@@ -0,0 +1,77 @@
+"""
+Streaming export of a group's expense history, one line per expense share.
+
+Rows come from a single LEFT JOIN of expenses, shares and users read through
+a server-side cursor, and are written out in small chunks, so memory use is
+bounded by ``CHUNK_SIZE`` whatever the size of the group. Archived expenses
+(see expenses.archive) are read the same way and merged in by date.
+"""
+import csv
+import heapq
+import json
+
+from .models import ArchivedExpense, Expense
+
+CHUNK_SIZE = 2000
+CSV_HEADER = ['expense_id', 'date', 'title', 'icon', 'description', 'amount', 'paid_by',
+              'participant', 'amount_owed']
+_COLUMNS = ['id', 'date', 'title', 'icon', 'description', 'amount', 'paid_by__username',
+            'expenseshare__user__username', 'expenseshare__amount_owed']
+_ARCHIVED_COLUMNS = _COLUMNS[:-2] + ['shares__user__username', 'shares__amount_owed']
+
+
+def share_rows(group):
+    live = (Expense.objects.filter(group=group)
+            .order_by('date', 'id', 'expenseshare__id')
+            .values_list(*_COLUMNS)
+            .iterator(chunk_size=CHUNK_SIZE))
+    archived = (ArchivedExpense.objects.filter(group=group)
+                .order_by('date', 'id', 'shares__id')
+                .values_list(*_ARCHIVED_COLUMNS)
+                .iterator(chunk_size=CHUNK_SIZE))
+    # Archived expenses keep their ids, so (date, id) orders the two streams the same way
+    return heapq.merge(archived, live, key=lambda row: (row[1], row[0]))
+
+
+class _Echo:
+    """File-like object whose write() hands the line back to the csv writer's caller."""
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_HEADER)
+    chunk = []
+    for expense_id, date, title, icon, description, amount, paid_by, user, owed in rows:
+        chunk.append(writer.writerow([expense_id, date.isoformat(), title, icon, description, amount,
+                                      paid_by or '', user or '', '' if owed is None else owed]))
+        if len(chunk) >= CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def stream_ndjson(rows):
+    """One JSON object per expense; its shares are consecutive rows thanks to the ordering."""
+    chunk = []
+    current = None
+    started = False
+    for expense_id, date, title, icon, description, amount, paid_by, user, owed in rows:
+        if current is None or current['id'] != expense_id:
+            if current is not None:
+                chunk.append(json.dumps(current) + '\n')
+                # The first line goes out on its own so the client sees data right away
+                if len(chunk) >= CHUNK_SIZE or not started:
+                    yield ''.join(chunk)
+                    chunk = []
+                    started = True
+            current = {'id': expense_id, 'date': date.isoformat(), 'title': title, 'icon': icon,
+                       'description': description, 'amount': str(amount), 'paid_by': paid_by, 'shares': []}
+        if user is not None:
+            current['shares'].append({'user': user, 'amount_owed': str(owed)})
+    if current is not None:
+        chunk.append(json.dumps(current) + '\n')
+    if chunk:
+        yield ''.join(chunk)
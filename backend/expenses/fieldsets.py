@@ -0,0 +1,138 @@
+"""
+Sparse fieldsets for read requests: ``?fields=`` and ``?expand=``.
+
+``?fields=id,amount,participants`` limits the response to the listed fields.
+Nested objects (an expense's ``paid_by`` and ``participants``, a group's
+``created_by`` and ``members``, ...) are then sent as ids, unless they are
+also named in ``?expand=``. ``?expand=`` on its own keeps every field but
+collapses the nested objects it does not name. Without either parameter, and
+on writes, responses are unchanged.
+
+Fields that are left out or collapsed are never serialized, and viewsets use
+``Fieldset.includes``/``Fieldset.expands`` to skip the joins and prefetches
+behind them. The ids of collapsed many-to-many fields are read from the
+through table with one query per response, without loading the related rows.
+"""
+from collections import defaultdict
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+
+def _names(value):
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+class RelatedIdsField(serializers.Field):
+    """The primary keys of a to-many relation, from ``load_related_ids`` when it has run."""
+
+    def __init__(self, **kwargs):
+        super().__init__(read_only=True, **kwargs)
+
+    def get_attribute(self, instance):
+        loaded = getattr(instance, '_related_ids', {})
+        if self.source in loaded:
+            return loaded[self.source]
+        return [related.pk for related in super().get_attribute(instance).all()]
+
+    def to_representation(self, value):
+        return list(value)
+
+
+def load_related_ids(instances, names):
+    """Read the ids behind the many-to-many fields ``names`` of ``instances``, one query per field."""
+    if not instances:
+        return
+    model = type(instances[0])
+    by_pk = {instance.pk: instance for instance in instances}
+    for name in names:
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            field = None
+        if not isinstance(field, models.ManyToManyField):
+            # Left to RelatedIdsField, which reads the relation itself
+            continue
+        through = field.remote_field.through._meta
+        own, related = (through.get_field(field.m2m_field_name()).attname,
+                        through.get_field(field.m2m_reverse_field_name()).attname)
+        ids = defaultdict(list)
+        for pk, related_id in (through.model.objects.filter(**{f'{own}__in': by_pk})
+                               .order_by('pk').values_list(own, related)):
+            ids[pk].append(related_id)
+        for pk, instance in by_pk.items():
+            if not hasattr(instance, '_related_ids'):
+                instance._related_ids = {}
+            instance._related_ids[name] = ids[pk]
+
+
+class Fieldset:
+    def __init__(self, fields=None, expand=None):
+        # None means every field, and every nested object expanded
+        self.fields = fields
+        self.expand = expand
+
+    @classmethod
+    def from_request(cls, request):
+        params = request.query_params
+        if request.method not in SAFE_METHODS or ('fields' not in params and 'expand' not in params):
+            return cls()
+        fields = _names(params['fields']) if 'fields' in params else None
+        return cls(fields, _names(params.get('expand', '')))
+
+    @property
+    def is_full(self):
+        return self.fields is None and self.expand is None
+
+    def includes(self, name):
+        return self.fields is None or name in self.fields
+
+    def expands(self, name):
+        return self.includes(name) and (self.expand is None or name in self.expand)
+
+    def check(self, names, nested):
+        """Raise ValidationError for requested fields that are not in ``names``, or expansions not in ``nested``."""
+        unknown = sorted((self.fields or set()) - set(names))
+        if unknown:
+            raise serializers.ValidationError({'fields': [f"Unknown field(s): {', '.join(unknown)}"]})
+        unknown = sorted((self.expand or set()) - set(nested))
+        if unknown:
+            raise serializers.ValidationError({'expand': [f"Cannot expand: {', '.join(unknown)}"]})
+
+    def apply(self, serializer):
+        """Drop and collapse the fields of ``serializer`` (or of its child, for many=True); returns it."""
+        if self.is_full:
+            return serializer
+        many = isinstance(serializer, serializers.ListSerializer)
+        fields = serializer.child.fields if many else serializer.fields
+        readable = [name for name, field in fields.items() if not field.write_only]
+        nested = [name for name in readable if isinstance(fields[name], serializers.BaseSerializer)]
+        self.check(readable, nested)
+        id_lists = []
+        for name in readable:
+            if not self.includes(name):
+                del fields[name]
+            elif name in nested and not self.expands(name):
+                source = {'source': fields[name].source} if fields[name].source != name else {}
+                if isinstance(fields[name], serializers.ListSerializer):
+                    fields[name] = RelatedIdsField(**source)
+                    id_lists.append(fields[name].source)
+                else:
+                    fields[name] = serializers.PrimaryKeyRelatedField(read_only=True, **source)
+        if id_lists and serializer.instance is not None:
+            # A queryset keeps the rows it was evaluated with, so the serializer will not query again
+            instances = list(serializer.instance) if many else [serializer.instance]
+            load_related_ids([instance for instance in instances if isinstance(instance, models.Model)], id_lists)
+        return serializer
+
+
+class SparseFieldsetMixin:
+    """Applies the request's fieldset to every serializer the viewset builds."""
+
+    def get_fieldset(self):
+        return Fieldset.from_request(self.request)
+
+    def get_serializer(self, *args, **kwargs):
+        return self.get_fieldset().apply(super().get_serializer(*args, **kwargs))
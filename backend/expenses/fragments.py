@@ -0,0 +1,221 @@
+"""
+Cache of pre-rendered group and user representations.
+
+Group and dashboard responses nest every member's UserSerializer output in
+every group, so rendering them costs a members query plus a serializer pass
+per member per group, for data that rarely changes. Instead, each group is
+kept as its rendered fields plus the ids of its creator and members, and each
+user as their rendered fields, and responses are assembled from the two.
+
+- Group fragments are keyed by id and Group.version, which every change to a
+  group or its membership bumps, so a stale one is never served, in any
+  process; membership changes also drop them straight away.
+- User fragments are keyed by id and dropped when the user is saved or
+  deleted (see expenses.signals). That only reaches this process, so a group
+  whose fragment is rebuilt renders its users from the database rather than
+  from this cache. Saving a user bumps the version of each of their groups,
+  so every process rebuilds those groups and their users. A response sent
+  under a new ETag therefore never carries a user another process changed.
+
+Fragments rendered inside a transaction are only stored once it commits: a
+rolled back one could otherwise leave rows that never existed cached under
+an id and version that get used again.
+
+Both caches are LRUs bounded by settings.FRAGMENT_CACHE and count hits,
+misses, evictions and invalidations for expenses.metrics.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .fieldsets import Fieldset
+from .models import Group
+from .serializers import GroupSerializer, UserSerializer
+
+DEFAULTS = {
+    'MAX_GROUPS': 5000,
+    'MAX_USERS': 20000,
+    'TTL': 300,
+}
+
+
+class FragmentCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_many(self, versions):
+        """The fragments of ``{key: version}`` that are cached for that version, as ``{key: fragment}``."""
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for key, version in versions.items():
+                entry = self._entries.get(key)
+                if entry is not None and (entry[0] < now or entry[1] != version):
+                    del self._entries[key]
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self._entries.move_to_end(key)
+                    found[key] = entry[2]
+                    self.hits += 1
+        return found
+
+    def set_many(self, fragments, versions=None):
+        """Store ``{key: fragment}``, each under ``versions[key]`` (None without ``versions``)."""
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key, fragment in fragments.items():
+                self._entries[key] = (expires, versions[key] if versions else None, fragment)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+            }
+
+
+def _build_caches():
+    options = {**DEFAULTS, **getattr(settings, 'FRAGMENT_CACHE', {})}
+    return FragmentCache(options['MAX_GROUPS'], options['TTL']), FragmentCache(options['MAX_USERS'], options['TTL'])
+
+
+group_fragments, user_fragments = _build_caches()
+
+
+def render_users(user_ids, loaded=None, refresh=()):
+    """
+    UserSerializer output for ``user_ids``, as ``{user_id: data}``; deleted users are left out.
+
+    ``loaded`` optionally maps user ids to User instances already fetched,
+    which are rendered instead of being queried again. Users in ``refresh``
+    are rendered afresh even when they are cached.
+    """
+    user_ids = set(user_ids)
+    rendered = user_fragments.get_many(dict.fromkeys(user_ids.difference(refresh)))
+    missing = user_ids - rendered.keys()
+    if missing:
+        users = [loaded[user_id] for user_id in missing if user_id in loaded] if loaded else []
+        queried = missing.difference(user.pk for user in users)
+        if queried:
+            users += User.objects.filter(pk__in=queried).only(*UserSerializer.Meta.fields)
+        fresh = {user.pk: dict(UserSerializer(user).data) for user in users}
+        transaction.on_commit(lambda: user_fragments.set_many(fresh))
+        rendered.update(fresh)
+    return rendered
+
+
+def _group_fragment(group, member_ids, fields):
+    fragment = {}
+    for name in GroupSerializer.Meta.fields:
+        if name == 'created_by':
+            fragment[name] = group.created_by_id
+        elif name == 'members':
+            fragment[name] = member_ids
+        else:
+            fragment[name] = fields[name].to_representation(getattr(group, name))
+    return fragment
+
+
+# GroupSerializer fields that nest users, kept as ids in the group fragments
+USER_FIELDS = ('created_by', 'members')
+
+
+def render_groups(groups, fieldset=None):
+    """
+    GroupSerializer(groups, many=True).data, assembled from the fragment caches.
+
+    ``fieldset`` (see expenses.fieldsets) leaves fields out, and sends users
+    as ids unless they are expanded, without rendering them.
+
+    ``groups`` needs no select_related or prefetch_related: only groups whose
+    fragment is missing or outdated have their members looked up, with a
+    single query for all of them that also loads the members' details when
+    they are rendered.
+    """
+    fieldset = fieldset or Fieldset()
+    fieldset.check(GroupSerializer.Meta.fields, USER_FIELDS)
+    groups = list(groups)
+    versions = {group.pk: group.version for group in groups}
+    fragments = group_fragments.get_many(versions)
+
+    stale = [group for group in groups if group.pk not in fragments]
+    fresh_ids = {group.pk for group in stale}
+    loaded = {}
+    if stale:
+        member_ids = {group.pk: [] for group in stale}
+        memberships = Group.members.through.objects.filter(group_id__in=member_ids).order_by('id')
+        if fieldset.expands('members'):
+            memberships = memberships.select_related('user').only(
+                'group', *(f'user__{name}' for name in UserSerializer.Meta.fields))
+            for membership in memberships:
+                member_ids[membership.group_id].append(membership.user_id)
+                loaded[membership.user_id] = membership.user
+        else:
+            for group_id, user_id in memberships.values_list('group_id', 'user_id'):
+                member_ids[group_id].append(user_id)
+        fields = GroupSerializer().fields
+        fresh = {group.pk: _group_fragment(group, member_ids[group.pk], fields) for group in stale}
+        transaction.on_commit(lambda: group_fragments.set_many(fresh, versions))
+        fragments.update(fresh)
+
+    user_ids, refresh = set(), set()
+    for group_id, fragment in fragments.items():
+        ids = set()
+        if fieldset.expands('created_by'):
+            ids.add(fragment['created_by'])
+        if fieldset.expands('members'):
+            ids.update(fragment['members'])
+        user_ids |= ids
+        if group_id in fresh_ids:
+            # The group changed, possibly through one of its users in another process
+            refresh |= ids
+    users = render_users(user_ids, loaded, refresh) if user_ids else {}
+    names = [name for name in GroupSerializer.Meta.fields if fieldset.includes(name)]
+    data = []
+    for group in groups:
+        # A new dict, so that the cached fragment keeps its ids; the field order is the serializer's
+        fragment = fragments[group.pk]
+        item = {name: fragment[name] for name in names}
+        if fieldset.expands('created_by'):
+            item['created_by'] = users.get(item['created_by'])
+        if fieldset.expands('members'):
+            item['members'] = [users[user_id] for user_id in item['members'] if user_id in users]
+        elif 'members' in item:
+            item['members'] = list(item['members'])
+        data.append(item)
+    return data
+
+
+def render_group(group, fieldset=None):
+    return render_groups([group], fieldset)[0]
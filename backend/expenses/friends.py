@@ -0,0 +1,62 @@
+"""
+Friend graph queries.
+
+Everything here is a single SQL statement over Friend and the group
+membership table. Friend rows exist in both directions, so the unique
+(user, friend) index answers "who are X's friends" and the (friend, user)
+index answers "whose friend is X".
+"""
+from django.contrib.auth.models import User
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import Friend, FriendRequest, Group
+
+DEFAULT_SUGGESTIONS = 20
+MAX_SUGGESTIONS = 100
+
+
+def friends_of(user):
+    return User.objects.filter(friend_of__user=user)
+
+
+def mutual_friends(user, other):
+    """Users who are friends with both ``user`` and ``other``."""
+    return User.objects.filter(
+        pk__in=Friend.objects.filter(user=user).values('friend_id'),
+    ).filter(
+        pk__in=Friend.objects.filter(user=other).values('friend_id'),
+    )
+
+
+def _count(queryset, key):
+    # Correlated COUNT(*) that comes back as 0 instead of NULL when nothing matches
+    counted = queryset.order_by().values(key).annotate(count=Count('*')).values('count')
+    return Coalesce(Subquery(counted, output_field=IntegerField()), Value(0))
+
+
+def suggestions(user, limit=DEFAULT_SUGGESTIONS):
+    """
+    Friends of friends and group co-members who are not friends with ``user`` yet.
+
+    Candidates are annotated with ``mutual_friends`` and ``shared_groups`` and
+    ranked by both, most connected first. Users with a pending request in
+    either direction are left out.
+    """
+    friend_ids = Friend.objects.filter(user=user).values('friend_id')
+    memberships = Group.members.through.objects
+    group_ids = memberships.filter(user=user).values('group_id')
+    pending = FriendRequest.objects.filter(Q(from_user=user) | Q(to_user=user), accepted=False)
+
+    return (User.objects
+            .filter(Q(pk__in=Friend.objects.filter(user__in=friend_ids).values('friend_id'))
+                    | Q(pk__in=memberships.filter(group__in=group_ids).values('user_id')))
+            .exclude(pk=user.pk)
+            .exclude(pk__in=friend_ids)
+            .exclude(pk__in=pending.values('from_user_id'))
+            .exclude(pk__in=pending.values('to_user_id'))
+            .annotate(mutual_friends=_count(Friend.objects.filter(friend=OuterRef('pk'), user__in=friend_ids),
+                                            'friend_id'),
+                      shared_groups=_count(memberships.filter(user=OuterRef('pk'), group__in=group_ids),
+                                           'user_id'))
+            .order_by('-mutual_friends', '-shared_groups', 'username')[:limit])
@@ -0,0 +1,161 @@
+"""
+Idempotency-Key support for mutating endpoints.
+
+The first request carrying a key claims it by inserting an IdempotencyKey row
+before the view runs, and stores the response once it is done. A retry with
+the same key gets the stored response back without the view running again; a
+retry that arrives while the first request is still in flight gets a 409.
+
+Keys are per user, so anonymous endpoints (login, register) ignore the header.
+Server errors are not stored: the key is released and the client may retry.
+"""
+import hashlib
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+DEFAULT_TTL = 24 * 60 * 60
+# A claim older than this is assumed to belong to a request that died mid-way
+LOCK_TIMEOUT = timedelta(minutes=1)
+
+
+def ttl():
+    return timedelta(seconds=getattr(settings, 'IDEMPOTENCY_KEY_TTL', DEFAULT_TTL))
+
+
+def fingerprint(request):
+    digest = hashlib.sha256(f'{request.method} {request.get_full_path()}\n'.encode())
+    # Multipart uploads are streamed to the view, so only their target is compared
+    if not request.content_type.startswith('multipart/'):
+        digest.update(request._request.body)
+    return digest.hexdigest()
+
+
+def error(message, status_code):
+    return Response({'error': message}, status=status_code)
+
+
+def claim(request):
+    """
+    Claim the request's Idempotency-Key.
+
+    Returns None when the request has no key to honour, the claimed
+    IdempotencyKey when the view should run, or the Response to send instead.
+    """
+    key = request.headers.get(HEADER)
+    if not key or request.method in SAFE_METHODS or not request.user.is_authenticated:
+        return None
+    if len(key) > MAX_KEY_LENGTH:
+        return error(f'{HEADER} must be at most {MAX_KEY_LENGTH} characters', status.HTTP_400_BAD_REQUEST)
+
+    digest = fingerprint(request)
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(user=request.user, key=key, fingerprint=digest, created_at=now)
+    except IntegrityError:
+        pass
+
+    in_progress = error(f'A request with this {HEADER} is already in progress', status.HTTP_409_CONFLICT)
+    record = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+    if record is None:
+        # Purged between the insert and this read
+        return in_progress
+    if record.created_at < now - ttl() or (record.status_code is None and record.created_at < now - LOCK_TIMEOUT):
+        # Expired or abandoned: start over, unless another retry took it over first
+        taken = (IdempotencyKey.objects.filter(pk=record.pk, created_at=record.created_at)
+                 .update(fingerprint=digest, status_code=None, response=None, created_at=now))
+        if not taken:
+            return in_progress
+        record.fingerprint, record.status_code, record.response, record.created_at = digest, None, None, now
+        return record
+
+    if record.fingerprint != digest:
+        return error(f'This {HEADER} was already used for a different request',
+                     status.HTTP_422_UNPROCESSABLE_ENTITY)
+    if record.status_code is None:
+        return in_progress
+    return Response(record.response, status=record.status_code, headers={'Idempotent-Replayed': 'true'})
+
+
+def release(record):
+    IdempotencyKey.objects.filter(pk=record.pk, status_code__isnull=True).delete()
+
+
+def store(record, response):
+    """Keep ``response`` for replays; server errors and streamed bodies release the key instead."""
+    if response.status_code >= 500 or not hasattr(response, 'data'):
+        release(record)
+        return
+    IdempotencyKey.objects.filter(pk=record.pk).update(status_code=response.status_code, response=response.data)
+
+
+def purge(now=None):
+    """Delete keys past their TTL. Returns the number of keys removed."""
+    cutoff = (now or timezone.now()) - ttl()
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=cutoff).delete()
+    return deleted
+
+
+class _Replay(Exception):
+    def __init__(self, response):
+        self.response = response
+
+
+class IdempotentViewSetMixin:
+    """Honour Idempotency-Key on every unsafe method of a viewset, after authentication."""
+
+    def initial(self, request, *args, **kwargs):
+        self._idempotency_key = None
+        super().initial(request, *args, **kwargs)
+        result = claim(request)
+        if isinstance(result, Response):
+            raise _Replay(result)
+        self._idempotency_key = result
+
+    def handle_exception(self, exc):
+        if isinstance(exc, _Replay):
+            return exc.response
+        try:
+            return super().handle_exception(exc)
+        except Exception:
+            if getattr(self, '_idempotency_key', None) is not None:
+                release(self._idempotency_key)
+                self._idempotency_key = None
+            raise
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, '_idempotency_key', None) is not None:
+            store(self._idempotency_key, response)
+            self._idempotency_key = None
+        return response
+
+
+def idempotent(view):
+    """The same as IdempotentViewSetMixin, for @api_view functions (apply below @api_view)."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        result = claim(request)
+        if isinstance(result, Response):
+            return result
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            if result is not None:
+                release(result)
+            raise
+        if result is not None:
+            store(result, response)
+        return response
+    return wrapper
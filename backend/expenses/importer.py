@@ -0,0 +1,152 @@
+"""
+Streaming import of historical expenses from CSV or NDJSON.
+
+Rows are parsed one at a time, validated with ExpenseImportSerializer and
+written in chunks, each chunk in its own transaction, so memory use does not
+depend on the size of the file. A bad row is reported and skipped; it never
+aborts the rest of the import.
+
+Recognised columns: title, amount, description, icon, date, paid_by
+(username, defaults to the importing user) and participants (usernames
+separated by ';', defaults to every group member). Payers and participants
+must be members of the group.
+"""
+import csv
+import io
+import json
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import DatabaseError, transaction
+
+from . import events, ledger, rollups
+from .models import Expense, ExpenseShare
+from .serializers import ExpenseImportSerializer
+from .splits import equal_shares
+
+FORMATS = ('csv', 'ndjson')
+DEFAULT_CHUNK_SIZE = 500
+# Only the first errors are kept in the report; the rest are just counted
+MAX_REPORTED_ERRORS = 1000
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, row_number, errors):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row_number, 'errors': errors})
+
+    def as_dict(self):
+        return {
+            'imported': self.imported,
+            'failed': self.failed,
+            'errors': self.errors,
+            'errors_truncated': self.failed > len(self.errors),
+        }
+
+
+def detect_format(filename, default='csv'):
+    suffix = filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else ''
+    if suffix in ('ndjson', 'jsonl'):
+        return 'ndjson'
+    if suffix == 'csv':
+        return 'csv'
+    return default
+
+
+def read_rows(stream, file_format):
+    """
+    Yield ``(row number, row)`` pairs from a binary stream, one row at a time.
+
+    ``row`` is a dict, or a string describing why the line could not be parsed.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        for number, row in enumerate(csv.DictReader(text), start=1):
+            # Empty cells fall back to the serializer defaults; extra cells are dropped
+            yield number, {key: value for key, value in row.items() if key and value not in ('', None)}
+    elif file_format == 'ndjson':
+        for number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as exc:
+                yield number, f'Invalid JSON: {exc}'
+                continue
+            yield number, row if isinstance(row, dict) else 'Each line must be a JSON object'
+    else:
+        raise ValueError(f"Unsupported format '{file_format}', expected one of {', '.join(FORMATS)}")
+
+
+def import_expenses(group, rows, paid_by, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Validate ``rows`` from read_rows() and write them to ``group`` in batched transactions."""
+    members = dict(group.members.values_list('username', 'id'))
+    default_payer_is_member = paid_by.id in members.values()
+    report = ImportReport()
+    pending = []
+
+    for number, row in rows:
+        if not isinstance(row, dict):
+            report.add_error(number, {'non_field_errors': [row]})
+            continue
+        serializer = ExpenseImportSerializer(data=row, context={'members': members})
+        if not serializer.is_valid():
+            report.add_error(number, serializer.errors)
+            continue
+
+        data = serializer.validated_data
+        if 'paid_by' not in data and not default_payer_is_member:
+            report.add_error(number, {'paid_by': [f"'{paid_by.username}' is not a member of this group"]})
+            continue
+        expense = Expense(group=group, title=data['title'], amount=data['amount'],
+                          description=data.get('description', ''), paid_by_id=data.get('paid_by', paid_by.id))
+        if 'icon' in data:
+            expense.icon = data['icon']
+        if 'date' in data:
+            expense.date = data['date']
+        participant_ids = data.get('participants') or list(members.values())
+        if not participant_ids:
+            report.add_error(number, {'participants': ['The expense needs at least one participant, '
+                                                       'and the group has no members']})
+            continue
+        pending.append((number, expense, participant_ids))
+
+        if len(pending) >= chunk_size:
+            _write_chunk(group, pending, report)
+            pending = []
+
+    if pending:
+        _write_chunk(group, pending, report)
+    return report
+
+
+def _write_chunk(group, pending, report):
+    try:
+        with transaction.atomic():
+            expenses = Expense.objects.bulk_create([expense for _, expense, _ in pending])
+            shares = []
+            for (_, _, participant_ids), expense in zip(pending, expenses):
+                shares.extend(equal_shares(expense, participant_ids))
+            ExpenseShare.objects.bulk_create(shares, batch_size=2000)
+
+            # bulk_create bypasses the ledger and rollup signals, so book the chunk here
+            deltas = defaultdict(Decimal)
+            for expense in expenses:
+                deltas[expense.paid_by_id] += expense.amount
+            for share in shares:
+                deltas[share.user_id] -= share.amount_owed
+            ledger.apply_deltas(group.id, deltas, sum(expense.amount for expense in expenses))
+            rollups.book_expenses(expenses, shares)
+            events.publish(group.id, events.EXPENSES_ADDED,
+                           {'count': len(expenses), 'amount': str(sum(expense.amount for expense in expenses))})
+    except DatabaseError as exc:
+        for number, _, _ in pending:
+            report.add_error(number, {'non_field_errors': [f'Could not be saved: {exc}']})
+        return
+    report.imported += len(pending)
@@ -0,0 +1,171 @@
+"""
+Incrementally maintained per-group balance ledger.
+
+Every write to Expense/ExpenseShare is turned into a set of signed deltas
+(user id -> amount) that are added to the matching GroupBalance rows, so that
+reading a group's balances never has to aggregate the expense tables.
+
+An expense without a payer, left behind when the payer's account is deleted,
+is out of the ledger: nobody is owed for it, so its shares are not debited
+either, and every group's balances keep adding up to zero.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from . import events
+from .models import (ArchivedExpense, ArchivedExpenseShare, BalanceSnapshot, BalanceSnapshotEntry, Expense,
+                     ExpenseShare, Group, GroupBalance, Settlement)
+
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+
+def to_cents(value):
+    """Round a value the same way DecimalField(decimal_places=2) stores it."""
+    return Decimal(value).quantize(CENT)
+
+
+def apply_deltas(group_id, deltas, total_delta=ZERO):
+    """
+    Add ``deltas`` (user id -> amount) to the group's ledger and ``total_delta`` to its total.
+
+    Also bumps the group's version, so callers never need to do it separately.
+    """
+    deltas = {user_id: to_cents(amount) for user_id, amount in deltas.items() if user_id is not None}
+    deltas = {user_id: amount for user_id, amount in deltas.items() if amount}
+    total_delta = to_cents(total_delta)
+
+    with transaction.atomic():
+        # Every ledger write is a change to the group, so its version moves with it
+        Group.objects.filter(pk=group_id).update(total_expenses=F('total_expenses') + total_delta,
+                                                 version=F('version') + 1)
+        if not deltas:
+            return
+
+        existing = GroupBalance.objects.select_for_update().filter(group_id=group_id, user_id__in=deltas)
+        updated = []
+        for entry in existing:
+            entry.balance += deltas.pop(entry.user_id)
+            updated.append(entry)
+        if updated:
+            GroupBalance.objects.bulk_update(updated, ['balance'])
+        if deltas:
+            GroupBalance.objects.bulk_create([
+                GroupBalance(group_id=group_id, user_id=user_id, balance=amount)
+                for user_id, amount in deltas.items()
+            ])
+        balances = {entry.user_id: entry.balance for entry in updated}
+        balances.update(deltas)
+        _publish_balances(group_id, balances)
+
+
+def expense_deltas(paid_by_id, amount, shares, sign=1):
+    """Build the ledger deltas for one expense: the payer is credited, each share is debited."""
+    deltas = defaultdict(Decimal)
+    if paid_by_id is None:
+        return deltas
+    deltas[paid_by_id] += sign * to_cents(amount)
+    for user_id, amount_owed in shares:
+        deltas[user_id] -= sign * to_cents(amount_owed)
+    return deltas
+
+
+def share_deltas(shares, sign=1):
+    """Build the ledger deltas for the shares of an expense that has a payer: each share is debited."""
+    deltas = defaultdict(Decimal)
+    for user_id, amount_owed in shares:
+        deltas[user_id] -= sign * to_cents(amount_owed)
+    return deltas
+
+
+def settlement_deltas(settlements, sign=1):
+    """Build the ledger deltas for settlement payments: the payer is credited, the receiver debited."""
+    deltas = defaultdict(Decimal)
+    for settlement in settlements:
+        deltas[settlement.from_user_id] += sign * to_cents(settlement.amount)
+        deltas[settlement.to_user_id] -= sign * to_cents(settlement.amount)
+    return deltas
+
+
+def ensure_members(group_id, user_ids):
+    """Create zero ledger rows so every member shows up in the balance listing."""
+    GroupBalance.objects.bulk_create(
+        [GroupBalance(group_id=group_id, user_id=user_id) for user_id in user_ids],
+        ignore_conflicts=True,
+    )
+
+
+def rebuild_group(group):
+    """
+    Recompute a group's ledger and total from its balance snapshot and the live expense tables.
+
+    Expenses moved to the archive (see expenses.archive) are only read back
+    through the snapshot, so the work grows with the recent history alone.
+    """
+    with transaction.atomic():
+        # Keeps a compaction of the group from moving expenses between the reads below
+        list(Group.objects.select_for_update().filter(pk=group.pk).values_list('pk', flat=True))
+        deltas = defaultdict(Decimal)
+        total = ZERO
+        snapshot = BalanceSnapshot.objects.filter(group=group).first()
+        if snapshot is not None:
+            for user_id, balance in snapshot.entries.values_list('user_id', 'balance'):
+                deltas[user_id] += balance
+            total += snapshot.total_expenses
+        paid = (Expense.objects.filter(group=group, paid_by__isnull=False)
+                .values('paid_by_id').annotate(total=Sum('amount')))
+        for row in paid:
+            deltas[row['paid_by_id']] += row['total']
+        owed = (ExpenseShare.objects.filter(expense__group=group, expense__paid_by__isnull=False)
+                .values('user_id').annotate(total=Sum('amount_owed')))
+        for row in owed:
+            deltas[row['user_id']] -= row['total']
+        settlements = Settlement.objects.filter(group=group)
+        for row in settlements.values('from_user_id').annotate(total=Sum('amount')):
+            deltas[row['from_user_id']] += row['total']
+        for row in settlements.values('to_user_id').annotate(total=Sum('amount')):
+            deltas[row['to_user_id']] -= row['total']
+        total += Expense.objects.filter(group=group).aggregate(total=Sum('amount'))['total'] or ZERO
+
+        member_ids = set(group.members.values_list('id', flat=True))
+        GroupBalance.objects.filter(group=group).delete()
+        GroupBalance.objects.bulk_create([
+            GroupBalance(group=group, user_id=user_id, balance=to_cents(deltas.get(user_id, ZERO)))
+            for user_id in member_ids | set(deltas)
+        ])
+        Group.objects.filter(pk=group.pk).update(total_expenses=to_cents(total), version=F('version') + 1)
+        _publish_balances(group.pk, {user_id: deltas.get(user_id, ZERO) for user_id in member_ids | set(deltas)})
+
+
+def rebuild_snapshot(group):
+    """Recompute the entries and totals of the group's BalanceSnapshot, if it has one, from the archive."""
+    snapshot = BalanceSnapshot.objects.filter(group=group).first()
+    if snapshot is None:
+        return
+    deltas = defaultdict(Decimal)
+    expenses = ArchivedExpense.objects.filter(group=group)
+    for row in expenses.filter(paid_by__isnull=False).values('paid_by_id').annotate(total=Sum('amount')):
+        deltas[row['paid_by_id']] += row['total']
+    owed = (ArchivedExpenseShare.objects.filter(expense__group=group, expense__paid_by__isnull=False)
+            .values('user_id').annotate(total=Sum('amount_owed')))
+    for row in owed:
+        deltas[row['user_id']] -= row['total']
+    totals = expenses.aggregate(total=Sum('amount'), count=Count('id'))
+
+    with transaction.atomic():
+        snapshot.entries.all().delete()
+        BalanceSnapshotEntry.objects.bulk_create([
+            BalanceSnapshotEntry(snapshot=snapshot, user_id=user_id, balance=to_cents(balance))
+            for user_id, balance in deltas.items() if balance
+        ])
+        snapshot.total_expenses = to_cents(totals['total'] or ZERO)
+        snapshot.expense_count = totals['count']
+        snapshot.save(update_fields=['total_expenses', 'expense_count', 'updated_at'])
+
+
+def _publish_balances(group_id, balances):
+    events.publish(group_id, events.BALANCES_CHANGED,
+                   {'balances': {str(user_id): str(to_cents(balance)) for user_id, balance in balances.items()}})
@@ -0,0 +1,63 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from expenses import archive, rollups
+from expenses.models import Group
+
+
+def _month_start(month):
+    return timezone.make_aware(datetime.combine(month, time.min))
+
+
+class Command(BaseCommand):
+    help = ('Move old expenses to the archive tables behind a per-group balance snapshot. '
+            'Works in chunks that each commit on their own, so an interrupted run can simply be started again')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, default=12,
+                            help='Keep the expenses of this many months before the current one live (default 12)')
+        parser.add_argument('--before', help='Archive the expenses dated before this month (YYYY-MM) instead')
+        parser.add_argument('--group', type=int, action='append', dest='groups',
+                            help='Only compact the given group id (can be repeated)')
+        parser.add_argument('--chunk-size', type=int, default=archive.CHUNK_SIZE,
+                            help=f'Expenses archived per transaction (default {archive.CHUNK_SIZE})')
+        parser.add_argument('--max-chunks', type=int,
+                            help='Stop each group after this many chunks; run again to resume')
+
+    def handle(self, *args, keep_months=12, before=None, groups=None, chunk_size=archive.CHUNK_SIZE,
+               max_chunks=None, **options):
+        if chunk_size < 1 or (max_chunks is not None and max_chunks < 1):
+            raise CommandError('--chunk-size and --max-chunks must be positive')
+        if before is not None:
+            try:
+                cutoff = _month_start(rollups.parse_month(before))
+            except ValueError as error:
+                raise CommandError(str(error))
+        else:
+            if keep_months < 0:
+                raise CommandError('--keep-months cannot be negative')
+            month = rollups.month_of(timezone.now())
+            months = month.year * 12 + month.month - 1 - keep_months
+            cutoff = _month_start(month.replace(year=months // 12, month=months % 12 + 1))
+
+        queryset = Group.objects.order_by('pk')
+        if groups:
+            queryset = queryset.filter(pk__in=groups)
+            missing = set(groups) - set(queryset.values_list('pk', flat=True))
+            if missing:
+                raise CommandError(f"Group(s) not found: {', '.join(map(str, sorted(missing)))}")
+
+        total, unfinished = 0, 0
+        for group in queryset.iterator():
+            archived, done = archive.compact(group, cutoff, chunk_size, max_chunks)
+            total += archived
+            if not done:
+                unfinished += 1
+            if archived or not done:
+                self.stdout.write(f"Group {group.pk}: archived {archived} expense(s)"
+                                  f"{'' if done else ', more left'}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {total} expense(s) dated before {cutoff.date().isoformat()}"
+            + (f'; {unfinished} group(s) have more left, run again to continue' if unfinished else '')))
@@ -0,0 +1,53 @@
+import json
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses import importer
+from expenses.models import Group
+
+
+class Command(BaseCommand):
+    help = 'Stream historical expenses from a CSV or NDJSON file into a group'
+
+    def add_arguments(self, parser):
+        parser.add_argument('group_id', type=int)
+        parser.add_argument('path', help="File to import, or '-' for stdin")
+        parser.add_argument('--format', choices=importer.FORMATS,
+                            help='Input format (default: guessed from the file extension, else csv)')
+        parser.add_argument('--paid-by', required=True,
+                            help='Username recorded as payer for rows without a paid_by column')
+        parser.add_argument('--chunk-size', type=int, default=importer.DEFAULT_CHUNK_SIZE,
+                            help='Rows written per transaction')
+
+    def handle(self, *args, group_id, path, format=None, paid_by, chunk_size, **options):
+        try:
+            group = Group.objects.get(pk=group_id)
+        except Group.DoesNotExist:
+            raise CommandError(f'Group {group_id} not found')
+        try:
+            payer = User.objects.get(username=paid_by)
+        except User.DoesNotExist:
+            raise CommandError(f"User '{paid_by}' not found")
+        if not group.members.filter(pk=payer.pk).exists():
+            raise CommandError(f"User '{paid_by}' is not a member of group {group_id}")
+        file_format = format or importer.detect_format(path)
+
+        if path == '-':
+            report = importer.import_expenses(group, importer.read_rows(sys.stdin.buffer, file_format),
+                                              paid_by=payer, chunk_size=chunk_size)
+        else:
+            try:
+                stream = open(path, 'rb')
+            except OSError as exc:
+                raise CommandError(str(exc))
+            with stream:
+                report = importer.import_expenses(group, importer.read_rows(stream, file_format),
+                                                  paid_by=payer, chunk_size=chunk_size)
+
+        for error in report.errors:
+            self.stderr.write(f"row {error['row']}: {json.dumps(error['errors'])}")
+        if report.failed > len(report.errors):
+            self.stderr.write(f'... and {report.failed - len(report.errors)} more failed row(s)')
+        self.stdout.write(self.style.SUCCESS(f'Imported {report.imported} expense(s), {report.failed} failed'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from expenses import idempotency
+
+
+class Command(BaseCommand):
+    help = 'Delete stored Idempotency-Key responses older than settings.IDEMPOTENCY_KEY_TTL'
+
+    def handle(self, *args, **options):
+        deleted = idempotency.purge()
+        self.stdout.write(self.style.SUCCESS(f'Purged {deleted} idempotency key(s)'))
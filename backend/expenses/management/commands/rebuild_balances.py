@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses import ledger
+from expenses.models import Group
+
+
+class Command(BaseCommand):
+    help = 'Recompute the per-group balance ledger and group totals from the expense tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, action='append', dest='groups',
+                            help='Only rebuild the given group id (can be repeated)')
+
+    def handle(self, *args, groups=None, **options):
+        queryset = Group.objects.order_by('pk')
+        if groups:
+            queryset = queryset.filter(pk__in=groups)
+            missing = set(groups) - set(queryset.values_list('pk', flat=True))
+            if missing:
+                raise CommandError(f"Group(s) not found: {', '.join(map(str, sorted(missing)))}")
+
+        count = 0
+        for group in queryset.iterator():
+            ledger.rebuild_group(group)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt balances for {count} group(s)'))
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from expenses import notifications
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued notifications, coalescing them into one message per user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Notifications claimed per round')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='Seconds to sleep when the outbox is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the notifications that are due now and exit')
+
+    def handle(self, *args, batch_size, interval, once, **options):
+        transports = notifications.load_transports()
+        while True:
+            batch = notifications.claim_batch(batch_size)
+            if batch:
+                sent, failed = notifications.deliver(batch, transports)
+                self.stdout.write(f'Delivered to {sent} user(s), {failed} will be retried')
+                continue
+            if once:
+                break
+            time.sleep(interval)
@@ -0,0 +1,133 @@
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from expenses import ledger, rollups
+from expenses.models import Expense, ExpenseShare, Friend, Group
+
+SHARE_INSERT = 'INSERT INTO {} ({}, {}, {}) VALUES (%s, %s, %s)'.format(
+    ExpenseShare._meta.db_table,
+    *(ExpenseShare._meta.get_field(name).column for name in ('expense', 'user', 'amount_owed')))
+CATEGORIES = ('default-icon', 'food', 'groceries', 'transport', 'rent', 'utilities', 'travel', 'fun')
+
+
+def group_sizes(rng, count, largest):
+    """Pareto distributed: mostly small groups, with a long tail of big ones."""
+    return [min(largest, max(2, int(rng.paretovariate(1.2) * 2))) for _ in range(count)]
+
+
+def split_cents(cents, parts):
+    base, remainder = divmod(cents, parts)
+    return [base + 1 if index < remainder else base for index in range(parts)]
+
+
+class Command(BaseCommand):
+    help = ('Generate synthetic users, groups of skewed sizes, friendships and expenses for load testing '
+            '(see benchmarks/load_test.py)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--groups', type=int, default=300)
+        parser.add_argument('--expenses', type=int, default=100000, help='Total expenses across all groups')
+        parser.add_argument('--friends', type=int, default=10, help='Average friends per user')
+        parser.add_argument('--max-group-size', type=int, default=200)
+        parser.add_argument('--months', type=int, default=24, help='Spread expense dates over this many months')
+        parser.add_argument('--prefix', default='load', help='Username prefix; must not be in use yet')
+        parser.add_argument('--password', default='load-test', help='Password given to every generated user')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--batch-size', type=int, default=5000, help='Expenses written per transaction')
+
+    def handle(self, *args, **options):
+        if min(options['users'], options['groups']) < 2 or options['expenses'] < 0:
+            raise CommandError('Need at least 2 users and 2 groups')
+        prefix = options['prefix']
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(f"Users named '{prefix}*' already exist; pick another --prefix")
+        rng = random.Random(options['seed'])
+
+        users = self.create_users(prefix, options['users'], options['password'])
+        groups = self.create_groups(rng, users, options['groups'], min(options['max_group_size'], len(users)))
+        friendships = self.create_friends(rng, users, options['friends'])
+        expenses, shares = self.create_expenses(rng, groups, options['expenses'], options['months'],
+                                                options['batch_size'])
+
+        self.stdout.write('Rebuilding balances and spending rollups...')
+        for group, _ in groups:
+            ledger.rebuild_group(group)
+            rollups.rebuild_group(group)
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {len(users)} users ({prefix}0..{prefix}{len(users) - 1}), {len(groups)} groups, '
+            f'{friendships} friendships, {expenses} expenses and {shares} shares'))
+
+    def create_users(self, prefix, count, password):
+        # Hashing is deliberately slow, so every user shares one hash
+        hashed = make_password(password)
+        User.objects.bulk_create([User(username=f'{prefix}{index}', password=hashed) for index in range(count)],
+                                 batch_size=5000)
+        return list(User.objects.filter(username__startswith=prefix).order_by('id').values_list('id', flat=True))
+
+    def create_groups(self, rng, users, count, largest):
+        sizes = group_sizes(rng, count, largest)
+        with transaction.atomic():
+            created = Group.objects.bulk_create([
+                Group(name=f'Load group {index}', created_by_id=rng.choice(users)) for index in range(count)
+            ])
+            groups, memberships = [], []
+            for group, size in zip(created, sizes):
+                others = [user_id for user_id in rng.sample(users, size) if user_id != group.created_by_id]
+                members = {group.created_by_id, *others[:size - 1]}
+                groups.append((group, sorted(members)))
+                memberships += [Group.members.through(group_id=group.id, user_id=user_id) for user_id in members]
+            Group.members.through.objects.bulk_create(memberships, batch_size=5000)
+        return groups
+
+    def create_friends(self, rng, users, average):
+        # Friendships are stored in both directions, like an accepted friend request
+        pairs = set()
+        target = len(users) * average // 2
+        while len(pairs) < min(target, len(users) * (len(users) - 1) // 2):
+            a, b = rng.sample(users, 2)
+            pairs.add((min(a, b), max(a, b)))
+        Friend.objects.bulk_create([Friend(user_id=a, friend_id=b) for pair in pairs for a, b in (pair, pair[::-1])],
+                                   batch_size=5000)
+        return len(pairs)
+
+    def create_expenses(self, rng, groups, count, months, batch_size):
+        # Bigger groups spend more often
+        weights = [len(members) for _, members in groups]
+        now = timezone.now()
+        span = int(timedelta(days=30 * months).total_seconds())
+        expenses = shares = 0
+        while expenses < count:
+            batch = []
+            for group, members in rng.choices(groups, weights=weights, k=min(batch_size, count - expenses)):
+                participants = rng.sample(members, min(len(members), rng.randint(2, 6)))
+                batch.append((Expense(
+                    title=f'Expense {expenses + len(batch)}',
+                    icon=rng.choice(CATEGORIES),
+                    amount=Decimal(rng.randint(100, 50000)).scaleb(-2),
+                    group=group,
+                    paid_by_id=rng.choice(participants),
+                    date=now - timedelta(seconds=rng.randrange(span)),
+                ), participants))
+            with transaction.atomic():
+                created = Expense.objects.bulk_create([expense for expense, _ in batch])
+                rows = [
+                    (expense.id, user_id, connection.ops.adapt_decimalfield_value(Decimal(cents).scaleb(-2)))
+                    for expense, (_, participants) in zip(created, batch)
+                    for user_id, cents in zip(participants,
+                                              split_cents(int(expense.amount * 100), len(participants)))
+                ]
+                # Shares outnumber everything else; skipping model instances more than halves the time
+                with connection.cursor() as cursor:
+                    cursor.executemany(SHARE_INSERT, rows)
+            expenses += len(batch)
+            shares += len(rows)
+            self.stdout.write(f'{expenses}/{count} expenses')
+        return expenses, shares
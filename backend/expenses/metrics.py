@@ -0,0 +1,196 @@
+"""
+Per-view request metrics, exported in the Prometheus text format at /api/metrics/.
+
+ProfilingMiddleware (expenses.middleware) times every request and, through a
+database execute wrapper installed on each new connection, counts its queries
+and their time. Numbers are kept per process: with several workers, scrape
+each of them or aggregate in Prometheus.
+
+Setting ``SLOW_REQUEST_MS`` logs requests slower than that to the
+``expenses.slow_requests`` logger, with the SQL of their slowest queries.
+"""
+import heapq
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from . import fragments
+from .authentication import token_cache
+
+slow_log = logging.getLogger('expenses.slow_requests')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Slowest queries kept per request for the slow-request log
+SLOW_QUERIES_LOGGED = 5
+
+
+class QueryCollector:
+    __slots__ = ('count', 'seconds', 'slowest', 'keep')
+
+    def __init__(self, keep=0):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = []
+        self.keep = keep
+
+    def record(self, sql, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if self.keep:
+            entry = (seconds, self.count, sql)
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, entry)
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+
+_collector = ContextVar('query_collector', default=None)
+
+
+def collect_queries(keep=0):
+    """Start counting this context's queries; returns (collector, token for stop_collecting())."""
+    collector = QueryCollector(keep)
+    return collector, _collector.set(collector)
+
+
+def stop_collecting(token):
+    _collector.reset(token)
+
+
+def _record_query(execute, sql, params, many, context):
+    collector = _collector.get()
+    if collector is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        collector.record(sql, time.perf_counter() - start)
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+class ViewStats:
+    __slots__ = ('buckets', 'count', 'seconds', 'queries', 'db_seconds', 'response_bytes')
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.response_bytes = 0
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+        self._statuses = {}
+
+    def observe(self, view, method, status, seconds, queries, db_seconds, response_bytes):
+        key = (view, method)
+        with self._lock:
+            stats = self._views.get(key)
+            if stats is None:
+                stats = self._views[key] = ViewStats()
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats.buckets[index] += 1
+                    break
+            stats.count += 1
+            stats.seconds += seconds
+            stats.queries += queries
+            stats.db_seconds += db_seconds
+            stats.response_bytes += response_bytes
+            status_key = (view, method, status)
+            self._statuses[status_key] = self._statuses.get(status_key, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+            self._statuses.clear()
+
+    def render(self):
+        with self._lock:
+            views = [(key, (list(stats.buckets), stats.count, stats.seconds, stats.queries, stats.db_seconds,
+                            stats.response_bytes))
+                     for key, stats in sorted(self._views.items())]
+            statuses = sorted(self._statuses.items())
+
+        lines = [
+            '# HELP dung_http_requests_total Requests served, by view, method and status.',
+            '# TYPE dung_http_requests_total counter',
+        ]
+        for (view, method, status), count in statuses:
+            lines.append(f'dung_http_requests_total{{{_labels(view, method)},status="{status}"}} {count}')
+
+        lines += [
+            '# HELP dung_http_request_duration_seconds Time to produce a response.',
+            '# TYPE dung_http_request_duration_seconds histogram',
+        ]
+        for (view, method), (buckets, count, seconds, *_) in views:
+            labels = _labels(view, method)
+            cumulative = 0
+            for bound, hits in zip(LATENCY_BUCKETS, buckets):
+                cumulative += hits
+                lines.append(f'dung_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'dung_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'dung_http_request_duration_seconds_sum{{{labels}}} {seconds:.6f}')
+            lines.append(f'dung_http_request_duration_seconds_count{{{labels}}} {count}')
+
+        for name, index, help_text in (
+                ('dung_http_db_queries_total', 3, 'Database queries run while serving requests.'),
+                ('dung_http_db_duration_seconds_total', 4, 'Time spent in database queries.'),
+                ('dung_http_response_bytes_total', 5, 'Response body bytes (streamed bodies are not counted).')):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for (view, method), values in views:
+                value = values[index]
+                lines.append(f'{name}{{{_labels(view, method)}}} {value:.6f}' if isinstance(value, float)
+                             else f'{name}{{{_labels(view, method)}}} {value}')
+
+        cache_stats = token_cache.stats()
+        for name in ('hits', 'misses', 'evictions', 'invalidations'):
+            lines += [f'# TYPE dung_token_cache_{name}_total counter',
+                      f'dung_token_cache_{name}_total {cache_stats[name]}']
+        lines += ['# TYPE dung_token_cache_size gauge', f'dung_token_cache_size {cache_stats["size"]}']
+
+        fragment_stats = {'group': fragments.group_fragments.stats(), 'user': fragments.user_fragments.stats()}
+        for name in ('hits', 'misses', 'evictions', 'invalidations'):
+            lines.append(f'# TYPE dung_fragment_cache_{name}_total counter')
+            lines += [f'dung_fragment_cache_{name}_total{{kind="{kind}"}} {stats[name]}'
+                      for kind, stats in fragment_stats.items()]
+        lines.append('# TYPE dung_fragment_cache_size gauge')
+        lines += [f'dung_fragment_cache_size{{kind="{kind}"}} {stats["size"]}' for kind, stats in fragment_stats.items()]
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(view, method):
+    view = view.replace('\\', '\\\\').replace('"', '\\"')
+    return f'view="{view}",method="{method}"'
+
+
+registry = Registry()
+
+
+def slow_request_threshold():
+    """Seconds after which a request is logged as slow, or None when the log is off."""
+    threshold = getattr(settings, 'SLOW_REQUEST_MS', None)
+    return None if threshold is None else threshold / 1000
+
+
+def log_slow_request(request, view, status, seconds, collector):
+    queries = '\n'.join(f'  {query_seconds * 1000:.1f} ms: {sql}'
+                        for query_seconds, _, sql in sorted(collector.slowest, reverse=True))
+    slow_log.warning('Slow request %s %s (%s) -> %s in %.0f ms, %d queries in %.0f ms\n%s',
+                     request.method, request.path, view, status, seconds * 1000,
+                     collector.count, collector.seconds * 1000, queries)
@@ -0,0 +1,122 @@
+import hashlib
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.authentication import get_authorization_header
+from rest_framework.permissions import SAFE_METHODS
+
+from . import metrics, routers
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Lets safe requests read from replicas, except for clients that wrote recently.
+
+    Clients are told apart by their auth token or session cookie, without a
+    database query. The pin lives in the default cache, so it is only shared
+    between processes when that cache is.
+
+    Works under WSGI and ASGI alike, so async views are not pushed onto a
+    worker thread by it.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def client_key(self, request):
+        auth = get_authorization_header(request).split()
+        credential = auth[1] if len(auth) == 2 else request.COOKIES.get(settings.SESSION_COOKIE_NAME, '').encode()
+        if not credential:
+            return None
+        return 'replica-pin:' + hashlib.sha256(credential).hexdigest()
+
+    def use_replicas(self, request):
+        return request.method in SAFE_METHODS and bool(routers.replicas())
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        client = self.client_key(request)
+        token = routers.begin_request(self.use_replicas(request) and not (client and cache.get(client)))
+        try:
+            response = self.get_response(request)
+        finally:
+            state = routers.end_request(token)
+        if client and state.wrote:
+            cache.set(client, True, pin_seconds())
+        return response
+
+    async def __acall__(self, request):
+        client = self.client_key(request)
+        # The routing state is a ContextVar, which the view's sync_to_async ORM calls inherit
+        token = routers.begin_request(self.use_replicas(request) and not (client and await cache.aget(client)))
+        try:
+            response = await self.get_response(request)
+        finally:
+            state = routers.end_request(token)
+        if client and state.wrote:
+            await cache.aset(client, True, pin_seconds())
+        return response
+
+
+def pin_seconds():
+    return getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+
+
+class ProfilingMiddleware:
+    """
+    Records latency, query count, DB time and response size per view and method.
+
+    Views are labelled by URL name (``group-balances``), so the number of
+    series stays fixed whatever ids appear in the paths. Like
+    ReplicaRoutingMiddleware it runs under WSGI and ASGI alike.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        threshold, collector, token = self.start()
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.stop_collecting(token)
+        return self.record(request, response, time.perf_counter() - start, threshold, collector)
+
+    async def __acall__(self, request):
+        # Queries made through sync_to_async inherit the collector's ContextVar
+        threshold, collector, token = self.start()
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.stop_collecting(token)
+        return self.record(request, response, time.perf_counter() - start, threshold, collector)
+
+    def start(self):
+        threshold = metrics.slow_request_threshold()
+        collector, token = metrics.collect_queries(keep=metrics.SLOW_QUERIES_LOGGED if threshold is not None else 0)
+        return threshold, collector, token
+
+    def record(self, request, response, seconds, threshold, collector):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name or match._func_path) if match else 'unmatched'
+        size = 0 if response.streaming else len(response.content)
+        metrics.registry.observe(view, request.method, response.status_code, seconds,
+                                 collector.count, collector.seconds, size)
+        if threshold is not None and seconds >= threshold:
+            metrics.log_slow_request(request, view, response.status_code, seconds, collector)
+        return response
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_ledger(apps, schema_editor):
+    Group = apps.get_model('expenses', 'Group')
+    Expense = apps.get_model('expenses', 'Expense')
+    ExpenseShare = apps.get_model('expenses', 'ExpenseShare')
+    GroupBalance = apps.get_model('expenses', 'GroupBalance')
+
+    for group in Group.objects.all():
+        balances = {user_id: 0 for user_id in group.members.values_list('id', flat=True)}
+        owed = (ExpenseShare.objects.filter(expense__group=group)
+                .values('user_id').annotate(total=models.Sum('amount_owed')))
+        for row in owed:
+            balances[row['user_id']] = balances.get(row['user_id'], 0) - row['total']
+        GroupBalance.objects.bulk_create([
+            GroupBalance(group=group, user_id=user_id, balance=balance)
+            for user_id, balance in balances.items()
+        ])
+        total = Expense.objects.filter(group=group).aggregate(total=models.Sum('amount'))['total']
+        group.total_expenses = total or 0
+        group.save(update_fields=['total_expenses'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('expenses', '0005_remove_expense_paid_by'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expense',
+            name='paid_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='expenses_paid', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='total_expenses',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.CreateModel(
+            name='GroupBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_entries', to='expenses.group')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='group_balances', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('group', 'user')},
+            },
+        ),
+        migrations.RunPython(build_ledger, migrations.RunPython.noop),
+    ]
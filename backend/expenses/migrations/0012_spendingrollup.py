@@ -0,0 +1,58 @@
+# Generated by Django 4.2.7 on 2026-10-18 18:06
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models.functions import TruncMonth
+
+
+def build_rollups(apps, schema_editor):
+    Expense = apps.get_model('expenses', 'Expense')
+    ExpenseShare = apps.get_model('expenses', 'ExpenseShare')
+    SpendingRollup = apps.get_model('expenses', 'SpendingRollup')
+
+    rows = {}
+    paid = (Expense.objects.annotate(month=TruncMonth('date', output_field=models.DateField()))
+            .values('group_id', 'month', 'paid_by_id', 'icon')
+            .annotate(total=models.Sum('amount'), count=models.Count('id')))
+    for row in paid:
+        rows[(row['group_id'], row['month'], row['paid_by_id'], row['icon'])] = \
+            SpendingRollup(group_id=row['group_id'], month=row['month'], user_id=row['paid_by_id'],
+                           category=row['icon'], paid=row['total'], expense_count=row['count'])
+    owed = (ExpenseShare.objects.annotate(month=TruncMonth('expense__date', output_field=models.DateField()))
+            .values('expense__group_id', 'month', 'user_id', 'expense__icon')
+            .annotate(total=models.Sum('amount_owed')))
+    for row in owed:
+        key = (row['expense__group_id'], row['month'], row['user_id'], row['expense__icon'])
+        if key not in rows:
+            rows[key] = SpendingRollup(group_id=key[0], month=key[1], user_id=key[2], category=key[3])
+        rows[key].owed = row['total']
+    SpendingRollup.objects.bulk_create(rows.values(), batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('expenses', '0011_notification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpendingRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('category', models.CharField(max_length=50)),
+                ('paid', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('owed', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('expense_count', models.PositiveIntegerField(default=0)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='expenses.group')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='spending_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('group', 'month', 'user', 'category')},
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations
+
+SEARCHED = ('username', 'first_name', 'last_name')
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # Serve the UPPER(column) LIKE '%q%' lookups of expenses.search; other databases just scan
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for field in SEARCHED:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS auth_user_{field}_trgm_idx '
+            f'ON auth_user USING gin (UPPER({field}::text) gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for field in SEARCHED:
+        schema_editor.execute(f'DROP INDEX IF EXISTS auth_user_{field}_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('expenses', '0014_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-18 18:55
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('expenses', '0015_user_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='expenseshare',
+            index=models.Index(fields=['user', 'expense'], name='share_user_expense_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(condition=models.Q(('accepted', False)), fields=['to_user'], name='friendrequest_pending_to_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(condition=models.Q(('accepted', False)), fields=['from_user'], name='friendrequest_pending_from_idx'),
+        ),
+        # Dropped once the indexes that cover them (share_user_expense_idx, expense_group_date_id_idx) exist
+        migrations.AlterField(
+            model_name='expense',
+            name='group',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='expenses.group'),
+        ),
+        migrations.AlterField(
+            model_name='expenseshare',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.7 on 2026-10-18 19:20
+
+from django.db import migrations, models
+
+
+def merge_unassigned_buckets(apps, schema_editor):
+    # Payerless rows were never deduplicated, so fold any repeats into one before constraining them
+    SpendingRollup = apps.get_model('expenses', 'SpendingRollup')
+    kept = {}
+    for rollup in SpendingRollup.objects.filter(user__isnull=True).order_by('pk'):
+        key = (rollup.group_id, rollup.month, rollup.category)
+        if key not in kept:
+            kept[key] = rollup
+            continue
+        first = kept[key]
+        first.paid += rollup.paid
+        first.owed += rollup.owed
+        first.expense_count += rollup.expense_count
+        first.save(update_fields=['paid', 'owed', 'expense_count'])
+        rollup.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0018_notification_delivered_via'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='spendingrollup',
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='spendingrollup',
+            constraint=models.UniqueConstraint(fields=('group', 'month', 'user', 'category'), name='unique_rollup_bucket'),
+        ),
+        migrations.RunPython(merge_unassigned_buckets, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='spendingrollup',
+            constraint=models.UniqueConstraint(condition=models.Q(('user__isnull', True)), fields=('group', 'month', 'category'), name='unique_unassigned_rollup_bucket'),
+        ),
+    ]
@@ -1,4 +1,8 @@
+from decimal import Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 
 class Group(models.Model):
@@ -7,32 +11,118 @@ class Group(models.Model):
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_groups')
     members = models.ManyToManyField(User, related_name='expense_groups')
     created_at = models.DateTimeField(auto_now_add=True)
+    total_expenses = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    # Bumped on every change to the group, its members, expenses, shares or settlements
+    version = models.PositiveBigIntegerField(default=0)
+
+    # Maintained with atomic UPDATEs elsewhere; a regular save must not write back a stale copy
+    counter_fields = ('total_expenses', 'version')
 
     def __str__(self):
         return self.name
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.counter_fields]
+        super().save(*args, **kwargs)
+
+    def get_total_expenses(self):
+        return self.total_expenses
+
+    def get_member_balance(self, member):
+        balance = self.balance_entries.filter(user=member).values_list('balance', flat=True).first()
+        return balance if balance is not None else Decimal('0.00')
+
 class Expense(models.Model):
     title = models.CharField(max_length=200)
     icon = models.CharField(max_length=50, blank=True, default='default-icon')
     amount = models.DecimalField(max_digits=10, decimal_places=2)
-    group = models.ForeignKey(Group, on_delete=models.CASCADE)
+    # Indexed by expense_group_date_id_idx, which starts with the group
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, db_index=False)
+    paid_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='expenses_paid')
     participants = models.ManyToManyField(User, through='ExpenseShare')
-    date = models.DateTimeField(auto_now_add=True)
+    date = models.DateTimeField(default=timezone.now)
     description = models.TextField(blank=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination walks a group's expenses by (date, id), newest first
+            models.Index(fields=['group', '-date', '-id'], name='expense_group_date_id_idx'),
+        ]
+
     def __str__(self):
         return f"{self.title} - ${self.amount}"
 
 class ExpenseShare(models.Model):
     expense = models.ForeignKey(Expense, on_delete=models.CASCADE)
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Indexed by share_user_expense_idx, which starts with the user
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     amount_owed = models.DecimalField(max_digits=10, decimal_places=2)
 
+    class Meta:
+        indexes = [
+            # A user's shares, e.g. the expenses they take part in
+            models.Index(fields=['user', 'expense'], name='share_user_expense_idx'),
+        ]
+
+class GroupBalance(models.Model):
+    """Running net balance of a user in a group: what they paid minus what they owe."""
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='balance_entries')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='group_balances')
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('group', 'user')
+
+    def __str__(self):
+        return f"{self.user.username} in {self.group.name}: {self.balance}"
+
+class SpendingRollup(models.Model):
+    """
+    Monthly spending of one user in one group and expense category (Expense.icon).
+
+    ``paid`` sums the expenses the user paid for, ``owed`` their shares of the
+    group's expenses. ``user`` is empty for expenses without a payer.
+    """
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='rollups')
+    month = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='spending_rollups')
+    category = models.CharField(max_length=50)
+    paid = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    owed = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    expense_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['group', 'month', 'user', 'category'], name='unique_rollup_bucket'),
+            # NULLs never collide in the constraint above, so the payerless bucket needs its own
+            models.UniqueConstraint(fields=['group', 'month', 'category'], condition=models.Q(user__isnull=True),
+                                    name='unique_unassigned_rollup_bucket'),
+        ]
+
+    def __str__(self):
+        return f"{self.group.name} {self.month:%Y-%m} {self.category}: {self.paid}"
+
+class Settlement(models.Model):
+    """A payment from one member to another that settles part of their group balances."""
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='settlements')
+    from_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='settlements_paid')
+    to_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='settlements_received')
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.from_user.username} paid {self.to_user.username} ${self.amount}"
+
 class Friend(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='friends')
     friend = models.ForeignKey(User, on_delete=models.CASCADE, related_name='friend_of')
 
     class Meta:
+        # The unique (user, friend) index serves "friends of X"; this one serves "whose friend is X"
         unique_together = ('user', 'friend')
+        indexes = [models.Index(fields=['friend', 'user'], name='friend_friend_user_idx')]
 
     def __str__(self):
         return f"{self.user.username} - {self.friend.username}"
@@ -45,6 +135,12 @@ class FriendRequest(models.Model):
 
     class Meta:
         unique_together = ('from_user', 'to_user')
+        # Only pending requests are ever looked up; accepted ones stay out of these indexes
+        indexes = [
+            models.Index(fields=['to_user'], condition=models.Q(accepted=False), name='friendrequest_pending_to_idx'),
+            models.Index(fields=['from_user'], condition=models.Q(accepted=False),
+                         name='friendrequest_pending_from_idx'),
+        ]
 
     def __str__(self):
         return f"Friend request from {self.from_user.username} to {self.to_user.username}"
@@ -58,4 +154,128 @@ class Profile(models.Model):
     email_notification = models.BooleanField(default=False)
 
     def __str__(self):
-        return f"{self.user.username}'s Profile"
\ No newline at end of file
+        return f"{self.user.username}'s Profile"
+
+class Notification(models.Model):
+    """
+    Transactional outbox for user notifications.
+
+    Rows are written in the same transaction as the change they describe and
+    delivered later by ``manage.py run_notifier``; delivered rows are deleted.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [(STATUS_PENDING, 'Pending'), (STATUS_FAILED, 'Failed')]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    # Names of the transports that already sent it, which a retry skips
+    delivered_via = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['available_at'], condition=models.Q(status='pending'),
+                         name='notification_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} for {self.user.username} ({self.status})"
+
+
+class IdempotencyKey(models.Model):
+    """
+    A client supplied Idempotency-Key and the response it produced.
+
+    ``status_code`` stays empty while the first request is still running.
+    Keys are scoped to a user and purged after settings.IDEMPOTENCY_KEY_TTL.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    # sha256 of method, path and body, so a key cannot be reused for a different request
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        unique_together = ('user', 'key')
+
+    def __str__(self):
+        return f"{self.key} for {self.user.username} ({self.status_code or 'in progress'})"
+
+
+class ArchivedExpense(models.Model):
+    """
+    An expense moved out of the live tables by ``manage.py compact_groups``.
+
+    It keeps the id it had as an Expense. What it adds to balances and to the
+    group total is carried by the group's BalanceSnapshot; exports still
+    include it (see expenses.archive).
+    """
+    id = models.BigIntegerField(primary_key=True)
+    title = models.CharField(max_length=200)
+    icon = models.CharField(max_length=50, blank=True, default='default-icon')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='archived_expenses', db_index=False)
+    paid_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
+                                related_name='archived_expenses_paid')
+    date = models.DateTimeField()
+    description = models.TextField(blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Exports read a group's archive in date order
+            models.Index(fields=['group', 'date', 'id'], name='archived_expense_group_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.title} - ${self.amount} (archived)"
+
+
+class ArchivedExpenseShare(models.Model):
+    expense = models.ForeignKey(ArchivedExpense, on_delete=models.CASCADE, related_name='shares')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_shares')
+    amount_owed = models.DecimalField(max_digits=10, decimal_places=2)
+
+
+class BalanceSnapshot(models.Model):
+    """
+    Checkpoint of a group's archived expenses.
+
+    Its entries hold what the archived expenses add to each member's balance,
+    and ``total_expenses`` what they add to the group total, so balances can
+    be recomputed from the snapshot plus the live expenses and settlements.
+    ``archived_before`` is the cutoff of the last compaction that ran to the
+    end. Expenses imported with an earlier date afterwards stay live until
+    the next compaction archives them.
+    """
+    group = models.OneToOneField(Group, on_delete=models.CASCADE, related_name='balance_snapshot')
+    archived_before = models.DateTimeField(null=True, blank=True)
+    total_expenses = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    expense_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Snapshot of {self.group.name} ({self.expense_count} archived expenses)"
+
+
+class BalanceSnapshotEntry(models.Model):
+    snapshot = models.ForeignKey(BalanceSnapshot, on_delete=models.CASCADE, related_name='entries')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balance_snapshot_entries')
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('snapshot', 'user')
+
+
+class EventPayload(models.Model):
+    """An event too large for a NOTIFY payload, stored for the listeners of expenses.events.PostgresBroker."""
+    event = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
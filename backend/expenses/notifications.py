@@ -0,0 +1,205 @@
+"""
+Notification outbox: enqueueing from request handlers and delivery by the worker.
+
+Views only insert Notification rows inside their own transaction; nothing is
+sent while a request is being served. ``manage.py run_notifier`` claims due
+rows in batches, coalesces them into one message per user, and hands that
+message to every transport the user enabled on their Profile. Delivery is at
+least once: a failed attempt is retried with exponential backoff, through the
+transports that failed only; each notification records the ones it already
+went out through.
+"""
+import json
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from urllib import request as urllib_request
+
+from django.conf import settings
+from django.core.mail import send_mail
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Notification, Profile
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRANSPORTS = {
+    'email': 'expenses.notifications.EmailTransport',
+    'telegram': 'expenses.notifications.TelegramTransport',
+}
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = timedelta(seconds=30)
+BACKOFF_MAX = timedelta(hours=1)
+# How long a claimed batch stays invisible to other workers while it is being sent
+LEASE = timedelta(minutes=5)
+
+MESSAGES = {
+    'expense_added': '{paid_by} added "{title}" ({amount}) in {group}',
+    'expenses_added': '{paid_by} added {count} expenses ({amount}) in {group}',
+    'friend_request': '{from_user} sent you a friend request',
+    'friend_request_accepted': '{by_user} accepted your friend request',
+}
+
+
+def enqueue(kind, user_ids, payload):
+    """Queue a notification for every user in ``user_ids`` who opted in to any channel."""
+    recipients = Profile.objects.filter(
+        Q(email_notification=True) | Q(telegram_notification=True), user_id__in=set(user_ids)
+    ).values_list('user_id', flat=True)
+    Notification.objects.bulk_create([Notification(user_id=user_id, kind=kind, payload=payload)
+                                      for user_id in recipients])
+
+
+def render(notification):
+    template = MESSAGES.get(notification.kind)
+    if template is None:
+        return f'{notification.kind}: {json.dumps(notification.payload)}'
+    return template.format(**notification.payload)
+
+
+def backoff(attempts):
+    return min(BACKOFF_BASE * (2 ** (attempts - 1)), BACKOFF_MAX)
+
+
+class Transport:
+    """Delivers one coalesced message to one user. ``send`` raises on failure."""
+    name = None
+
+    def enabled_for(self, profile):
+        raise NotImplementedError
+
+    def send(self, user, profile, subject, body):
+        raise NotImplementedError
+
+
+class EmailTransport(Transport):
+    name = 'email'
+
+    def enabled_for(self, profile):
+        return profile.email_notification and bool(profile.user.email)
+
+    def send(self, user, profile, subject, body):
+        send_mail(subject, body, None, [user.email])
+
+
+class TelegramTransport(Transport):
+    """Sends through the Bot API; the bot token comes from settings.TELEGRAM_BOT_TOKEN."""
+    name = 'telegram'
+    timeout = 10
+
+    def enabled_for(self, profile):
+        return (profile.telegram_notification and bool(profile.telegram_username)
+                and bool(getattr(settings, 'TELEGRAM_BOT_TOKEN', None)))
+
+    def send(self, user, profile, subject, body):
+        chat_id = profile.telegram_username
+        if not chat_id.startswith('@') and not chat_id.lstrip('-').isdigit():
+            chat_id = f'@{chat_id}'
+        data = json.dumps({'chat_id': chat_id, 'text': f'{subject}\n\n{body}'}).encode()
+        req = urllib_request.Request(
+            f'https://api.telegram.org/bot{settings.TELEGRAM_BOT_TOKEN}/sendMessage',
+            data=data, headers={'Content-Type': 'application/json'},
+        )
+        with urllib_request.urlopen(req, timeout=self.timeout) as response:
+            result = json.loads(response.read())
+        if not result.get('ok'):
+            raise RuntimeError(result.get('description', 'Telegram API error'))
+
+
+class LocMemTransport(Transport):
+    """Stub that records messages in ``LocMemTransport.outbox``, for tests and local development."""
+    name = 'locmem'
+    outbox = []
+
+    def enabled_for(self, profile):
+        return profile.email_notification or profile.telegram_notification
+
+    def send(self, user, profile, subject, body):
+        self.outbox.append({'user': user.username, 'subject': subject, 'body': body})
+
+
+class FailingTransport(Transport):
+    """Stub that always fails, for exercising the retry path."""
+    name = 'failing'
+
+    def enabled_for(self, profile):
+        return True
+
+    def send(self, user, profile, subject, body):
+        raise RuntimeError('transport unavailable')
+
+
+def load_transports():
+    paths = getattr(settings, 'NOTIFICATION_TRANSPORTS', DEFAULT_TRANSPORTS)
+    return [import_string(path)() for path in paths.values()]
+
+
+def claim_batch(batch_size):
+    """Lease up to ``batch_size`` due notifications so no other worker picks them up."""
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(Notification.objects.select_for_update(skip_locked=True, of=('self',))
+                     .filter(status=Notification.STATUS_PENDING, available_at__lte=now)
+                     .select_related('user__profile').order_by('available_at', 'id')[:batch_size])
+        if batch:
+            Notification.objects.filter(pk__in=[n.pk for n in batch]).update(available_at=now + LEASE)
+    return batch
+
+
+def compose(notifications):
+    """The subject and body of one coalesced message."""
+    lines = [render(notification) for notification in notifications]
+    subject = lines[0] if len(lines) == 1 else f'{len(lines)} new updates on Dung'
+    return subject, '\n'.join(f'- {line}' for line in lines)
+
+
+def deliver(batch, transports):
+    """Send one message per user and transport for ``batch`` and record the outcome. Returns (sent, failed) users."""
+    by_user = defaultdict(list)
+    for notification in batch:
+        by_user[notification.user_id].append(notification)
+
+    delivered, retry = [], []
+    for notifications in by_user.values():
+        user = notifications[0].user
+        profile = getattr(user, 'profile', None)
+        errors = defaultdict(list)
+        if profile is not None:
+            for transport in transports:
+                if not transport.enabled_for(profile):
+                    continue
+                # A retry skips the notifications this transport already sent
+                pending = [n for n in notifications if transport.name not in n.delivered_via]
+                if not pending:
+                    continue
+                try:
+                    transport.send(user, profile, *compose(pending))
+                except Exception as exc:
+                    logger.warning('Notification via %s to %s failed: %s', transport.name, user.username, exc)
+                    for notification in pending:
+                        errors[notification.pk].append(f'{transport.name}: {exc}')
+                else:
+                    for notification in pending:
+                        notification.delivered_via = [*notification.delivered_via, transport.name]
+        for notification in notifications:
+            if notification.pk in errors:
+                retry.append((notification, '\n'.join(errors[notification.pk])))
+            else:
+                delivered.append(notification)
+
+    Notification.objects.filter(pk__in=[n.pk for n in delivered]).delete()
+    now = timezone.now()
+    for notification, error in retry:
+        notification.attempts += 1
+        notification.last_error = error
+        if notification.attempts >= MAX_ATTEMPTS:
+            notification.status = Notification.STATUS_FAILED
+        else:
+            notification.available_at = now + backoff(notification.attempts)
+    Notification.objects.bulk_update([notification for notification, _ in retry],
+                                     ['attempts', 'last_error', 'status', 'available_at', 'delivered_via'])
+    failed = {notification.user_id for notification, _ in retry}
+    return len({n.user_id for n in delivered} - failed), len(failed)
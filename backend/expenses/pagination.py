@@ -0,0 +1,120 @@
+"""
+Keyset pagination for expense listings.
+
+Pages are ordered newest first by ``(date, id)`` and the cursor stores the
+``(date, id)`` of the row at the page boundary, so fetching a page is an index
+range scan starting at that row no matter how deep the client has scrolled.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class ExpenseCursorPagination(BasePagination):
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 50
+    max_page_size = 200
+    invalid_cursor_message = 'Invalid cursor'
+    # Where the links point; defaults to the requested URL
+    base_url = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request):
+        """paginate_queryset for async views; ``request`` must be a DRF Request."""
+        return self.set_page([row async for row in self.page_queryset(queryset, request)])
+
+    def page_queryset(self, queryset, request):
+        """The query for the requested page, plus one row to tell whether there is more."""
+        self.request = request
+        self.page_size_requested = page_size = self.get_page_size(request)
+        self.cursor = cursor = self.decode_cursor(request)
+
+        if cursor is None:
+            return queryset.order_by('-date', '-id')[:page_size + 1]
+        date, pk, reverse = cursor
+        if reverse:
+            # Walking back towards newer expenses: scan upwards from the cursor
+            return (queryset.filter(date__gte=date).exclude(date=date, id__lte=pk)
+                    .order_by('date', 'id')[:page_size + 1])
+        return (queryset.filter(date__lte=date).exclude(date=date, id__gte=pk)
+                .order_by('-date', '-id')[:page_size + 1])
+
+    def set_page(self, page):
+        """Trim the rows fetched by page_queryset() to the page and work out the links."""
+        reverse = self.cursor is not None and self.cursor[2]
+        has_more = len(page) > self.page_size_requested
+        page = page[:self.page_size_requested]
+        if reverse:
+            page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+
+        self.page = page
+        return page
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            date, pk, reverse = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii').split('|')
+            date = parse_datetime(date)
+            pk = int(pk)
+        except (Base64Error, UnicodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if date is None or reverse not in ('0', '1'):
+            raise NotFound(self.invalid_cursor_message)
+        return date, pk, reverse == '1'
+
+    def encode_cursor(self, expense, reverse):
+        position = f"{expense.date.isoformat()}|{expense.pk}|{int(reverse)}"
+        return replace_query_param(self.get_base_url(), self.cursor_query_param,
+                                   urlsafe_b64encode(position.encode('ascii')).decode('ascii'))
+
+    def get_base_url(self):
+        return self.base_url or self.request.build_absolute_uri()
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.get_base_url(), self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,233 @@
+"""
+Push channel for group events (see expenses.events), mounted in front of
+Django by dung_backend.asgi.
+
+``/api/events/`` streams the events of the user's groups, either as
+Server-Sent Events (a plain GET, e.g. ``new EventSource(url)``) or as JSON
+text frames over a WebSocket to the same path::
+
+    {"group": 3, "type": "expense_added", "data": {"id": 41, "title": "Taxi", ...}}
+
+``?group=<id>`` (repeatable) narrows the stream to some of the user's groups.
+Browsers cannot set headers on either kind of connection, so instead of the
+usual Authorization header a client may pass ``?ticket=``: a signed,
+single-use ticket from ``POST /api/events/ticket/`` that expires after
+settings.EVENT_TICKET_SECONDS. Tokens are never accepted in the URL, where
+they would end up in access logs.
+
+A member removed from a group stops receiving its events once the
+``member_left`` event naming them has been sent, and so does everyone when
+the group is deleted; a stream left with no groups is closed. Logging out,
+deactivating or deleting the user closes all of their streams.
+
+Connections are served by this module directly rather than by a Django view:
+an idle one costs a coroutine and a small queue, not a thread, and it is
+noticed as soon as the client goes away.
+"""
+import asyncio
+import json
+import secrets
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import cache
+from rest_framework import exceptions
+
+from . import events
+from .authentication import aauthenticate_key
+from .queries import visible_groups
+
+PATH = '/api/events/'
+# Reconnect delay suggested to EventSource clients, in milliseconds
+RETRY_MS = 3000
+TICKET_SALT = 'expenses.push.ticket'
+
+
+class PushError(Exception):
+    def __init__(self, status, detail):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+def _token(scope):
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            keyword, _, key = value.decode('latin-1').partition(' ')
+            if keyword.lower() == 'token' and key:
+                return key.strip()
+    return None
+
+
+def ticket_seconds():
+    return getattr(settings, 'EVENT_TICKET_SECONDS', 30)
+
+
+def issue_ticket(user):
+    """A ticket that authenticates one connection as ``user``."""
+    return signing.dumps({'user': user.pk, 'nonce': secrets.token_urlsafe(16)}, salt=TICKET_SALT)
+
+
+async def redeem_ticket(ticket):
+    """The user a ticket was issued to, or raises PushError; each ticket works once."""
+    try:
+        payload = signing.loads(ticket, salt=TICKET_SALT, max_age=ticket_seconds())
+    except signing.BadSignature:
+        raise PushError(401, 'Invalid or expired ticket.')
+    # Remembered for as long as the ticket is valid, so it cannot be replayed
+    if not await cache.aadd(f"event-ticket:{payload['nonce']}", True, ticket_seconds()):
+        raise PushError(401, 'Ticket already used.')
+    user = await User.objects.filter(pk=payload['user'], is_active=True).afirst()
+    if user is None:
+        raise PushError(401, 'User inactive or deleted.')
+    return user
+
+
+async def authorize(scope):
+    """The user and the ids of the groups they asked to follow, or raises PushError."""
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    key = _token(scope)
+    if key is not None:
+        try:
+            user, _ = await aauthenticate_key(key)
+        except exceptions.AuthenticationFailed as exc:
+            raise PushError(401, str(exc.detail))
+    elif query.get('ticket'):
+        user = await redeem_ticket(query['ticket'][0])
+    else:
+        raise PushError(401, 'Authentication credentials were not provided.')
+
+    try:
+        requested = {int(group_id) for group_id in query.get('group', [])}
+    except ValueError:
+        raise PushError(400, 'group must be a number')
+    groups = visible_groups(user)
+    if requested:
+        groups = groups.filter(pk__in=requested)
+    group_ids = {group_id async for group_id in groups.values_list('id', flat=True)}
+    if requested - group_ids:
+        raise PushError(404, 'Not found.')
+    return user, group_ids
+
+
+async def _pump(subscription, receive, is_disconnect, emit, heartbeat=None, ping=None):
+    """Forward events to ``emit`` until the client leaves; returns True if the server ends the stream instead."""
+    # Waiting on the queue alone keeps an event's cost per connection to a get() and a send()
+    pump = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    left = False
+
+    async def watch():
+        nonlocal left
+        while not is_disconnect(await receive()):
+            # Anything a WebSocket client sends is ignored
+            pass
+        left = True
+        pump.cancel()
+
+    def beat():
+        nonlocal timer
+        subscription.ping()
+        timer = loop.call_later(heartbeat, beat)
+
+    watcher = asyncio.ensure_future(watch())
+    timer = loop.call_later(heartbeat, beat) if heartbeat else None
+    try:
+        while True:
+            event = await subscription.get()
+            if event is None:
+                return True
+            if event is events.PING:
+                await ping()
+            else:
+                await emit(event)
+    except asyncio.CancelledError:
+        if not left:
+            raise
+        pump.uncancel()
+        return False
+    finally:
+        watcher.cancel()
+        if timer is not None:
+            timer.cancel()
+
+
+async def _error_response(send, status, detail):
+    body = json.dumps({'detail': detail}).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def event_stream(scope, receive, send):
+    """Server-Sent Events."""
+    if scope['method'] != 'GET':
+        return await _error_response(send, 405, f'Method "{scope["method"]}" not allowed.')
+    try:
+        user, group_ids = await authorize(scope)
+    except PushError as exc:
+        return await _error_response(send, exc.status, exc.detail)
+
+    async def chunk(data):
+        await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+    async def emit(event):
+        kind, data = event
+        await chunk(f'event: {kind}\ndata: {data}\n\n'.encode())
+
+    async def ping():
+        # Keeps proxies from timing the connection out, and finds clients that vanished
+        await chunk(b': ping\n\n')
+
+    subscription = events.hub.subscribe(group_ids, user_id=user.pk)
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        await chunk(f'retry: {RETRY_MS}\n\n'.encode())
+        await _pump(subscription, receive, lambda message: message['type'] == 'http.disconnect', emit,
+                    heartbeat=getattr(settings, 'EVENT_HEARTBEAT_SECONDS', 25), ping=ping)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        events.hub.unsubscribe(subscription)
+
+
+async def event_socket(scope, receive, send):
+    """The same events over a WebSocket."""
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    try:
+        user, group_ids = await authorize(scope)
+    except PushError as exc:
+        # 4xxx close codes are free for applications; mirror the HTTP status
+        return await send({'type': 'websocket.close', 'code': 4000 + exc.status})
+
+    async def emit(event):
+        await send({'type': 'websocket.send', 'text': event[1]})
+
+    subscription = events.hub.subscribe(group_ids, user_id=user.pk)
+    try:
+        await send({'type': 'websocket.accept'})
+        # The server pings WebSocket clients itself, so no heartbeat here
+        if await _pump(subscription, receive, lambda message: message['type'] == 'websocket.disconnect', emit):
+            # Removed from every group it followed, or 1013: try again later
+            await send({'type': 'websocket.close', 'code': 4403 if subscription.revoked else 1013})
+    finally:
+        events.hub.unsubscribe(subscription)
+
+
+def with_event_stream(django_application):
+    """Wrap Django's ASGI application so that PATH is served by this module."""
+    async def application(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == PATH:
+            return await event_stream(scope, receive, send)
+        if scope['type'] == 'websocket':
+            if scope['path'] == PATH:
+                return await event_socket(scope, receive, send)
+            await receive()
+            return await send({'type': 'websocket.close'})
+        return await django_application(scope, receive, send)
+    return application
@@ -0,0 +1,109 @@
+"""
+EXPLAIN-based checks for the queries behind the busiest endpoints.
+
+``hot_queries()`` builds the lookups expenses.views, expenses.fragments and
+friends run on every page load, and ``explain()`` returns the plan the
+database picks for one of them. expenses.tests fails when a hot query starts
+reading a whole table, sorts rows an index should return in order, or, on
+PostgreSQL, costs more than MAX_COST.
+
+On PostgreSQL sequential scans are switched off while planning. A scan then
+only appears when no index can serve the query, and it carries the planner's
+penalty for disabled nodes, so small test data is enough to catch both. On
+SQLite, which has no costs, only the scans and sorts are checked.
+"""
+import json
+from collections import namedtuple
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from . import friends
+from .models import (ArchivedExpense, Expense, ExpenseShare, FriendRequest, Group, IdempotencyKey, Notification,
+                     SpendingRollup)
+from .queries import visible_groups
+
+# Far below the 1e10 PostgreSQL adds for a disabled sequential scan
+MAX_COST = 1e6
+
+HotQuery = namedtuple('HotQuery', ['queryset', 'ordered'])
+# ``scans`` are the tables read in full, ``sorts`` the sort steps, ``cost`` the total (None on SQLite)
+Plan = namedtuple('Plan', ['scans', 'sorts', 'cost', 'text'])
+
+
+def hot_queries(user, group, other):
+    """``{name: HotQuery}``; ``ordered`` queries must come out of an index already sorted."""
+    memberships = Group.members.through.objects
+    expense_ids = list(Expense.objects.filter(group=group).values_list('pk', flat=True)[:50])
+    now = timezone.now()
+    return {
+        # Group list, dashboard, and the ETag check of every group endpoint
+        'visible_groups': HotQuery(visible_groups(user), False),
+        'group_version': HotQuery(visible_groups(user).filter(pk=group.pk).values_list('version', flat=True), False),
+        'group_members': HotQuery(memberships.filter(group_id__in=[group.pk]).values_list('group_id', 'user_id'),
+                                  False),
+        # Keyset pagination of a group's expenses, first and later pages
+        'group_expenses': HotQuery(Expense.objects.filter(group=group).order_by('-date', '-id')[:51], True),
+        'group_expenses_after': HotQuery(Expense.objects.filter(group=group, date__lte=now)
+                                         .exclude(date=now, id__gte=expense_ids[-1])
+                                         .order_by('-date', '-id')[:51], True),
+        # Expenses across all of the user's groups are merged, which takes a sort
+        'member_expenses': HotQuery(Expense.objects.filter(group__members=user).distinct()
+                                    .order_by('-date', '-id')[:51], False),
+        'expense_participants': HotQuery(ExpenseShare.objects.filter(expense_id__in=expense_ids), False),
+        'user_shares': HotQuery(ExpenseShare.objects.filter(user=user).values('expense_id'), False),
+        'group_shares': HotQuery(ExpenseShare.objects.filter(expense__group=group)
+                                 .values('user_id', 'amount_owed'), False),
+        'group_balances': HotQuery(group.balance_entries.select_related('user'), False),
+        'group_settlements': HotQuery(group.settlements.all(), False),
+        'group_rollups': HotQuery(SpendingRollup.objects.filter(group=group), False),
+        # Export of the archive, and the oldest expenses compact_groups archives next
+        'group_archive': HotQuery(ArchivedExpense.objects.filter(group=group).order_by('date', 'id'), True),
+        'expenses_to_archive': HotQuery(Expense.objects.filter(group=group, date__lt=now)
+                                        .order_by('date', 'id')[:1000], True),
+        'pending_requests': HotQuery(FriendRequest.objects.filter(to_user=user, accepted=False)
+                                     .select_related('from_user', 'to_user'), False),
+        'pending_request_between': HotQuery(FriendRequest.objects.filter(from_user=user, to_user=other,
+                                                                         accepted=False), False),
+        'friends': HotQuery(friends.friends_of(user), False),
+        'idempotency_key': HotQuery(IdempotencyKey.objects.filter(user=user, key='key'), False),
+        'due_notifications': HotQuery(Notification.objects.filter(status=Notification.STATUS_PENDING,
+                                                                  available_at__lte=now)
+                                      .order_by('available_at', 'id')[:100], True),
+    }
+
+
+def explain(queryset):
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        with transaction.atomic(using=queryset.db), connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            return _postgresql_plan(queryset.explain(format='json'))
+    return _sqlite_plan(queryset.explain())
+
+
+def _postgresql_plan(text):
+    root = json.loads(text)[0]['Plan']
+    scans, sorts = [], []
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        if node['Node Type'] == 'Seq Scan':
+            scans.append(node['Relation Name'])
+        elif node['Node Type'] in ('Sort', 'Incremental Sort'):
+            sorts.append(', '.join(node.get('Sort Key', [])))
+        nodes.extend(node.get('Plans', []))
+    return Plan(scans, sorts, root['Total Cost'], text)
+
+
+def _sqlite_plan(text):
+    # EXPLAIN QUERY PLAN rows: "<id> <parent> <unused> <detail>"
+    scans, sorts = [], []
+    for line in text.splitlines():
+        detail = line.split(' ', 3)[-1]
+        if detail.startswith('SCAN ') and not detail.startswith(('SCAN (', 'SCAN CONSTANT ROW')):
+            # "SCAN t USING INDEX i" walks all of the index, which is no better
+            scans.append(detail.split()[1])
+        elif detail.startswith('USE TEMP B-TREE FOR') and 'ORDER BY' in detail:
+            sorts.append(detail)
+    return Plan(scans, sorts, None, text)
@@ -0,0 +1,68 @@
+import json
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StreamingExportRenderer(BaseRenderer):
+    """
+    Lets ``?format=`` select an export format on streaming endpoints.
+
+    Successful responses are StreamingHttpResponses that bypass rendering;
+    only error payloads reach ``render`` and are sent as JSON.
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return json.dumps(data).encode(self.charset)
+
+
+class CSVRenderer(StreamingExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class NDJSONRenderer(StreamingExportRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+class PrometheusRenderer(BaseRenderer):
+    """Prometheus text exposition format; the view returns the rendered text."""
+    media_type = 'text/plain'
+    format = 'prometheus'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, str):
+            return data.encode(self.charset)
+        return json.dumps(data).encode(self.charset)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer on top of orjson, for large responses. Opt in by putting it
+    first in REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'], which setting the
+    FAST_JSON_RENDERER environment variable does.
+
+    The output matches JSONRenderer's: values orjson does not handle
+    itself, and datetimes, go through DRF's encoder. Indented output (the
+    ``indent`` media type parameter) falls back to JSONRenderer. orjson is in
+    requirements.txt; configuring this renderer without it fails the system
+    checks (see expenses.checks).
+    """
+    options = orjson and (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        ret = orjson.dumps(data, default=JSONEncoder().default, option=self.options)
+        # Escaped by JSONRenderer too: valid JSON, but line terminators in JavaScript
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
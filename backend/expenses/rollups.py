@@ -0,0 +1,163 @@
+"""
+Pre-aggregated monthly spending for group analytics.
+
+SpendingRollup keeps one row per (group, month, user, category). The write
+paths that book the ledger also book the rollups, so a stats request over any
+date range only sums a few monthly buckets instead of scanning the expense
+tables. ``manage.py rebuild_rollups`` recomputes them from scratch.
+"""
+from collections import defaultdict
+from datetime import date, datetime
+
+from django.db import transaction
+from django.db.models import Count, DateField, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .ledger import ZERO, to_cents
+from .models import ArchivedExpense, ArchivedExpenseShare, Expense, ExpenseShare, SpendingRollup
+
+
+def month_of(moment):
+    """First day of the month ``moment`` (a date or datetime) falls in, in the current time zone."""
+    if isinstance(moment, datetime) and timezone.is_aware(moment):
+        moment = timezone.localtime(moment)
+    return date(moment.year, moment.month, 1)
+
+
+def parse_month(value):
+    """Parse ``YYYY-MM`` or ``YYYY-MM-DD`` into the first day of that month; raises ValueError."""
+    for fmt in ('%Y-%m', '%Y-%m-%d'):
+        try:
+            return month_of(datetime.strptime(value, fmt).date())
+        except ValueError:
+            continue
+    raise ValueError(f"'{value}' is not a month (YYYY-MM) or a date (YYYY-MM-DD)")
+
+
+class RollupDeltas:
+    """Signed changes to rollup rows, keyed by (month, user id, category)."""
+
+    def __init__(self):
+        self.rows = defaultdict(lambda: [ZERO, ZERO, 0])
+
+    def expense(self, moment, category, paid_by_id, amount, sign=1):
+        row = self.rows[(month_of(moment), paid_by_id, category)]
+        row[0] += sign * to_cents(amount)
+        row[2] += sign
+
+    def share(self, moment, category, user_id, amount_owed, sign=1):
+        self.rows[(month_of(moment), user_id, category)][1] += sign * to_cents(amount_owed)
+
+
+def apply_deltas(group_id, deltas):
+    """Add ``deltas`` to the group's rollup rows, creating the missing ones."""
+    pending = {key: row for key, row in deltas.rows.items() if any(row)}
+    if not pending:
+        return
+
+    with transaction.atomic():
+        months = {month for month, _, _ in pending}
+        existing = SpendingRollup.objects.select_for_update().filter(group_id=group_id, month__in=months)
+        updated, emptied = [], []
+        for rollup in existing:
+            row = pending.pop((rollup.month, rollup.user_id, rollup.category), None)
+            if row is None:
+                continue
+            rollup.paid += row[0]
+            rollup.owed += row[1]
+            rollup.expense_count += row[2]
+            if rollup.paid or rollup.owed or rollup.expense_count:
+                updated.append(rollup)
+            else:
+                emptied.append(rollup.pk)
+        if updated:
+            SpendingRollup.objects.bulk_update(updated, ['paid', 'owed', 'expense_count'])
+        if emptied:
+            # Buckets whose expenses all moved away or were deleted
+            SpendingRollup.objects.filter(pk__in=emptied).delete()
+        if pending:
+            SpendingRollup.objects.bulk_create([
+                SpendingRollup(group_id=group_id, month=month, user_id=user_id, category=category,
+                               paid=row[0], owed=row[1], expense_count=row[2])
+                for (month, user_id, category), row in pending.items()
+            ])
+
+
+def book_expenses(expenses, shares, sign=1):
+    """Book bulk-created ``expenses`` and ``shares`` (whose ``expense`` is set) per group."""
+    by_group = defaultdict(RollupDeltas)
+    for expense in expenses:
+        by_group[expense.group_id].expense(expense.date, expense.icon, expense.paid_by_id, expense.amount, sign)
+    for share in shares:
+        expense = share.expense
+        by_group[expense.group_id].share(expense.date, expense.icon, share.user_id, share.amount_owed, sign)
+    for group_id, deltas in by_group.items():
+        apply_deltas(group_id, deltas)
+
+
+def rebuild_group(group):
+    """Recompute a group's rollups from the expense tables, archived expenses included."""
+    rows = defaultdict(lambda: [ZERO, ZERO, 0])
+    for expenses, shares in ((Expense.objects, ExpenseShare.objects),
+                             (ArchivedExpense.objects, ArchivedExpenseShare.objects)):
+        paid = (expenses.filter(group=group)
+                .annotate(month=TruncMonth('date', output_field=DateField()))
+                .values('month', 'paid_by_id', 'icon').annotate(total=Sum('amount'), count=Count('id')))
+        for row in paid:
+            entry = rows[(row['month'], row['paid_by_id'], row['icon'])]
+            entry[0] += row['total']
+            entry[2] += row['count']
+        owed = (shares.filter(expense__group=group)
+                .annotate(month=TruncMonth('expense__date', output_field=DateField()))
+                .values('month', 'user_id', 'expense__icon').annotate(total=Sum('amount_owed')))
+        for row in owed:
+            rows[(row['month'], row['user_id'], row['expense__icon'])][1] += row['total']
+
+    with transaction.atomic():
+        SpendingRollup.objects.filter(group=group).delete()
+        SpendingRollup.objects.bulk_create([
+            SpendingRollup(group=group, month=month, user_id=user_id, category=category,
+                           paid=to_cents(paid), owed=to_cents(owed), expense_count=count)
+            for (month, user_id, category), (paid, owed, count) in rows.items()
+        ])
+
+
+def summarize(group, start=None, end=None, top=5):
+    """
+    Spending of ``group`` between the months ``start`` and ``end`` (inclusive, either may be None).
+
+    Returns totals by month, by category and by member plus the top spenders, from one query.
+    """
+    rollups = SpendingRollup.objects.filter(group=group).select_related('user')
+    if start is not None:
+        rollups = rollups.filter(month__gte=start)
+    if end is not None:
+        rollups = rollups.filter(month__lte=end)
+
+    by_month = defaultdict(lambda: [ZERO, 0])
+    by_category = defaultdict(lambda: [ZERO, 0])
+    by_member = {}
+    for rollup in rollups:
+        for bucket in (by_month[rollup.month], by_category[rollup.category]):
+            bucket[0] += rollup.paid
+            bucket[1] += rollup.expense_count
+        if rollup.user_id is not None:
+            member = by_member.setdefault(rollup.user_id, {'user': rollup.user, 'paid': ZERO, 'owed': ZERO,
+                                                           'expense_count': 0})
+            member['paid'] += rollup.paid
+            member['owed'] += rollup.owed
+            member['expense_count'] += rollup.expense_count
+
+    members = sorted(by_member.values(), key=lambda member: member['user'].username)
+    return {
+        'total': sum((total for total, _ in by_month.values()), ZERO),
+        'expense_count': sum(count for _, count in by_month.values()),
+        'by_month': [{'month': month, 'total': total, 'expense_count': count}
+                     for month, (total, count) in sorted(by_month.items())],
+        'by_category': [{'category': category, 'total': total, 'expense_count': count}
+                        for category, (total, count) in sorted(by_category.items(), key=lambda item: -item[1][0])],
+        'by_member': members,
+        'top_spenders': sorted((member for member in members if member['paid'] > 0),
+                               key=lambda member: -member['paid'])[:top],
+    }
@@ -0,0 +1,76 @@
+"""
+Database router that sends request reads to replicas.
+
+Reads made while handling a GET/HEAD/OPTIONS request go to one alias from
+settings.DATABASE_REPLICAS, picked at random when the request starts so that
+all of its reads see the same point in time; everything else (writes, unsafe requests,
+management commands, the notifier) uses ``default``. Replication lags, so a
+client that just wrote is pinned to the primary for settings.REPLICA_PIN_SECONDS
+and sees its own changes (see expenses.middleware.ReplicaRoutingMiddleware).
+
+Authentication tokens and sessions are always read from the primary, so a
+token issued a moment ago on the primary is never rejected by a replica.
+"""
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+
+PRIMARY = 'default'
+# Apps whose rows must be visible as soon as they are written
+PRIMARY_ONLY_APPS = {'authtoken', 'sessions'}
+
+
+class RoutingState:
+    def __init__(self, use_replicas):
+        aliases = replicas()
+        self.use_replicas = use_replicas and bool(aliases)
+        # Replicas lag by different amounts, so a request reads from only one of them
+        self.replica = random.choice(aliases) if self.use_replicas else None
+        self.wrote = False
+
+
+# Unset outside a request, which means primary only
+_state = ContextVar('replica_routing', default=None)
+
+
+def begin_request(use_replicas):
+    """Route this request's reads; returns a token for end_request()."""
+    return _state.set(RoutingState(use_replicas))
+
+
+def end_request(token):
+    """Stop routing for the request; returns its RoutingState."""
+    state = _state.get()
+    _state.reset(token)
+    return state
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # Follow the object the related rows are loaded for
+            return instance._state.db
+        state = _state.get()
+        if state is None or not state.use_replicas or model._meta.app_label in PRIMARY_ONLY_APPS:
+            return PRIMARY
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            # Read your own writes for the rest of the request
+            state.use_replicas = False
+            state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -0,0 +1,84 @@
+"""
+Username typeahead for add_member and add_friend.
+
+A query matches users whose username, first or last name contains it, case
+insensitively. Friends come first, then people the searcher shares a group
+with, then prefix matches, then everything else by username.
+
+On PostgreSQL the substring match is served by the trigram indexes created
+in migration 0015; elsewhere it is a plain LIKE scan. Results are cached
+per user for a few seconds. Because every match for "ann" also matches
+"anna", a cached result set that was complete for a prefix answers longer
+queries without touching the database.
+"""
+from urllib.parse import quote
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import BooleanField, Case, Exists, OuterRef, Q, Value, When
+
+from .models import Friend, Group
+
+MAX_RESULTS = 50
+DEFAULT_RESULTS = 10
+CACHE_TTL = 30
+MAX_QUERY_LENGTH = 100
+FIELDS = ('id', 'username', 'first_name', 'last_name')
+SEARCHED = ('username', 'first_name', 'last_name')
+
+
+def _cache_key(user_id, query):
+    return f'user-search:{user_id}:{quote(query)}'
+
+
+def _matches(row, query):
+    return any(query in row[field].lower() for field in SEARCHED)
+
+
+def _rank(row, query):
+    return (not row['is_friend'], not row['is_co_member'], not row['username'].lower().startswith(query),
+            row['username'])
+
+
+def _query_database(user, query):
+    memberships = Group.members.through.objects
+    co_member = memberships.filter(user=OuterRef('pk'),
+                                   group__in=memberships.filter(user=user).values('group_id'))
+    matches = Q()
+    for field in SEARCHED:
+        matches |= Q(**{f'{field}__icontains': query})
+    rows = (User.objects.filter(matches).exclude(pk=user.pk)
+            .annotate(is_friend=Exists(Friend.objects.filter(user=user, friend=OuterRef('pk'))),
+                      is_co_member=Exists(co_member),
+                      is_prefix=Case(When(username__istartswith=query, then=Value(True)),
+                                     default=Value(False), output_field=BooleanField()))
+            .order_by('-is_friend', '-is_co_member', '-is_prefix', 'username')
+            .values(*FIELDS, 'is_friend', 'is_co_member')[:MAX_RESULTS + 1])
+    rows = list(rows)
+    return {'complete': len(rows) <= MAX_RESULTS, 'rows': rows[:MAX_RESULTS]}
+
+
+def _from_prefix(user_id, query):
+    """Derive the result for ``query`` from a complete cached result for a shorter prefix of it."""
+    # Longest prefix first, all fetched in one cache round trip
+    keys = [_cache_key(user_id, query[:end]) for end in range(len(query) - 1, 0, -1)]
+    found = cache.get_many(keys)
+    for key in keys:
+        shorter = found.get(key)
+        if shorter is not None and shorter['complete']:
+            rows = sorted((row for row in shorter['rows'] if _matches(row, query)), key=lambda row: _rank(row, query))
+            return {'complete': True, 'rows': rows}
+    return None
+
+
+def search_users(user, query, limit=DEFAULT_RESULTS):
+    """Up to ``limit`` users matching ``query``, as dicts of FIELDS plus is_friend and is_co_member."""
+    query = query.strip().lower()[:MAX_QUERY_LENGTH]
+    if not query:
+        return []
+    key = _cache_key(user.pk, query)
+    entry = cache.get(key)
+    if entry is None:
+        entry = _from_prefix(user.pk, query) or _query_database(user, query)
+        cache.set(key, entry, CACHE_TTL)
+    return entry['rows'][:limit]
@@ -1,6 +1,10 @@
+from decimal import Decimal
+
 from rest_framework import serializers
+from rest_framework.settings import ISO_8601
 from django.contrib.auth.models import User
-from .models import Group, Expense, ExpenseShare, FriendRequest
+from .models import Group, Expense, ExpenseShare, FriendRequest, Settlement
+from .splits import EQUAL, SPLIT_MODES
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -19,15 +23,65 @@ class GroupSerializer(serializers.ModelSerializer):
         read_only_fields = ['created_by', 'created_at']
 
 
+class SplitEntrySerializer(serializers.Serializer):
+    user = serializers.IntegerField()
+    # The weight, percentage or exact amount, depending on the split mode; unused for equal splits
+    value = serializers.DecimalField(max_digits=12, decimal_places=4, required=False)
+
+
 class ExpenseSerializer(serializers.ModelSerializer):
     paid_by = UserSerializer(read_only=True)
     participants = UserSerializer(many=True, read_only=True)
+    # How a new expense is shared out (see expenses.splits); without ``split`` every group member takes part
+    split_mode = serializers.ChoiceField(choices=SPLIT_MODES, default=EQUAL, write_only=True)
+    split = SplitEntrySerializer(many=True, required=False, write_only=True)
 
     class Meta:
         model = Expense
-        fields = ['id', 'title', 'amount', 'paid_by', 'group', 'participants', 'date', 'description']
+        fields = ['id', 'title', 'amount', 'paid_by', 'group', 'participants', 'date', 'description',
+                  'split_mode', 'split']
         read_only_fields = ['paid_by', 'date']
 
+    def update(self, instance, validated_data):
+        if 'split' in validated_data:
+            raise serializers.ValidationError({'split': ['Splits can only be set when an expense is created']})
+        validated_data.pop('split_mode', None)
+        return super().update(instance, validated_data)
+
+
+class ExpenseBatchSerializer(ExpenseSerializer):
+    # Groups are resolved with a single query for the whole batch by the view
+    group = serializers.IntegerField()
+
+
+class ExpenseImportSerializer(ExpenseSerializer):
+    """Validates one imported row; usernames are resolved against the ``members`` in context."""
+    paid_by = serializers.CharField(required=False)
+    participants = serializers.CharField(required=False)
+    date = serializers.DateTimeField(required=False, input_formats=[ISO_8601, '%Y-%m-%d'])
+
+    class Meta(ExpenseSerializer.Meta):
+        fields = ['title', 'amount', 'icon', 'description', 'date', 'paid_by', 'participants']
+        read_only_fields = []
+
+    def _member_id(self, username):
+        try:
+            return self.context['members'][username]
+        except KeyError:
+            raise serializers.ValidationError(f"'{username}' is not a member of this group")
+
+    def validate_amount(self, value):
+        if value <= 0:
+            raise serializers.ValidationError("Amount must be greater than zero")
+        return value
+
+    def validate_paid_by(self, value):
+        return self._member_id(value.strip())
+
+    def validate_participants(self, value):
+        usernames = {username.strip() for username in value.split(';') if username.strip()}
+        return [self._member_id(username) for username in sorted(usernames)]
+
 
 class ExpenseShareSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
@@ -37,6 +91,23 @@ class ExpenseShareSerializer(serializers.ModelSerializer):
         fields = ['expense', 'user', 'amount_owed']
 
 
+class SettlementSerializer(serializers.ModelSerializer):
+    from_user = UserSerializer(read_only=True)
+    to_user = UserSerializer(read_only=True)
+
+    class Meta:
+        model = Settlement
+        fields = ['id', 'group', 'from_user', 'to_user', 'amount', 'created_at']
+        read_only_fields = ['group', 'created_at']
+
+
+class PaymentSerializer(serializers.Serializer):
+    """One settlement payment to record; ``from_user`` defaults to the requesting user."""
+    from_user = serializers.IntegerField(required=False)
+    to_user = serializers.IntegerField()
+    amount = serializers.DecimalField(max_digits=12, decimal_places=2, min_value=Decimal('0.01'))
+
+
 class FriendRequestSerializer(serializers.ModelSerializer):
     from_user = UserSerializer(read_only=True)
     to_user = UserSerializer(read_only=True)
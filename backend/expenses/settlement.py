@@ -0,0 +1,45 @@
+"""
+Debt simplification for a group's net balances.
+
+Positive balances are owed money (creditors), negative balances owe money
+(debtors). The planner repeatedly matches the largest debtor with the largest
+creditor, so every step clears at least one of them and a group of n members
+settles in at most n - 1 transfers. Amounts stay exact Decimals throughout.
+"""
+import heapq
+from collections import namedtuple
+from decimal import Decimal
+
+Transfer = namedtuple('Transfer', ['from_user', 'to_user', 'amount'])
+
+
+def plan_settlements(balances):
+    """
+    Return the transfers that clear ``balances`` (user id -> Decimal net balance).
+
+    If the balances do not sum to zero, the unmatched remainder is left on the
+    largest creditor or debtor instead of being invented out of thin air.
+    """
+    creditors = []
+    debtors = []
+    for user_id, balance in balances.items():
+        balance = Decimal(balance)
+        if balance > 0:
+            creditors.append((-balance, user_id))
+        elif balance < 0:
+            debtors.append((balance, user_id))
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append(Transfer(debtor, creditor, amount))
+
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, creditor))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, debtor))
+    return transfers
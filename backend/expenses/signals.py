@@ -0,0 +1,343 @@
+import threading
+from contextlib import contextmanager
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from . import events, fragments, ledger, rollups, versioning
+from .authentication import token_cache
+from .models import ArchivedExpense, ArchivedExpenseShare, Expense, ExpenseShare, Group, GroupBalance, Settlement
+
+# Ids of groups/expenses whose cascade delete is in progress. Their children
+# are already accounted for by the parent's handler and must not be reversed twice.
+_deleting = threading.local()
+
+
+def _deleting_ids(name):
+    if not hasattr(_deleting, name):
+        setattr(_deleting, name, set())
+    return getattr(_deleting, name)
+
+
+@contextmanager
+def archiving(group_id, expense_ids):
+    """
+    Delete a group's expenses without booking them out of the ledger and rollups.
+
+    Used by expenses.archive, which moves them to the archive tables and books
+    them into the group's BalanceSnapshot instead.
+    """
+    _deleting_ids('archiving').add(group_id)
+    # Their shares are skipped without looking the expense up
+    _deleting_ids('expenses').update(expense_ids)
+    try:
+        yield
+    finally:
+        _deleting_ids('archiving').discard(group_id)
+        _deleting_ids('expenses').difference_update(expense_ids)
+
+
+def _skip_bookkeeping(group_id):
+    # Deleted along with the group, or moved to the archive
+    return group_id in _deleting_ids('groups') or group_id in _deleting_ids('archiving')
+
+
+@receiver(pre_save, sender=Expense)
+def remember_expense(sender, instance, raw=False, **kwargs):
+    instance._ledger_previous = None
+    if raw or instance.pk is None:
+        return
+    instance._ledger_previous = (Expense.objects.filter(pk=instance.pk)
+                                 .values('group_id', 'paid_by_id', 'amount', 'date', 'icon').first())
+
+
+@receiver(post_save, sender=Expense)
+def expense_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_ledger_previous', None)
+    instance._ledger_previous = None
+    current = {'group_id': instance.group_id, 'paid_by_id': instance.paid_by_id,
+               'amount': ledger.to_cents(instance.amount), 'month': rollups.month_of(instance.date),
+               'icon': instance.icon}
+    if previous is not None:
+        previous['month'] = rollups.month_of(previous.pop('date'))
+    if previous == current:
+        # Nothing the ledger or the rollups care about changed, but the expense itself did
+        versioning.bump(instance.group_id)
+        return
+
+    shares, moved = [], False
+    if previous is not None:
+        moved = previous['group_id'] != current['group_id']
+        if moved or (previous['month'], previous['icon']) != (current['month'], current['icon']):
+            # The shares move along with the expense
+            shares = list(ExpenseShare.objects.filter(expense=instance).values_list('user_id', 'amount_owed'))
+        ledger.apply_deltas(previous['group_id'],
+                            ledger.expense_deltas(previous['paid_by_id'], previous['amount'],
+                                                  shares if moved else [], sign=-1),
+                            -previous['amount'])
+        _book_rollups(previous, shares, sign=-1)
+    ledger.apply_deltas(current['group_id'],
+                        ledger.expense_deltas(current['paid_by_id'], current['amount'],
+                                              shares if moved else []),
+                        current['amount'])
+    _book_rollups(current, shares)
+
+
+def _book_rollups(state, shares, sign=1):
+    deltas = rollups.RollupDeltas()
+    deltas.expense(state['month'], state['icon'], state['paid_by_id'], state['amount'], sign)
+    for user_id, amount_owed in shares:
+        deltas.share(state['month'], state['icon'], user_id, amount_owed, sign)
+    rollups.apply_deltas(state['group_id'], deltas)
+
+
+@receiver(pre_delete, sender=Expense)
+def expense_deleting(sender, instance, **kwargs):
+    if _skip_bookkeeping(instance.group_id):
+        return
+    _deleting_ids('expenses').add(instance.pk)
+    shares = list(ExpenseShare.objects.filter(expense=instance).values_list('user_id', 'amount_owed'))
+    ledger.apply_deltas(instance.group_id,
+                        ledger.expense_deltas(instance.paid_by_id, instance.amount, shares, sign=-1),
+                        -instance.amount)
+    _book_rollups({'group_id': instance.group_id, 'paid_by_id': instance.paid_by_id, 'amount': instance.amount,
+                   'month': rollups.month_of(instance.date), 'icon': instance.icon}, shares, sign=-1)
+
+
+@receiver(post_delete, sender=Expense)
+def expense_deleted(sender, instance, **kwargs):
+    _deleting_ids('expenses').discard(instance.pk)
+
+
+def expense_event_data(expense):
+    return {'id': expense.pk, 'title': expense.title, 'amount': str(expense.amount),
+            'paid_by': expense.paid_by_id, 'date': expense.date.isoformat()}
+
+
+@receiver(post_save, sender=Expense)
+def publish_expense_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        events.publish(instance.group_id, events.EXPENSE_ADDED if created else events.EXPENSE_UPDATED,
+                       expense_event_data(instance))
+
+
+@receiver(post_delete, sender=Expense)
+def publish_expense_deleted(sender, instance, **kwargs):
+    if not _skip_bookkeeping(instance.group_id):
+        events.publish(instance.group_id, events.EXPENSE_DELETED, {'id': instance.pk})
+
+
+@receiver(pre_save, sender=ExpenseShare)
+def remember_share(sender, instance, raw=False, **kwargs):
+    instance._ledger_previous = None
+    if raw or instance.pk is None:
+        return
+    instance._ledger_previous = (ExpenseShare.objects.filter(pk=instance.pk)
+                                 .values('expense__group_id', 'expense__date', 'expense__icon',
+                                         'user_id', 'amount_owed').first())
+
+
+@receiver(post_save, sender=ExpenseShare)
+def share_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_ledger_previous', None)
+    instance._ledger_previous = None
+    expense = instance.expense
+    if previous is not None:
+        if (previous['expense__group_id'], rollups.month_of(previous['expense__date']), previous['expense__icon'],
+                previous['user_id'], ledger.to_cents(previous['amount_owed'])) == \
+                (expense.group_id, rollups.month_of(expense.date), expense.icon,
+                 instance.user_id, ledger.to_cents(instance.amount_owed)):
+            return
+        if expense.paid_by_id is not None:
+            ledger.apply_deltas(previous['expense__group_id'],
+                                {previous['user_id']: previous['amount_owed']})
+        deltas = rollups.RollupDeltas()
+        deltas.share(previous['expense__date'], previous['expense__icon'], previous['user_id'],
+                     previous['amount_owed'], sign=-1)
+        rollups.apply_deltas(previous['expense__group_id'], deltas)
+    if expense.paid_by_id is not None:
+        ledger.apply_deltas(expense.group_id, {instance.user_id: -ledger.to_cents(instance.amount_owed)})
+    rollups.book_expenses([], [instance])
+
+
+@receiver(post_delete, sender=ExpenseShare)
+def share_deleted(sender, instance, **kwargs):
+    if instance.expense_id in _deleting_ids('expenses') or instance.user_id in _deleting_ids('users'):
+        return
+    expense = Expense.objects.filter(pk=instance.expense_id).values('group_id', 'date', 'icon', 'paid_by_id').first()
+    if expense is None or _skip_bookkeeping(expense['group_id']):
+        return
+    if expense['paid_by_id'] is not None:
+        ledger.apply_deltas(expense['group_id'], {instance.user_id: instance.amount_owed})
+    deltas = rollups.RollupDeltas()
+    deltas.share(expense['date'], expense['icon'], instance.user_id, instance.amount_owed, sign=-1)
+    rollups.apply_deltas(expense['group_id'], deltas)
+
+
+@receiver(post_save, sender=Settlement)
+def settlement_saved(sender, instance, created, raw=False, **kwargs):
+    # Settlements are append-only; bulk inserts apply their own deltas
+    if created and not raw:
+        ledger.apply_deltas(instance.group_id, ledger.settlement_deltas([instance]))
+
+
+@receiver(post_delete, sender=Settlement)
+def settlement_deleted(sender, instance, **kwargs):
+    users = _deleting_ids('users')
+    if instance.group_id in _deleting_ids('groups') or instance.from_user_id in users or instance.to_user_id in users:
+        return
+    ledger.apply_deltas(instance.group_id, ledger.settlement_deltas([instance], sign=-1))
+
+
+@receiver(post_save, sender=Group)
+def group_saved(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        versioning.bump(instance.pk)
+
+
+@receiver(pre_delete, sender=Group)
+def group_deleting(sender, instance, **kwargs):
+    _deleting_ids('groups').add(instance.pk)
+
+
+@receiver(post_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    _deleting_ids('groups').discard(instance.pk)
+    fragments.group_fragments.invalidate(instance.pk)
+    events.publish(instance.pk, events.GROUP_DELETED)
+
+
+@receiver(m2m_changed, sender=Group.members.through)
+def members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_clear' and not reverse:
+        versioning.bump(instance.pk)
+        fragments.group_fragments.invalidate(instance.pk)
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+    if reverse:
+        # user.expense_groups.add(...): instance is the user and pk_set holds group ids
+        targets = [(group_id, [instance.pk]) for group_id in pk_set]
+    else:
+        targets = [(instance.pk, pk_set)]
+
+    for group_id, user_ids in targets:
+        if action == 'post_add':
+            ledger.ensure_members(group_id, user_ids)
+        else:
+            # Former members only stay in the ledger while they still owe or are owed
+            GroupBalance.objects.filter(group_id=group_id, user_id__in=user_ids, balance=0).delete()
+        events.publish(group_id, events.MEMBER_JOINED if action == 'post_add' else events.MEMBER_LEFT,
+                       {'users': sorted(user_ids)})
+    versioning.bump(*(group_id for group_id, _ in targets))
+    # The bump already outdates them; this frees the memory
+    fragments.group_fragments.invalidate(*(group_id for group_id, _ in targets))
+
+
+def _invalidate_tokens(keys):
+    # Once now, and again after commit in case a concurrent request re-cached the old row
+    keys = list(keys)
+    for key in keys:
+        token_cache.invalidate(key)
+    transaction.on_commit(lambda: [token_cache.invalidate(key) for key in keys])
+
+
+def _revoke_streams(user_id):
+    # Streams opened with the token, or with a ticket it paid for, must not outlive it
+    events.publish(None, events.REVOKED, {'users': [user_id]})
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    _invalidate_tokens([instance.key])
+    _revoke_streams(instance.user_id)
+
+
+def _invalidate_user_fragment(user_id):
+    # Same reasoning as for tokens
+    fragments.user_fragments.invalidate(user_id)
+    transaction.on_commit(lambda: fragments.user_fragments.invalidate(user_id))
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, raw=False, **kwargs):
+    # Covers deactivation as well as any change to the cached user fields
+    if created or raw:
+        return
+    _invalidate_tokens(Token.objects.filter(user=instance).values_list('key', flat=True))
+    _invalidate_user_fragment(instance.pk)
+    if not instance.is_active:
+        _revoke_streams(instance.pk)
+    # Group payloads embed member details
+    Group.objects.filter(members=instance).update(version=F('version') + 1)
+
+
+def _hand_shares_to_payers(user, share_model):
+    """
+    Add the user's shares of expenses someone else paid to the payer's own share.
+
+    What the user owed is forgiven by the payer, and the expense's shares still
+    add up to its amount. The user's rows are left for the cascade to delete.
+    """
+    shares = list(share_model.objects.filter(user=user, expense__paid_by__isnull=False)
+                  .exclude(expense__paid_by=user).annotate(payer_id=F('expense__paid_by'))
+                  .values_list('expense_id', 'payer_id', 'amount_owed'))
+    if not shares:
+        return
+    own = {(share.expense_id, share.user_id): share
+           for share in share_model.objects.filter(expense_id__in={expense_id for expense_id, _, _ in shares},
+                                                   user_id__in={payer_id for _, payer_id, _ in shares})}
+    created = []
+    for expense_id, payer_id, amount_owed in shares:
+        share = own.get((expense_id, payer_id))
+        if share is None:
+            share = own[(expense_id, payer_id)] = share_model(expense_id=expense_id, user_id=payer_id,
+                                                              amount_owed=0)
+            created.append(share)
+        share.amount_owed += amount_owed
+    # Neither writes through the share signals; the groups are rebuilt once the user is gone
+    share_model.objects.bulk_update([share for share in own.values() if share.pk is not None], ['amount_owed'])
+    share_model.objects.bulk_create(created)
+
+
+def _ledger_groups(user):
+    """Ids of the groups whose balances involve ``user``."""
+    querysets = [
+        GroupBalance.objects.filter(user=user).values_list('group_id'),
+        Expense.objects.filter(paid_by=user).values_list('group_id'),
+        ExpenseShare.objects.filter(user=user).values_list('expense__group_id'),
+        ArchivedExpense.objects.filter(paid_by=user).values_list('group_id'),
+        ArchivedExpenseShare.objects.filter(user=user).values_list('expense__group_id'),
+        Settlement.objects.filter(Q(from_user=user) | Q(to_user=user)).values_list('group_id'),
+    ]
+    return {group_id for group_id, in querysets[0].union(*querysets[1:])}
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    # The memberships go with the user without an m2m_changed signal
+    Group.objects.filter(members=instance).update(version=F('version') + 1)
+    # Their shares, settlements and balances are deleted, and the expenses they paid lose their payer
+    # (see expenses.ledger), without the ledger signals; the groups involved are rebuilt afterwards
+    instance._ledger_groups = _ledger_groups(instance)
+    _hand_shares_to_payers(instance, ExpenseShare)
+    _hand_shares_to_payers(instance, ArchivedExpenseShare)
+    _deleting_ids('users').add(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    _deleting_ids('users').discard(instance.pk)
+    _invalidate_user_fragment(instance.pk)
+    _revoke_streams(instance.pk)
+    for group in Group.objects.filter(pk__in=getattr(instance, '_ledger_groups', ())).order_by('pk'):
+        ledger.rebuild_snapshot(group)
+        ledger.rebuild_group(group)
+        rollups.rebuild_group(group)
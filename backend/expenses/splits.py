@@ -0,0 +1,141 @@
+"""
+Helpers that turn an expense amount into ExpenseShare rows.
+
+Four modes decide how ``amount`` is divided between the chosen participants:
+
+- ``equal``: everyone owes the same;
+- ``shares``: in proportion to a positive weight each (e.g. 2 nights vs 3);
+- ``percentage``: by percentages that add up to 100;
+- ``exact``: the given amounts, which must add up to ``amount``.
+
+Amounts are worked out in whole cents. Cents that cannot be divided evenly go
+to the largest remainders, ties to the lowest user id, so the shares always
+add up to the expense amount and the same input always gives the same split.
+
+Shares are only built here, never saved, so callers can write them with a
+single bulk_create.
+"""
+from decimal import Decimal
+from fractions import Fraction
+
+from .ledger import CENT, to_cents
+from .models import ExpenseShare
+
+EQUAL, SHARES, PERCENTAGE, EXACT = 'equal', 'shares', 'percentage', 'exact'
+SPLIT_MODES = (EQUAL, SHARES, PERCENTAGE, EXACT)
+HUNDRED = Decimal(100)
+
+
+class SplitError(ValueError):
+    pass
+
+
+def _cents(amount):
+    return int(to_cents(amount) * 100)
+
+
+def _distribute(total_cents, weights):
+    """Split ``total_cents`` in proportion to ``weights`` by largest remainder; returns a list of cents."""
+    weights = [Fraction(weight) for weight in weights]
+    weight_sum = sum(weights)
+    exact = [total_cents * weight / weight_sum for weight in weights]
+    cents = [int(value) for value in exact]
+    leftover = total_cents - sum(cents)
+    # Stable sort: equal remainders keep the caller's (user id) order
+    by_remainder = sorted(range(len(weights)), key=lambda index: exact[index] - cents[index], reverse=True)
+    for index in by_remainder[:leftover]:
+        cents[index] += 1
+    return cents
+
+
+def allocate(amount, mode, entries):
+    """
+    Split ``amount`` between participants according to ``mode``.
+
+    ``entries`` maps user id to the value for that mode (the weight, the
+    percentage or the exact amount); for ``equal`` it may be any iterable of
+    user ids. Returns ``[(user_id, amount_owed)]`` ordered by user id, and
+    raises SplitError for values the mode does not accept.
+    """
+    if mode not in SPLIT_MODES:
+        raise SplitError(f"Unknown split mode '{mode}'")
+    if mode == EQUAL:
+        user_ids = sorted(set(entries))
+        values = [1] * len(user_ids)
+    else:
+        user_ids = sorted(entries)
+        values = [Decimal(entries[user_id]) for user_id in user_ids]
+    if not user_ids:
+        raise SplitError('At least one participant is required')
+    if any(value < 0 for value in values):
+        raise SplitError('Split values cannot be negative')
+
+    total_cents = _cents(amount)
+    if mode == EXACT:
+        if any(value != to_cents(value) for value in values):
+            raise SplitError('Exact amounts cannot have more than 2 decimal places')
+        cents = [_cents(value) for value in values]
+        if sum(cents) != total_cents:
+            raise SplitError(f'Exact amounts add up to {sum(values)}, not {to_cents(amount)}')
+    elif mode == PERCENTAGE:
+        if sum(values) != HUNDRED:
+            raise SplitError(f'Percentages add up to {sum(values)}, not 100')
+        cents = _distribute(total_cents, values)
+    else:
+        if not any(values):
+            raise SplitError('At least one share must be greater than zero')
+        cents = _distribute(total_cents, values)
+    return [(user_id, Decimal(value).scaleb(-2)) for user_id, value in zip(user_ids, cents)]
+
+
+def allocate_for_group(amount, mode, entries, member_ids):
+    """
+    ``allocate()`` for a new expense in a group with members ``member_ids``.
+
+    ``entries`` is the validated ``split`` list of ``{'user', 'value'}``; when
+    it is None the whole group splits equally.
+    """
+    if entries is None:
+        if mode != EQUAL:
+            raise SplitError(f"A '{mode}' split needs a list of participants and values")
+        return allocate(amount, EQUAL, member_ids)
+    user_ids = [entry['user'] for entry in entries]
+    if len(set(user_ids)) != len(user_ids):
+        raise SplitError('Each participant can only be listed once')
+    outsiders = sorted(set(user_ids) - set(member_ids))
+    if outsiders:
+        raise SplitError(f"User(s) {', '.join(map(str, outsiders))} are not members of this group")
+    if mode == EQUAL:
+        return allocate(amount, EQUAL, user_ids)
+    if any('value' not in entry for entry in entries):
+        raise SplitError(f"A '{mode}' split needs a value for every participant")
+    return allocate(amount, mode, {entry['user']: entry['value'] for entry in entries})
+
+
+def reallocate(amount, shares):
+    """
+    ``allocate()`` of a new ``amount`` between the participants of an existing split.
+
+    ``shares`` is the current ``[(user_id, amount_owed)]``. A split whose
+    shares are at most a cent apart is split equally again; any other keeps
+    its proportions, which is exact for ``shares`` and ``percentage`` splits
+    up to the cents.
+    """
+    shares = [(user_id, to_cents(amount_owed)) for user_id, amount_owed in shares]
+    if not shares:
+        raise SplitError('The expense has no participants to split the new amount between')
+    amounts = [amount_owed for _, amount_owed in shares]
+    if max(amounts) - min(amounts) <= CENT:
+        return allocate(amount, EQUAL, [user_id for user_id, _ in shares])
+    return allocate(amount, SHARES, dict(shares))
+
+
+def build_shares(expense, allocation):
+    """ExpenseShare rows for an ``allocate()`` result."""
+    return [ExpenseShare(expense=expense, user_id=user_id, amount_owed=amount_owed)
+            for user_id, amount_owed in allocation]
+
+
+def equal_shares(expense, user_ids):
+    """Split ``expense.amount`` equally between ``user_ids``."""
+    return build_shares(expense, allocate(expense.amount, EQUAL, user_ids))
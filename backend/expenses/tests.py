@@ -1,3 +1,1467 @@
-from django.test import TestCase
+import asyncio
+import json
+from base64 import urlsafe_b64encode
+from contextlib import contextmanager
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.http import HttpResponse
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase
+
+from . import archive, checks, events, exporter, fragments, ledger, metrics, query_plans, routers, splits
+from .authentication import TokenCache, token_cache
+from .middleware import ReplicaRoutingMiddleware
+from .models import (ArchivedExpense, BalanceSnapshot, EventPayload, Group, GroupBalance, Expense, ExpenseShare,
+                     Friend, FriendRequest, IdempotencyKey, Notification, Profile, Settlement, SpendingRollup)
+from .notifications import LocMemTransport
+from .push import issue_ticket, with_event_stream
+from .renderers import FastJSONRenderer, orjson
+from .serializers import GroupSerializer
+from .settlement import plan_settlements
+
+
+def seed_users(count, prefix='user'):
+    User.objects.bulk_create([User(username=f'{prefix}{i}') for i in range(count)])
+    return list(User.objects.filter(username__startswith=prefix).order_by('id'))
+
+
+def seed_group(creator, members, expenses=0, name='group'):
+    group = Group.objects.create(name=name, created_by=creator)
+    group.members.add(creator, *members)
+    participants = [creator, *members]
+    created = Expense.objects.bulk_create([
+        Expense(title=f'{name} expense {i}', amount=Decimal('12.00'), group=group, paid_by=creator)
+        for i in range(expenses)
+    ])
+    ExpenseShare.objects.bulk_create([
+        ExpenseShare(expense=expense, user=user, amount_owed=Decimal('12.00') / len(participants))
+        for expense in created for user in participants
+    ])
+    return group
+
+
+class SeededAPITestCase(APITestCase):
+    """A user in 51 groups (one with 40 members and 120 expenses), with friends and pending requests."""
+
+    @contextmanager
+    def assertQueryBudget(self, budget):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        queries = '\n'.join(query['sql'] for query in context.captured_queries)
+        self.assertLessEqual(len(context), budget,
+                             f'{len(context)} queries exceed the budget of {budget}:\n{queries}')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.members = seed_users(40)
+        cls.user = cls.members[0]
+        cls.groups = [seed_group(cls.user, cls.members[1 + i % 10:21 + i % 10], expenses=3, name=f'g{i}')
+                      for i in range(50)]
+        cls.big_group = seed_group(cls.user, cls.members[1:], expenses=120, name='big')
+        Friend.objects.bulk_create([Friend(user=cls.user, friend=friend) for friend in cls.members[1:]])
+        strangers = seed_users(30, prefix='stranger')
+        FriendRequest.objects.bulk_create([FriendRequest(from_user=other, to_user=cls.user)
+                                           for other in strangers])
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+
+class QueryBudgetTestCase(SeededAPITestCase):
+    """Every endpoint must run in a fixed number of queries, whatever the size of the data."""
+
+    def test_group_list(self):
+        with self.assertQueryBudget(2):
+            response = self.client.get('/api/groups/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 51)
+
+    def test_group_retrieve_and_details(self):
+        for url in (f'/api/groups/{self.big_group.id}/', f'/api/groups/{self.big_group.id}/details/'):
+            with self.assertQueryBudget(3):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['members']), 40)
+
+    def test_group_balances(self):
+        with self.assertQueryBudget(3):
+            response = self.client.get(f'/api/groups/{self.big_group.id}/balances/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['balances']), 40)
+
+    def test_group_settle_plan(self):
+        with self.assertQueryBudget(2):
+            response = self.client.get(f'/api/groups/{self.big_group.id}/settle_plan/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_group_expenses(self):
+        with self.assertQueryBudget(4):
+            response = self.client.get(f'/api/groups/{self.big_group.id}/expenses/?page_size=100')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 100)
+
+    def test_expense_list_and_retrieve(self):
+        with self.assertQueryBudget(3):
+            response = self.client.get(f'/api/expenses/?group={self.big_group.id}&page_size=100')
+        self.assertEqual(len(response.data['results']), 100)
+        with self.assertQueryBudget(2):
+            response = self.client.get('/api/expenses/?page_size=200')
+        self.assertEqual(len(response.data['results']), 200)
+
+        expense_id = response.data['results'][0]['id']
+        with self.assertQueryBudget(2):
+            response = self.client.get(f'/api/expenses/{expense_id}/')
+        self.assertEqual(len(response.data['participants']), 40)
+
+    def test_expense_create_does_not_grow_with_group_size(self):
+        counts = []
+        for group in (self.groups[0], self.big_group):
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post('/api/expenses/', {'title': 't', 'amount': '10.00', 'group': group.id})
+            self.assertEqual(response.status_code, 201)
+            counts.append(len(context))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_expense_batch_does_not_grow_with_batch_size(self):
+        counts = []
+        # Kept small enough that SQLite does not split the share insert into several statements
+        for size in (2, 12):
+            payload = [{'title': f'b{i}', 'amount': '3.00', 'group': self.groups[0].id} for i in range(size)]
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post('/api/expenses/batch/', payload, format='json')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(len(response.data), size)
+            counts.append(len(context))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_friend_list(self):
+        with self.assertQueryBudget(1):
+            response = self.client.get('/api/friends/')
+        self.assertEqual(len(response.data), 39)
+
+    def test_friend_request_list(self):
+        with self.assertQueryBudget(1):
+            response = self.client.get('/api/friendrequests/')
+        self.assertEqual(len(response.data), 30)
+
+
+class FriendGraphTestCase(APITestCase):
+    def befriend(self, user, *others):
+        Friend.objects.bulk_create([row for other in others
+                                    for row in (Friend(user=user, friend=other), Friend(user=other, friend=user))])
+
+    def setUp(self):
+        self.me, self.ann, self.ben, self.cat, self.dan, self.eve = seed_users(6)
+        self.befriend(self.me, self.ann, self.ben)
+        self.befriend(self.cat, self.ann, self.ben)
+        self.befriend(self.dan, self.ann)
+        seed_group(self.me, [self.eve, self.dan], name='flat')
+        self.client.force_authenticate(self.me)
+
+    def test_suggestions_rank_by_mutual_connections(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/friends/suggestions/')
+        self.assertEqual(len(context), 1)
+        ranked = [(entry['user']['username'], entry['mutual_friends'], entry['shared_groups'])
+                  for entry in response.data]
+        self.assertEqual(ranked, [(self.cat.username, 2, 0), (self.dan.username, 1, 1), (self.eve.username, 0, 1)])
+
+        FriendRequest.objects.create(from_user=self.me, to_user=self.cat)
+        response = self.client.get('/api/friends/suggestions/', {'limit': 1})
+        self.assertEqual([entry['user']['username'] for entry in response.data], [self.dan.username])
+
+    def test_mutual_friends(self):
+        response = self.client.get(f'/api/friends/{self.cat.id}/mutual/')
+        self.assertEqual([user['username'] for user in response.data], [self.ann.username, self.ben.username])
+        self.assertEqual(self.client.get('/api/friends/0/mutual/').status_code, 404)
+
+
+class UserSearchTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.me, self.stranger, self.colleague, self.friend = seed_users(4, prefix='sam')
+        User.objects.filter(pk=self.stranger.pk).update(first_name='Alex')
+        Friend.objects.create(user=self.me, friend=self.friend)
+        seed_group(self.me, [self.colleague])
+        self.client.force_authenticate(self.me)
+
+    def search(self, q, queries):
+        with self.assertNumQueries(queries):
+            response = self.client.get('/api/users/search/', {'q': q})
+        return [(entry['user']['username'], entry['is_friend'], entry['is_co_member']) for entry in response.data]
+
+    def test_friends_and_co_members_rank_first(self):
+        self.assertEqual(self.search('SAM', 1), [(self.friend.username, True, False),
+                                                (self.colleague.username, False, True),
+                                                (self.stranger.username, False, False)])
+        self.assertEqual(self.search('ale', 1), [(self.stranger.username, False, False)])
+
+    def test_results_leave_out_email_addresses(self):
+        User.objects.filter(pk=self.stranger.pk).update(email='alex@example.com')
+        response = self.client.get('/api/users/search/', {'q': 'a'})
+        self.assertTrue(response.data)
+        for entry in response.data:
+            self.assertEqual(set(entry['user']), {'id', 'username', 'first_name', 'last_name'})
+        self.assertNotIn(b'@example.com', response.content)
+
+    def test_longer_queries_reuse_a_complete_prefix(self):
+        self.search('sa', 1)
+        self.assertEqual(self.search('sam2', 0), [(self.colleague.username, False, True)])
+        self.assertEqual(self.search('', 0), [])
+
+
+class AsyncViewsTestCase(SeededAPITestCase):
+    """The async endpoints must return exactly what their synchronous counterparts do."""
+
+    async def test_async_reads_match_sync_views(self):
+        token = await Token.objects.acreate(user=self.user)
+        headers = {'Authorization': f'Token {token.key}'}
+        group = self.big_group.id
+        for sync_url, async_url in (('/api/groups/', '/api/async/groups/'),
+                                    (f'/api/groups/{group}/details/', f'/api/async/groups/{group}/details/'),
+                                    (f'/api/groups/{group}/balances/', f'/api/async/groups/{group}/balances/'),
+                                    (f'/api/expenses/?group={group}&page_size=7',
+                                     f'/api/async/expenses/?group={group}&page_size=7'),
+                                    ('/api/auth/profile/', '/api/async/auth/profile/')):
+            expected = await self.async_client.get(sync_url, headers=headers)
+            response = await self.async_client.get(async_url, headers=headers)
+            self.assertEqual(response.status_code, 200, async_url)
+            body = json.loads(response.content)
+            if 'next' in body:
+                body['next'] = body['next'].replace('/async', '')
+            self.assertEqual(body, json.loads(expected.content), async_url)
+
+    async def test_async_views_require_a_token(self):
+        self.assertEqual((await self.async_client.get('/api/async/groups/')).status_code, 401)
+        response = await self.async_client.get('/api/async/groups/', headers={'Authorization': 'Token nope'})
+        self.assertEqual(response.status_code, 401)
+
+
+class AsyncLoginTestCase(TransactionTestCase):
+    # Password hashing runs on a pool thread, which only sees committed rows
+
+    async def test_login_hashes_off_the_event_loop(self):
+        await sync_to_async(User.objects.create_user)(username='ann', password='secret')
+        response = await self.async_client.post('/api/async/auth/login/', {'username': 'ann', 'password': 'secret'},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(await Token.objects.filter(key=json.loads(response.content)['token']).aexists())
+        response = await self.async_client.post('/api/async/auth/login/', {'username': 'ann', 'password': 'nope'},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+
+class EventStreamTestCase(TransactionTestCase):
+    # Events go out on commit, so the writes must really commit
+
+    def setUp(self):
+        self.user, self.other, self.stranger = seed_users(3)
+        self.group = seed_group(self.user, [self.other])
+        self.other_group = seed_group(self.stranger, [], name='other')
+        self.token = Token.objects.create(user=self.user).key
+
+    async def connect(self, scope_type, query):
+        inbound, sent = asyncio.Queue(), []
+        scope = {'type': scope_type, 'path': '/api/events/', 'method': 'GET', 'headers': [],
+                 'query_string': query.encode()}
+
+        async def send(message):
+            sent.append(message)
+
+        if scope_type == 'websocket':
+            inbound.put_nowait({'type': 'websocket.connect'})
+        task = asyncio.create_task(with_event_stream(None)(scope, inbound.get, send))
+        return task, inbound, sent
+
+    async def wait_for(self, sent, predicate):
+        for _ in range(200):
+            if predicate(sent):
+                return
+            await asyncio.sleep(0.005)
+        self.fail(f'Timed out, got {sent}')
+
+    def post_expense(self, group):
+        return self.client.post('/api/expenses/', {'title': 'taxi', 'amount': '30.00', 'group': group.id},
+                                content_type='application/json', HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    async def test_server_sent_events(self):
+        response = await sync_to_async(self.client.post)('/api/events/ticket/',
+                                                         HTTP_AUTHORIZATION=f'Token {self.token}')
+        self.assertEqual(response.status_code, 200)
+        task, inbound, sent = await self.connect('http', f"ticket={response.json()['ticket']}&group={self.group.id}")
+        await self.wait_for(sent, lambda sent: len(sent) == 2)
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(dict(sent[0]['headers'])[b'content-type'], b'text/event-stream')
+        self.assertEqual(events.hub.stats()['connections'], 1)
+
+        response = await sync_to_async(self.post_expense)(self.group)
+        self.assertEqual(response.status_code, 201)
+        await self.wait_for(sent, lambda sent: len(sent) == 4)
+        added, balances = [json.loads(message['body'].decode().split('data: ')[1]) for message in sent[2:]]
+        self.assertEqual((added['type'], added['data']['title']), ('expense_added', 'taxi'))
+        # Both ledger writes of the request arrive as one event, after the expense
+        self.assertEqual(balances['type'], 'balances_changed')
+        self.assertEqual(balances['data']['balances'], {str(self.user.id): '15.00', str(self.other.id): '-15.00'})
+
+        inbound.put_nowait({'type': 'http.disconnect'})
+        await task
+        self.assertEqual(events.hub.stats()['connections'], 0)
+
+    async def test_websocket_only_receives_followed_groups(self):
+        task, inbound, sent = await self.connect('websocket', f'ticket={issue_ticket(self.user)}')
+        await self.wait_for(sent, lambda sent: sent)
+        self.assertEqual(sent[0]['type'], 'websocket.accept')
+
+        await sync_to_async(events.publish)(self.other_group.id, events.EXPENSE_DELETED, {'id': 1})
+        await sync_to_async(self.group.members.add)(self.stranger)
+        await self.wait_for(sent, lambda sent: len(sent) == 2)
+        self.assertEqual(json.loads(sent[1]['text']), {'group': self.group.id, 'type': 'member_joined',
+                                                       'data': {'users': [self.stranger.id]}})
+
+        inbound.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+        await task
+
+    @override_settings(EVENT_QUEUE_SIZE=3, EVENT_HEARTBEAT_SECONDS=0.02)
+    async def test_heartbeats_and_slow_clients(self):
+        task, inbound, sent = await self.connect('http', f'ticket={issue_ticket(self.user)}')
+        await self.wait_for(sent, lambda sent: any(message.get('body') == b': ping\n\n' for message in sent))
+        # More events than fit in the queue arrive before the stream gets to run
+        for number in range(5):
+            events.hub.dispatch({'group': self.group.id, 'type': events.EXPENSE_DELETED, 'data': {'id': number}})
+        await task
+        self.assertEqual(sent[-1], {'type': 'http.response.body', 'body': b''})
+        self.assertEqual(events.hub.stats()['connections'], 0)
+
+    async def test_removed_members_stop_receiving_the_group(self):
+        task, inbound, sent = await self.connect('websocket', f'ticket={issue_ticket(self.other)}')
+        await self.wait_for(sent, lambda sent: sent)
+        await sync_to_async(self.group.members.remove)(self.other)
+        await sync_to_async(events.publish)(self.group.id, events.EXPENSE_ADDED, {'id': 1})
+        await task
+        self.assertEqual(json.loads(sent[1]['text'])['type'], 'member_left')
+        self.assertEqual(sent[2:], [{'type': 'websocket.close', 'code': 4403}])
+        self.assertEqual(events.hub.stats()['connections'], 0)
+
+    async def assertClosedBy(self, change, user=None):
+        task, inbound, sent = await self.connect('websocket', f'ticket={issue_ticket(user or self.user)}')
+        await self.wait_for(sent, lambda sent: sent)
+        await sync_to_async(change)()
+        await asyncio.wait_for(task, 2)
+        self.assertEqual(sent[-1], {'type': 'websocket.close', 'code': 4403})
+        self.assertEqual(events.hub.stats()['connections'], 0)
+        return [json.loads(message['text']) for message in sent[1:-1]]
+
+    async def test_logging_out_closes_the_streams(self):
+        received = await self.assertClosedBy(lambda: self.client.post('/api/auth/logout/',
+                                                                      HTTP_AUTHORIZATION=f'Token {self.token}'))
+        self.assertEqual(received, [{'group': None, 'type': 'revoked', 'data': {'users': [self.user.id]}}])
+
+    async def test_deleting_the_user_closes_the_streams(self):
+        received = await self.assertClosedBy(self.other.delete, user=self.other)
+        self.assertEqual(received[-1]['type'], 'revoked')
+
+    async def test_deleting_the_group_closes_its_streams(self):
+        group_id = self.group.id
+        received = await self.assertClosedBy(self.group.delete)
+        self.assertEqual(received, [{'group': group_id, 'type': 'group_deleted', 'data': {}}])
+
+    async def test_rejected_connections(self):
+        cache.clear()
+        ticket = issue_ticket(self.user)
+        task, inbound, sent = await self.connect('http', f'ticket={ticket}')
+        await self.wait_for(sent, lambda sent: sent)
+        inbound.put_nowait({'type': 'http.disconnect'})
+        await task
+        # Tokens are not accepted in the URL, and tickets only work once
+        for query, status in (('', 401), (f'token={self.token}', 401), (f'ticket={ticket}', 401),
+                              (f'ticket={ticket[:-2]}', 401),
+                              (f'ticket={issue_ticket(self.user)}&group={self.other_group.id}', 404)):
+            task, _, sent = await self.connect('http', query)
+            await task
+            self.assertEqual(sent[0]['status'], status)
+        with override_settings(EVENT_TICKET_SECONDS=-1):
+            task, _, sent = await self.connect('http', f'ticket={issue_ticket(self.user)}')
+            await task
+            self.assertEqual(sent[0]['status'], 401)
+        task, _, sent = await self.connect('websocket', '')
+        await task
+        self.assertEqual(sent, [{'type': 'websocket.close', 'code': 4401}])
+
+
+class FailingBroker:
+    def publish(self, events):
+        raise ConnectionError('broker unavailable')
+
+
+class RecordingBroker:
+    def __init__(self):
+        self.sent = []
+
+    def publish(self, events):
+        self.sent.append([event['data']['id'] for event in events])
+
+
+class EventBrokerTestCase(APITestCase):
+    def setUp(self):
+        self.addCleanup(setattr, events, '_broker', None)
+
+    def test_large_events_are_sent_by_reference(self):
+        broker = events.PostgresBroker()
+        small = {'group': 1, 'type': events.EXPENSE_DELETED, 'data': {'id': 1}}
+        self.assertEqual(json.loads(broker.encode(small)), small)
+        large = {'group': 1, 'type': events.BALANCES_CHANGED,
+                 'data': {'balances': {str(user_id): '-1234.56' for user_id in range(1000)}}}
+        payload = broker.encode(large)
+        self.assertLess(len(payload.encode()), events.NOTIFY_LIMIT)
+        self.assertEqual(broker.decode(payload), large)
+        EventPayload.objects.all().delete()
+        self.assertIsNone(broker.decode(payload))
+
+    def test_events_of_a_rolled_back_transaction_are_dropped(self):
+        broker = events._broker = RecordingBroker()
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValueError), transaction.atomic():
+                events.publish(1, events.EXPENSE_DELETED, {'id': 1})
+                raise ValueError
+            with transaction.atomic():
+                events.publish(1, events.EXPENSE_DELETED, {'id': 2})
+                events.publish(1, events.EXPENSE_DELETED, {'id': 3})
+        self.assertEqual(broker.sent, [[2, 3]])
+
+    def test_broker_failures_do_not_fail_committed_writes(self):
+        events._broker = FailingBroker()
+        user, other = seed_users(2)
+        self.client.force_authenticate(user)
+        with self.assertLogs('expenses.events', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+            group = seed_group(user, [other])
+            response = self.client.post('/api/expenses/', {'title': 'taxi', 'amount': '30.00', 'group': group.id},
+                                        format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Expense.objects.filter(pk=response.data['id']).exists())
+
+
+class CachedTokenAuthenticationTestCase(APITestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user('alice', password='secret-pass')
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_cache_hit_skips_token_lookup(self):
+        self.client.get('/api/auth/profile/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/auth/profile/')
+        self.assertEqual(response.data['user']['username'], 'alice')
+
+    def test_logout_invalidates_token(self):
+        self.client.get('/api/auth/profile/')
+        self.assertEqual(self.client.post('/api/auth/logout/').status_code, 200)
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, 401)
+
+    def test_deactivation_invalidates_token(self):
+        self.client.get('/api/auth/profile/')
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/auth/profile/').status_code, 401)
+
+    def test_cache_is_bounded(self):
+        cache = TokenCache(max_size=2, ttl=60)
+        for key in 'abc':
+            cache.set(key, key)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), 'c')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class ExpensePaginationTestCase(APITestCase):
+    def setUp(self):
+        self.user, self.other = seed_users(2)
+        self.group = seed_group(self.user, [self.other])
+        self.client.force_authenticate(self.user)
+        same_day = timezone.make_aware(timezone.datetime(2024, 5, 1, 12))
+        dates = [same_day] * 7 + [same_day + timezone.timedelta(days=1), same_day - timezone.timedelta(days=1)]
+        Expense.objects.bulk_create([Expense(title=f'e{i}', amount=Decimal('1.00'), group=self.group,
+                                             paid_by=self.user, date=date) for i, date in enumerate(dates)])
+        self.expected = list(Expense.objects.filter(group=self.group).order_by('-date', '-id')
+                             .values_list('id', flat=True))
+
+    def page(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [expense['id'] for expense in response.data['results']], response.data
+
+    def test_cursors_walk_every_row_once_across_equal_dates(self):
+        pages = []
+        url = f'/api/expenses/?group={self.group.id}&page_size=2'
+        while url:
+            ids, data = self.page(url)
+            pages.append(ids)
+            url = data['next']
+        self.assertEqual([expense_id for ids in pages for expense_id in ids], self.expected)
+        self.assertEqual(len(pages), 5)
+
+        # And back again from the last page
+        back = [ids]
+        url = data['previous']
+        while url:
+            ids, data = self.page(url)
+            back.append(ids)
+            url = data['previous']
+        self.assertEqual(back, pages[::-1])
+
+    def test_bad_cursors_are_not_found(self):
+        url = f'/api/expenses/?group={self.group.id}&cursor='
+        for cursor in ('nope', 'eHx5fHo=', '2ZjZhw==', urlsafe_b64encode(b'2024-05-01T12:00:00|1|2').decode()):
+            with self.subTest(cursor):
+                self.assertEqual(self.client.get(url + cursor).status_code, 404)
+
+    def test_page_size_is_capped(self):
+        Expense.objects.bulk_create([Expense(title='bulk', amount=Decimal('1.00'), group=self.group,
+                                             paid_by=self.user) for _ in range(200)])
+        ids, data = self.page(f'/api/expenses/?group={self.group.id}&page_size=1000')
+        self.assertEqual(len(ids), 200)
+        self.assertIsNotNone(data['next'])
+        self.assertEqual(len(self.page(f'/api/expenses/?group={self.group.id}&page_size=0')[0]), 1)
+
+
+class DashboardTestCase(SeededAPITestCase):
+    def test_dashboard_in_one_request(self):
+        with self.assertQueryBudget(7):
+            response = self.client.get(f'/api/dashboard/?group={self.big_group.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['profile']['username'], self.user.username)
+        self.assertEqual(len(response.data['groups']), 51)
+        self.assertEqual(len(response.data['friends']), 39)
+        self.assertEqual(len(response.data['friend_requests']), 30)
+        self.assertEqual(len(response.data['expenses']['results']), 50)
+
+    def test_expenses_continue_in_the_expense_listing(self):
+        response = self.client.get(f'/api/dashboard/?include=expenses&group={self.big_group.id}&page_size=100')
+        next_link = response.data['expenses']['next']
+        self.assertTrue(next_link.startswith('http://testserver/api/expenses/?'), next_link)
+        following = self.client.get(next_link)
+        self.assertEqual(len(following.data['results']), 20)
+        self.assertFalse({expense['id'] for expense in following.data['results']}
+                         & {expense['id'] for expense in response.data['expenses']['results']})
+        self.assertEqual(self.client.get('/api/dashboard/?group=abc').status_code, 400)
+
+    def test_dashboard_include(self):
+        with self.assertQueryBudget(1):
+            response = self.client.get('/api/dashboard/?include=profile,friends')
+        self.assertEqual(set(response.data), {'profile', 'friends'})
+        self.assertEqual(set(self.client.get('/api/dashboard/?include=profile, friends').data), {'profile', 'friends'})
+        self.assertEqual(set(self.client.get('/api/dashboard/?include=groups,').data), {'groups'})
+        self.assertEqual(self.client.get('/api/dashboard/?include=nope').status_code, 400)
+
+
+class GroupETagTestCase(SeededAPITestCase):
+    def assertNotModified(self, url, etag, expected=True):
+        with self.assertQueryBudget(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code == 304, expected)
+        return response
+
+    def test_conditional_get_on_group_endpoints(self):
+        base = f'/api/groups/{self.big_group.id}/'
+        for url in (base, base + 'details/', base + 'expenses/', base + 'balances/',
+                    f'/api/expenses/?group={self.big_group.id}'):
+            etag = self.client.get(url)['ETag']
+            self.assertNotModified(url, etag)
+
+    def test_writes_change_the_etag(self):
+        url = f'/api/groups/{self.big_group.id}/details/'
+        etag = self.client.get(url)['ETag']
+
+        self.client.post('/api/expenses/', {'title': 't', 'amount': '4.00', 'group': self.big_group.id})
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        etag = self.client.get(url)['ETag']
+        self.big_group.members.remove(self.members[-1])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        etag = self.client.get(url)['ETag']
+        self.client.patch(f'/api/groups/{self.big_group.id}/', {'name': 'renamed'})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.data['name'], 'renamed')
+
+
+@override_settings(NOTIFICATION_TRANSPORTS={'locmem': 'expenses.notifications.LocMemTransport'})
+class NotificationOutboxTestCase(APITestCase):
+    def setUp(self):
+        LocMemTransport.outbox.clear()
+        self.payer, self.friend, self.quiet = seed_users(3)
+        Profile.objects.create(user=self.friend, email_notification=True)
+        Profile.objects.create(user=self.quiet)
+        self.group = seed_group(self.payer, [self.friend, self.quiet])
+        self.client.force_authenticate(self.payer)
+
+    def run_notifier(self):
+        call_command('run_notifier', once=True, stdout=StringIO())
+
+    def test_writes_only_enqueue(self):
+        self.client.post('/api/expenses/', {'title': 'Dinner', 'amount': '30.00', 'group': self.group.id})
+        self.assertEqual(list(Notification.objects.values_list('user__username', flat=True)), ['user1'])
+        self.assertEqual(LocMemTransport.outbox, [])
+
+    def test_worker_coalesces_per_user(self):
+        for title in ('Dinner', 'Taxi'):
+            self.client.post('/api/expenses/', {'title': title, 'amount': '30.00', 'group': self.group.id})
+        self.run_notifier()
+        self.assertEqual(len(LocMemTransport.outbox), 1)
+        self.assertIn('Dinner', LocMemTransport.outbox[0]['body'])
+        self.assertIn('Taxi', LocMemTransport.outbox[0]['body'])
+        self.assertFalse(Notification.objects.exists())
+
+    @override_settings(NOTIFICATION_TRANSPORTS={'failing': 'expenses.notifications.FailingTransport'})
+    def test_failed_delivery_is_retried_later(self):
+        self.client.post('/api/expenses/', {'title': 'Dinner', 'amount': '30.00', 'group': self.group.id})
+        self.run_notifier()
+        notification = Notification.objects.get()
+        self.assertEqual(notification.attempts, 1)
+        self.assertGreater(notification.available_at, timezone.now())
+        self.assertEqual(notification.status, Notification.STATUS_PENDING)
+
+    @override_settings(NOTIFICATION_TRANSPORTS={'locmem': 'expenses.notifications.LocMemTransport',
+                                                'failing': 'expenses.notifications.FailingTransport'})
+    def test_retries_skip_transports_that_succeeded(self):
+        self.client.post('/api/expenses/', {'title': 'Dinner', 'amount': '30.00', 'group': self.group.id})
+        self.run_notifier()
+        notification = Notification.objects.get()
+        self.assertEqual((notification.attempts, notification.delivered_via), (1, ['locmem']))
+        self.assertEqual(len(LocMemTransport.outbox), 1)
+
+        # A later notification for the same user is sent once, without the one already delivered
+        self.client.post('/api/expenses/', {'title': 'Taxi', 'amount': '9.00', 'group': self.group.id})
+        Notification.objects.update(available_at=timezone.now())
+        self.run_notifier()
+        self.assertEqual(len(LocMemTransport.outbox), 2)
+        self.assertNotIn('Dinner', LocMemTransport.outbox[1]['body'] + LocMemTransport.outbox[1]['subject'])
+        self.assertEqual(sorted(Notification.objects.values_list('attempts', flat=True)), [1, 2])
+        self.assertEqual({tuple(via) for via in Notification.objects.values_list('delivered_via', flat=True)},
+                         {('locmem',)})
+
+
+class GroupExportTestCase(SeededAPITestCase):
+    def test_csv_export_streams_every_share(self):
+        # The group, then the live and the archived expenses
+        with self.assertQueryBudget(3):
+            response = self.client.get(f'/api/groups/{self.big_group.id}/export/?format=csv')
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(lines[0].split(','), exporter.CSV_HEADER)
+        self.assertEqual(len(lines), 1 + 120 * 40)
+
+    def test_ndjson_export_nests_shares(self):
+        response = self.client.get(f'/api/groups/{self.big_group.id}/export/?format=ndjson')
+        expenses = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(expenses), 120)
+        self.assertEqual(len(expenses[0]['shares']), 40)
+
+    def test_export_requires_membership(self):
+        self.client.force_authenticate(User.objects.create_user('outsider'))
+        response = self.client.get(f'/api/groups/{self.big_group.id}/export/?format=csv')
+        self.assertEqual(response.status_code, 404)
+
+
+class LedgerTestCase(APITestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = seed_users(3)
+        self.group = Group.objects.create(name='flat', created_by=self.alice)
+        self.group.members.add(self.alice, self.bob, self.carol)
+
+    def balances(self):
+        return dict(GroupBalance.objects.filter(group=self.group).values_list('user_id', 'balance'))
+
+    def assertConsistent(self):
+        """Balances add up to zero and match a rebuild from the expense tables, as do the rollups."""
+        balances = self.balances()
+        self.assertEqual(sum(balances.values()), 0)
+        rollups = set(SpendingRollup.objects.filter(group=self.group)
+                      .values_list('month', 'user_id', 'category', 'paid', 'owed', 'expense_count'))
+        self.group.refresh_from_db()
+        total = self.group.total_expenses
+        ledger.rebuild_group(self.group)
+        call_command('rebuild_rollups', group=[self.group.id], stdout=StringIO())
+        self.group.refresh_from_db()
+        self.assertEqual((self.balances(), self.group.total_expenses), (balances, total))
+        self.assertEqual(set(SpendingRollup.objects.filter(group=self.group)
+                             .values_list('month', 'user_id', 'category', 'paid', 'owed', 'expense_count')), rollups)
+        return balances
+
+    def add_expense(self, payer, amount, date=None):
+        self.client.force_authenticate(payer)
+        response = self.client.post('/api/expenses/', {'title': 'e', 'amount': amount, 'group': self.group.id},
+                                    format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        expense = Expense.objects.get(pk=response.data['id'])
+        if date is not None:
+            expense.date = date
+            expense.save()
+        return expense
+
+    def test_expense_writes_keep_balances_in_step(self):
+        dinner = self.add_expense(self.alice, '30.00')
+        self.assertEqual(self.assertConsistent(), {self.alice.id: Decimal('20.00'), self.bob.id: Decimal('-10.00'),
+                                                   self.carol.id: Decimal('-10.00')})
+        taxi = self.add_expense(self.bob, '12.00')
+        self.client.force_authenticate(self.alice)
+        self.client.patch(f'/api/expenses/{dinner.id}/', {'amount': '45.00', 'title': 'Dinner'}, format='json')
+        self.assertEqual(self.assertConsistent()[self.alice.id], Decimal('26.00'))
+
+        self.client.force_authenticate(self.bob)
+        self.client.delete(f'/api/expenses/{taxi.id}/')
+        self.assertEqual(self.assertConsistent(), {self.alice.id: Decimal('30.00'), self.bob.id: Decimal('-15.00'),
+                                                   self.carol.id: Decimal('-15.00')})
+
+    def test_deleting_a_user_keeps_balances_adding_up(self):
+        self.add_expense(self.alice, '30.00', date=timezone.make_aware(timezone.datetime(2024, 1, 10)))
+        self.add_expense(self.bob, '60.00', date=timezone.make_aware(timezone.datetime(2024, 1, 20)))
+        dinner = self.add_expense(self.alice, '9.00')
+        self.add_expense(self.bob, '6.00')
+        self.add_expense(self.carol, '3.00')
+        Settlement.objects.create(group=self.group, from_user=self.bob, to_user=self.alice, amount=Decimal('2.00'))
+        archive.compact(self.group, timezone.make_aware(timezone.datetime(2024, 2, 1)))
+        self.assertConsistent()
+
+        self.bob.delete()
+        # Bob's debts are forgiven by the payers, and nobody owes anything for what he paid
+        balances = self.assertConsistent()
+        self.assertEqual(balances, {self.alice.id: Decimal('12.00'), self.carol.id: Decimal('-12.00')})
+        self.assertEqual(sum(dinner.expenseshare_set.values_list('amount_owed', flat=True)), dinner.amount)
+        snapshot = BalanceSnapshot.objects.get(group=self.group)
+        self.assertEqual(sum(snapshot.entries.values_list('balance', flat=True)), 0)
+        self.assertEqual(snapshot.total_expenses, Decimal('90.00'))
+
+
+class SettlementTestCase(APITestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = seed_users(3)
+        self.group = Group.objects.create(name='flat', created_by=self.alice)
+        self.group.members.add(self.alice, self.bob, self.carol)
+        self.client.force_authenticate(self.alice)
+        self.client.post('/api/expenses/', {'title': 'Rent', 'amount': '90.00', 'group': self.group.id},
+                         format='json')
+
+    def balances(self):
+        return dict(GroupBalance.objects.filter(group=self.group).values_list('user_id', 'balance'))
+
+    def test_plan_clears_every_balance(self):
+        balances = {1: Decimal('70.05'), 2: Decimal('-20.01'), 3: Decimal('-35.02'), 4: Decimal('5.00'),
+                    5: Decimal('-20.02'), 6: Decimal('0')}
+        transfers = plan_settlements(balances)
+        self.assertLessEqual(len(transfers), 4)
+        for transfer in transfers:
+            self.assertGreater(transfer.amount, 0)
+            balances[transfer.from_user] += transfer.amount
+            balances[transfer.to_user] -= transfer.amount
+        self.assertEqual(set(balances.values()), {0})
+
+    def test_paying_the_plan_settles_the_group(self):
+        response = self.client.get(f'/api/groups/{self.group.id}/settle_plan/')
+        transfers = response.data['transfers']
+        self.assertEqual(sorted((t['from_user']['id'], t['to_user']['id'], t['amount']) for t in transfers),
+                         [(self.bob.id, self.alice.id, '30.00'), (self.carol.id, self.alice.id, '30.00')])
+
+        payments = [{'from_user': t['from_user']['id'], 'to_user': t['to_user']['id'], 'amount': t['amount']}
+                    for t in transfers]
+        response = self.client.post(f'/api/groups/{self.group.id}/settle/', {'payments': payments}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Settlement.objects.filter(group=self.group).count(), 2)
+        self.assertEqual(set(self.balances().values()), {0})
+        self.assertEqual(self.client.get(f'/api/groups/{self.group.id}/settle_plan/').data['transfers'], [])
+
+    def test_single_payment_updates_balances(self):
+        self.client.force_authenticate(self.bob)
+        response = self.client.post(f'/api/groups/{self.group.id}/settle/',
+                                    {'to_user': self.alice.id, 'amount': '12.50'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.balances(), {self.alice.id: Decimal('47.50'), self.bob.id: Decimal('-17.50'),
+                                           self.carol.id: Decimal('-30.00')})
+
+    def test_invalid_payments_are_rejected(self):
+        outsider = User.objects.create_user('outsider')
+        url = f'/api/groups/{self.group.id}/settle/'
+        for payment in ({'to_user': self.bob.id, 'amount': '-5'}, {'to_user': self.bob.id, 'amount': '0'},
+                        {'to_user': self.bob.id, 'amount': '1.005'}, {'to_user': self.bob.id, 'amount': 'ten'},
+                        {'amount': '5'}, {'to_user': self.alice.id, 'amount': '5'},
+                        {'to_user': outsider.id, 'amount': '5'}):
+            response = self.client.post(url, payment, format='json')
+            self.assertEqual(response.status_code, 400, payment)
+        self.assertEqual(self.client.post(url, {'payments': []}, format='json').status_code, 400)
+        for body in ([{'to_user': self.bob.id, 'amount': '5'}], {'payments': [7]}, {'payments': 'all'}):
+            self.assertEqual(self.client.post(url, body, format='json').status_code, 400, body)
+        for amount in ('NaN', 'Infinity', '-Infinity', 'sNaN', '1e400'):
+            response = self.client.post(url, {'to_user': self.bob.id, 'amount': amount}, format='json')
+            self.assertEqual(response.status_code, 400, amount)
+
+        self.client.force_authenticate(self.bob)
+        response = self.client.post(url, {'from_user': self.carol.id, 'to_user': self.alice.id, 'amount': '5'},
+                                    format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Settlement.objects.exists())
+        self.assertEqual(self.balances()[self.alice.id], Decimal('60.00'))
+
+
+class ImportTestCase(APITestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = (User.objects.create_user(name) for name in ('alice', 'bob', 'carol'))
+        self.group = Group.objects.create(name='trip', created_by=self.alice)
+        self.group.members.add(self.alice, self.bob, self.carol)
+        self.client.force_authenticate(self.alice)
+
+    def upload(self, name, content):
+        return self.client.post(f'/api/groups/{self.group.id}/import/',
+                                {'file': SimpleUploadedFile(name, content.encode())}, format='multipart')
+
+    def run_command(self, group, content, name='expenses.csv', **options):
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / name
+            path.write_text(content)
+            stdout, stderr = StringIO(), StringIO()
+            call_command('import_expenses', group.id, str(path), stdout=stdout, stderr=stderr, **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def balances(self):
+        return dict(GroupBalance.objects.filter(group=self.group).values_list('user_id', 'balance'))
+
+    def test_csv_upload_books_expenses_and_reports_bad_rows(self):
+        response = self.upload('expenses.csv', 'title,amount,paid_by,participants\n'
+                                               'Hotel,90.00,bob,\n'
+                                               'Taxi,-5.00,,\n'
+                                               'Museum,20.00,mallory,\n'
+                                               'Lunch,12.00,,alice;carol\n')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['imported'], response.data['failed']), (2, 2))
+        self.assertEqual([(error['row'], set(error['errors'])) for error in response.data['errors']],
+                         [(2, {'amount'}), (3, {'paid_by'})])
+        self.assertEqual(self.balances(), {self.alice.id: Decimal('-24.00'), self.bob.id: Decimal('60.00'),
+                                           self.carol.id: Decimal('-36.00')})
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.total_expenses, Decimal('102.00'))
+
+    def test_ndjson_upload_reports_lines_that_are_not_objects(self):
+        response = self.upload('expenses.ndjson', '{"title": "Hotel", "amount": "90.00"}\n'
+                                                  '\n'
+                                                  '{"title": "Taxi", \n'
+                                                  '["Museum", "20.00"]\n'
+                                                  '{"title": "Lunch", "amount": "12.00", "date": "2024-03-01"}\n')
+        self.assertEqual((response.data['imported'], response.data['failed']), (2, 2))
+        self.assertEqual([error['row'] for error in response.data['errors']], [3, 4])
+        self.assertEqual(sorted(Expense.objects.filter(group=self.group).values_list('title', flat=True)),
+                         ['Hotel', 'Lunch'])
+        self.assertEqual(sum(self.balances().values()), 0)
+
+    def test_upload_requires_a_supported_file(self):
+        self.assertEqual(self.client.post(f'/api/groups/{self.group.id}/import/', {}, format='multipart')
+                         .status_code, 400)
+        response = self.client.post(f'/api/groups/{self.group.id}/import/',
+                                    {'file': SimpleUploadedFile('expenses.xls', b''), 'format': 'xls'},
+                                    format='multipart')
+        self.assertEqual(response.status_code, 400)
+
+    def test_command_writes_in_chunks(self):
+        rows = ''.join(f'Expense {i},{3 * i}.00\n' for i in range(1, 6))
+        stdout, stderr = self.run_command(self.group, 'title,amount\n' + rows + ',3.00\n',
+                                          paid_by='carol', chunk_size=2)
+        self.assertIn('Imported 5 expense(s), 1 failed', stdout)
+        self.assertIn('row 6: {"title"', stderr)
+        self.assertEqual(Expense.objects.filter(group=self.group).count(), 5)
+        self.assertEqual(self.balances(), {self.alice.id: Decimal('-15.00'), self.bob.id: Decimal('-15.00'),
+                                           self.carol.id: Decimal('30.00')})
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.total_expenses, Decimal('45.00'))
+
+    def test_payers_must_be_members(self):
+        # The creator can still import after leaving the group, but not as the default payer
+        self.group.members.remove(self.alice)
+        response = self.upload('expenses.csv', 'title,amount,paid_by\nHotel,90.00,\nTaxi,12.00,bob\nBus,3.00,alice\n')
+        self.assertEqual((response.data['imported'], response.data['failed']), (1, 2))
+        self.assertEqual([(error['row'], set(error['errors'])) for error in response.data['errors']],
+                         [(1, {'paid_by'}), (3, {'paid_by'})])
+        self.assertEqual(set(Expense.objects.filter(group=self.group).values_list('paid_by', flat=True)),
+                         {self.bob.id})
+        self.assertEqual(set(self.balances()), {self.bob.id, self.carol.id})
+
+    def test_command_rejects_unknown_groups_and_payers(self):
+        User.objects.create_user('dave')
+        with self.assertRaisesMessage(CommandError, 'Group 0 not found'):
+            call_command('import_expenses', 0, 'expenses.csv', paid_by='alice')
+        with self.assertRaisesMessage(CommandError, "User 'mallory' not found"):
+            call_command('import_expenses', self.group.id, 'expenses.csv', paid_by='mallory')
+        with self.assertRaisesMessage(CommandError, f"User 'dave' is not a member of group {self.group.id}"):
+            call_command('import_expenses', self.group.id, 'expenses.csv', paid_by='dave')
+
+
+class GroupStatsTestCase(APITestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = (User.objects.create_user(name) for name in ('alice', 'bob', 'carol'))
+        self.group = Group.objects.create(name='trip', created_by=self.alice)
+        self.group.members.add(self.alice, self.bob, self.carol)
+        self.client.force_authenticate(self.alice)
+        self.url = f'/api/groups/{self.group.id}/stats/'
+
+    def add_expense(self, payer, amount, month, icon='food'):
+        expense = Expense.objects.create(title='e', amount=Decimal(amount), group=self.group, paid_by=payer,
+                                         icon=icon, date=timezone.make_aware(timezone.datetime(2024, month, 15)))
+        for user in (self.alice, self.bob, self.carol):
+            ExpenseShare.objects.create(expense=expense, user=user, amount_owed=Decimal(amount) / 3)
+        return expense
+
+    def stats(self, **params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(context), 4)
+        return response.data
+
+    def test_stats_by_month_category_and_member(self):
+        self.add_expense(self.alice, '30.00', 1)
+        self.add_expense(self.bob, '60.00', 2, icon='travel')
+        self.add_expense(self.bob, '9.00', 3)
+        self.client.post('/api/expenses/batch/', [{'title': 'x', 'amount': '3.00', 'group': self.group.id}],
+                         format='json')
+
+        data = self.stats()
+        self.assertEqual(data['total'], '102.00')
+        self.assertEqual(data['expense_count'], 4)
+        self.assertEqual([entry['month'] for entry in data['by_month']][:3], ['2024-01', '2024-02', '2024-03'])
+        self.assertEqual(data['by_category'][0], {'category': 'travel', 'total': '60.00', 'expense_count': 1})
+        self.assertEqual(data['top_spenders'][0]['user']['username'], self.bob.username)
+        self.assertEqual(data['top_spenders'][0]['paid'], '69.00')
+        self.assertEqual({entry['owed'] for entry in data['by_member']}, {'34.00'})
+
+        data = self.stats(start='2024-02', end='2024-02-28')
+        self.assertEqual(data['total'], '60.00')
+        self.assertEqual(self.client.get(self.url, {'start': 'soon'}).status_code, 400)
+
+    def test_top_is_bounded(self):
+        self.add_expense(self.alice, '30.00', 1)
+        self.add_expense(self.bob, '60.00', 2)
+        self.assertEqual(len(self.stats(top=1)['top_spenders']), 1)
+        for top in ('0', '-1', '101', 'many'):
+            self.assertEqual(self.client.get(self.url, {'top': top}).status_code, 400)
+
+    def test_writes_keep_rollups_in_step_with_rebuild(self):
+        moved = self.add_expense(self.alice, '30.00', 1)
+        removed = self.add_expense(self.bob, '60.00', 2)
+        moved.date = timezone.make_aware(timezone.datetime(2024, 5, 1))
+        moved.icon = 'travel'
+        moved.save()
+        removed.delete()
+        ExpenseShare.objects.filter(expense=moved, user=self.carol).delete()
+
+        incremental = self.stats()
+        self.assertEqual(incremental['total'], '30.00')
+        self.assertEqual(incremental['by_month'], [{'month': '2024-05', 'total': '30.00', 'expense_count': 1}])
+        call_command('rebuild_rollups', group=[self.group.id], stdout=StringIO())
+        self.assertEqual(self.stats(), incremental)
+
+    def test_expenses_without_a_payer_share_one_bucket(self):
+        self.add_expense(None, '30.00', 1)
+        self.add_expense(None, '6.00', 1)
+        unassigned = SpendingRollup.objects.get(group=self.group, user=None)
+        self.assertEqual((unassigned.paid, unassigned.expense_count), (Decimal('36.00'), 2))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            SpendingRollup.objects.create(group=self.group, month=unassigned.month, category=unassigned.category)
+
+
+class CompactionTestCase(APITestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = (User.objects.create_user(name) for name in ('alice', 'bob', 'carol'))
+        self.group = Group.objects.create(name='trip', created_by=self.alice)
+        self.group.members.add(self.alice, self.bob, self.carol)
+        for month, payer, amount in [(1, self.alice, '30.00'), (1, self.bob, '10.00'), (2, self.carol, '45.00'),
+                                     (3, self.bob, '9.00'), (6, self.alice, '12.00')]:
+            expense = Expense.objects.create(title=f'e{month}', amount=Decimal(amount), group=self.group,
+                                             paid_by=payer,
+                                             date=timezone.make_aware(timezone.datetime(2024, month, 15)))
+            for user in (self.alice, self.bob, self.carol):
+                ExpenseShare.objects.create(expense=expense, user=user, amount_owed=Decimal(amount) / 3)
+        self.client.force_authenticate(self.alice)
+
+    def state(self):
+        self.group.refresh_from_db()
+        balances = dict(GroupBalance.objects.filter(group=self.group).values_list('user_id', 'balance'))
+        rollups = set(SpendingRollup.objects.filter(group=self.group)
+                      .values_list('month', 'user_id', 'category', 'paid', 'owed', 'expense_count'))
+        return balances, self.group.total_expenses, rollups
+
+    def export(self):
+        response = self.client.get(f'/api/groups/{self.group.id}/export/?format=ndjson')
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_compaction_keeps_balances_totals_and_exports(self):
+        before = self.state()
+        exported = self.export()
+        self.assertEqual(archive.compact(self.group, timezone.make_aware(timezone.datetime(2024, 4, 1))),
+                         (4, True))
+
+        self.assertEqual(self.state(), before)
+        self.assertEqual(Expense.objects.filter(group=self.group).count(), 1)
+        self.assertEqual(ArchivedExpense.objects.filter(group=self.group).count(), 4)
+        snapshot = BalanceSnapshot.objects.get(group=self.group)
+        self.assertEqual((snapshot.total_expenses, snapshot.expense_count), (Decimal('94.00'), 4))
+        self.assertEqual(self.export(), exported)
+
+        # Rebuilding from the snapshot and the live tables gives the same ledger and rollups
+        ledger.rebuild_group(self.group)
+        call_command('rebuild_rollups', group=[self.group.id], stdout=StringIO())
+        self.assertEqual(self.state(), before)
+
+        # Later writes are booked on top
+        response = self.client.post('/api/expenses/', {'title': 'x', 'amount': '6.00', 'group': self.group.id,
+                                                       'participants': [self.bob.id, self.carol.id]},
+                                    format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        incremental = self.state()
+        ledger.rebuild_group(self.group)
+        self.assertEqual(self.state(), incremental)
+
+    def test_chunk_queries_do_not_grow_with_its_expenses(self):
+        cutoff = timezone.make_aware(timezone.datetime(2024, 4, 1))
+        # The first chunk also creates the snapshot and its entries
+        archive.archive_chunk(self.group, cutoff, chunk_size=1)
+        with CaptureQueriesContext(connection) as one:
+            self.assertEqual(archive.archive_chunk(self.group, cutoff, chunk_size=1), 1)
+        with CaptureQueriesContext(connection) as two:
+            self.assertEqual(archive.archive_chunk(self.group, cutoff, chunk_size=2), 2)
+        self.assertEqual(len(two), len(one))
+        self.assertLessEqual(len(one), 16)
+
+    def test_command_resumes_in_chunks(self):
+        before = self.state()
+        out = StringIO()
+        call_command('compact_groups', before='2024-04', chunk_size=1, max_chunks=2, stdout=out)
+        self.assertIn('more left', out.getvalue())
+        self.assertEqual(ArchivedExpense.objects.count(), 2)
+        self.assertIsNone(BalanceSnapshot.objects.get(group=self.group).archived_before)
+
+        call_command('compact_groups', before='2024-04', chunk_size=3, stdout=StringIO())
+        self.assertEqual(ArchivedExpense.objects.count(), 4)
+        self.assertEqual(BalanceSnapshot.objects.get(group=self.group).archived_before,
+                         timezone.make_aware(timezone.datetime(2024, 4, 1)))
+        self.assertEqual(self.state(), before)
+        # Nothing changed in the meantime, so there is nothing left to archive
+        call_command('compact_groups', before='2024-04', stdout=out)
+        self.assertEqual(ArchivedExpense.objects.count(), 4)
+
+        # An expense back-dated past the cutoff later on is picked up by the next run
+        late = Expense.objects.create(title='late', amount=Decimal('3.00'), group=self.group, paid_by=self.carol,
+                                      date=timezone.make_aware(timezone.datetime(2024, 2, 1)))
+        ExpenseShare.objects.create(expense=late, user=self.alice, amount_owed=Decimal('3.00'))
+        before = self.state()
+        call_command('compact_groups', before='2024-04', stdout=StringIO())
+        self.assertTrue(ArchivedExpense.objects.filter(pk=late.pk).exists())
+        self.assertFalse(Expense.objects.filter(pk=late.pk).exists())
+        self.assertEqual(self.state(), before)
+        ledger.rebuild_group(self.group)
+        self.assertEqual(self.state(), before)
+
+        with self.assertRaises(CommandError):
+            call_command('compact_groups', before='soon', stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('compact_groups', group=[0], stdout=StringIO())
+
+
+class IdempotencyKeyTestCase(APITestCase):
+    def setUp(self):
+        self.user, self.other = seed_users(2)
+        self.group = seed_group(self.user, [self.other])
+        self.client.force_authenticate(self.user)
+
+    def post(self, url, data, key):
+        return self.client.post(url, data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_without_running_the_view(self):
+        data = {'title': 'taxi', 'amount': '20.00', 'group': self.group.id}
+        first = self.post('/api/expenses/', data, 'abc')
+        with CaptureQueriesContext(connection) as context:
+            retry = self.post('/api/expenses/', data, 'abc')
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertFalse([query for query in context.captured_queries if 'expenses_expense' in query['sql']])
+        self.assertEqual(Expense.objects.filter(group=self.group).count(), 1)
+
+        self.assertEqual(self.post('/api/expenses/', {**data, 'amount': '5.00'}, 'abc').status_code, 422)
+        # Keys belong to one user
+        self.client.force_authenticate(self.other)
+        self.assertEqual(self.post('/api/expenses/', data, 'abc').status_code, 201)
+        self.assertEqual(Expense.objects.filter(group=self.group).count(), 2)
+
+    def test_error_responses_are_replayed_and_keys_expire(self):
+        first = self.post('/api/groups/join/', {'group_id': self.group.id}, 'join-1')
+        self.assertEqual(first.status_code, 400)
+        self.assertEqual(self.post('/api/groups/join/', {'group_id': self.group.id}, 'join-1').data, first.data)
+
+        IdempotencyKey.objects.update(created_at=timezone.now() - timezone.timedelta(days=2))
+        call_command('purge_idempotency_keys', stdout=StringIO())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class MetricsTestCase(APITestCase):
+    def setUp(self):
+        metrics.registry.reset()
+        self.user, self.other = seed_users(2)
+        self.group = seed_group(self.user, [self.other], expenses=2)
+        self.client.force_authenticate(self.user)
+
+    def test_requests_are_recorded_per_view(self):
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(f'/api/groups/{self.group.id}/balances/')
+        # The next request resets the query log
+        queries = len(context)
+        self.client.get('/api/no-such-page/')
+
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        admin = User.objects.create_superuser('admin', password='x')
+        self.client.force_authenticate(admin)
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode()
+        labels = 'view="group-balances",method="GET"'
+        self.assertIn(f'dung_http_requests_total{{{labels},status="200"}} 1', body)
+        self.assertIn(f'dung_http_request_duration_seconds_count{{{labels}}} 1', body)
+        self.assertIn(f'dung_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 1', body)
+        self.assertIn(f'dung_http_db_queries_total{{{labels}}} {queries}', body)
+        self.assertIn('view="unmatched",method="GET",status="404"', body)
+        self.assertIn('dung_token_cache_hits_total', body)
+        self.assertIn('dung_fragment_cache_hits_total{kind="group"}', body)
+
+    async def test_async_requests_are_recorded(self):
+        token = await Token.objects.acreate(user=self.user)
+        response = await self.async_client.get('/api/async/groups/', headers={'Authorization': f'Token {token.key}'})
+        self.assertEqual(response.status_code, 200)
+        body = metrics.registry.render()
+        self.assertIn('dung_http_requests_total{view="async_group_list",method="GET",status="200"} 1', body)
+        self.assertNotIn('dung_http_db_queries_total{view="async_group_list",method="GET"} 0', body)
+
+    @override_settings(DEBUG=True)
+    def test_async_views_run_without_thread_adapters(self):
+        # Django logs every sync-only middleware it has to wrap in sync_to_async under ASGI
+        with self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()
+
+    @override_settings(SLOW_REQUEST_MS=0)
+    def test_slow_requests_are_logged_with_their_queries(self):
+        with self.assertLogs('expenses.slow_requests', 'WARNING') as logs:
+            self.client.get(f'/api/groups/{self.group.id}/balances/')
+        self.assertIn('group-balances', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+
+class FragmentCacheTestCase(APITestCase):
+    def setUp(self):
+        for cache in (fragments.group_fragments, fragments.user_fragments):
+            cache.clear()
+            # Ids are reused once the test's transaction rolls back
+            self.addCleanup(cache.clear)
+        self.user, self.other, self.newcomer = seed_users(3)
+        self.groups = [seed_group(self.user, [self.other], name=f'g{i}') for i in range(3)]
+        self.client.force_authenticate(self.user)
+
+    def get_groups(self):
+        # Fragments are stored when the request's transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get('/api/groups/')
+        return {group['id']: group for group in response.data}
+
+    def test_responses_are_assembled_from_cached_fragments(self):
+        expected = GroupSerializer(Group.objects.filter(pk__in=[group.id for group in self.groups]), many=True).data
+        self.assertEqual(self.get_groups(), {group['id']: group for group in expected})
+        with self.assertNumQueries(1):
+            self.get_groups()
+        self.assertEqual(fragments.group_fragments.stats()['hits'], 3)
+        self.assertEqual(self.client.get(f'/api/groups/{self.groups[0].id}/details/').data,
+                         expected[0])
+
+    def test_member_changes_and_user_saves_invalidate(self):
+        self.get_groups()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.groups[0].members.add(self.newcomer)
+            self.other.first_name = 'Renamed'
+            self.other.save()
+        groups = self.get_groups()
+        self.assertEqual([member['id'] for member in groups[self.groups[0].id]['members']],
+                         [self.user.id, self.other.id, self.newcomer.id])
+        self.assertEqual({group['members'][1]['first_name'] for group in groups.values()}, {'Renamed'})
+        self.assertEqual(fragments.user_fragments.stats()['invalidations'], 1)
+
+    def test_users_changed_in_another_process_are_not_served_under_a_new_version(self):
+        self.get_groups()
+        stale = fragments.user_fragments.get_many({self.other.id: None})
+        self.other.first_name = 'Renamed'
+        self.other.save()
+        # What another worker, which never saw the save, still has cached
+        fragments.user_fragments.set_many(stale)
+        groups = self.get_groups()
+        self.assertEqual({group['members'][1]['first_name'] for group in groups.values()}, {'Renamed'})
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_groups(), groups)
+
+    def test_cache_is_bounded_and_versioned(self):
+        cache = fragments.FragmentCache(max_size=2, ttl=60)
+        cache.set_many({'a': 'a0', 'b': 'b0'}, {'a': 0, 'b': 0})
+        cache.set_many({'c': 'c0'}, {'c': 0})
+        self.assertEqual(cache.get_many({'a': 0, 'b': 1, 'c': 0}), {'c': 'c0'})
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'evictions': 1, 'invalidations': 0,
+                                         'size': 1, 'max_size': 2})
+
+
+class SparseFieldsetTestCase(SeededAPITestCase):
+    def test_fields_and_expand_on_expenses(self):
+        url = f'/api/groups/{self.big_group.id}/expenses/?page_size=100'
+        with self.assertQueryBudget(4):
+            response = self.client.get(url + '&fields=id,amount,participants')
+        expense = response.data['results'][0]
+        self.assertEqual(set(expense), {'id', 'amount', 'participants'})
+        self.assertEqual(sorted(expense['participants']), [member.id for member in self.members])
+
+        # No users are loaded for a payer sent as an id
+        with self.assertQueryBudget(3):
+            response = self.client.get(f'/api/expenses/?group={self.big_group.id}&fields=id,paid_by')
+        self.assertEqual(response.data['results'][0], {'id': response.data['results'][0]['id'],
+                                                       'paid_by': self.user.id})
+
+        response = self.client.get(url + '&expand=paid_by')
+        expense = response.data['results'][0]
+        self.assertEqual(expense['paid_by']['username'], self.user.username)
+        self.assertIsInstance(expense['participants'][0], int)
+
+    def test_fields_on_groups_and_friend_requests(self):
+        with self.assertQueryBudget(2):
+            response = self.client.get('/api/groups/?fields=id,members')
+        group = next(group for group in response.data if group['id'] == self.big_group.id)
+        self.assertEqual(group, {'id': self.big_group.id, 'members': [member.id for member in self.members]})
+        response = self.client.get(f'/api/groups/{self.big_group.id}/?fields=name,created_by&expand=created_by')
+        self.assertEqual(response.data, {'name': 'big',
+                                         'created_by': GroupSerializer(self.big_group).data['created_by']})
+        response = self.client.get('/api/friendrequests/?fields=from_user')
+        self.assertIsInstance(response.data[0]['from_user'], int)
+
+    def test_unknown_fields_are_rejected_and_writes_ignore_fieldsets(self):
+        self.assertEqual(self.client.get('/api/expenses/?fields=id,nope').status_code, 400)
+        self.assertEqual(self.client.get('/api/groups/?expand=name').status_code, 400)
+        response = self.client.post('/api/expenses/?fields=id', {'title': 't', 'amount': '4.00',
+                                                                  'group': self.big_group.id})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['paid_by']['id'], self.user.id)
+
+    def test_fast_renderer_matches_json_renderer(self):
+        self.assertIsNotNone(orjson, 'orjson is in requirements.txt')
+        data = self.client.get(f'/api/groups/{self.big_group.id}/expenses/').data
+        data['extra'] = {1: timezone.now(), 'amount': Decimal('1.50'), 'text': 'line\u2028break'}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_fast_renderer_requires_orjson(self):
+        fast = {**settings.REST_FRAMEWORK, 'DEFAULT_RENDERER_CLASSES': [checks.FAST_JSON_RENDERER]}
+        with override_settings(REST_FRAMEWORK=fast):
+            self.assertEqual(checks.fast_json_renderer_check(None), [])
+            with mock.patch('expenses.renderers.orjson', None):
+                self.assertEqual([error.id for error in checks.fast_json_renderer_check(None)], ['expenses.E001'])
+
+
+class QueryPlanTestCase(SeededAPITestCase):
+    def test_hot_queries_use_indexes(self):
+        for name, query in query_plans.hot_queries(self.user, self.big_group, self.members[1]).items():
+            with self.subTest(name):
+                plan = query_plans.explain(query.queryset)
+                self.assertEqual(plan.scans, [], plan.text)
+                if query.ordered:
+                    self.assertEqual(plan.sorts, [], plan.text)
+                if plan.cost is not None:
+                    self.assertLess(plan.cost, query_plans.MAX_COST, plan.text)
+
+    def test_scans_and_sorts_are_reported(self):
+        plan = query_plans.explain(Expense.objects.filter(title='lunch').order_by('amount'))
+        self.assertEqual(plan.scans, ['expenses_expense'])
+        self.assertEqual(len(plan.sorts), 1)
+
+
+class SplitTestCase(APITestCase):
+    def setUp(self):
+        self.users = seed_users(300)
+        self.user = self.users[0]
+        self.group = seed_group(self.user, self.users[1:])
+        self.client.force_authenticate(self.user)
+
+    def test_remainders_are_assigned_deterministically(self):
+        ids = [user.id for user in self.users[:3]]
+        self.assertEqual([amount for _, amount in splits.allocate(Decimal('10.00'), 'equal', reversed(ids))],
+                         [Decimal('3.34'), Decimal('3.33'), Decimal('3.33')])
+        self.assertEqual(splits.allocate(Decimal('10.00'), 'shares', {ids[0]: 1, ids[1]: 2}),
+                         [(ids[0], Decimal('3.33')), (ids[1], Decimal('6.67'))])
+        percentages = splits.allocate(Decimal('0.05'), 'percentage', {ids[0]: 50, ids[1]: 25, ids[2]: 25})
+        self.assertEqual([amount for _, amount in percentages], [Decimal('0.03'), Decimal('0.01'), Decimal('0.01')])
+        for mode, entries in (('percentage', {ids[0]: 60, ids[1]: 30}), ('exact', {ids[0]: '4.00'}),
+                              ('shares', {ids[0]: 0}), ('exact', {ids[0]: '10.001'})):
+            with self.assertRaises(splits.SplitError):
+                splits.allocate(Decimal('10.00'), mode, entries)
+
+    def create(self, mode, entries):
+        data = {'title': 'trip', 'amount': '100.00', 'group': self.group.id, 'split_mode': mode,
+                'split': [{'user': user.id} if value is None else {'user': user.id, 'value': value}
+                          for user, value in entries]}
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/api/expenses/', data, format='json')
+        return response, len(context)
+
+    def test_custom_split_over_a_subset(self):
+        response, _ = self.create('percentage', [(self.users[1], '12.5'), (self.users[2], '87.5')])
+        self.assertEqual(response.status_code, 201)
+        shares = dict(ExpenseShare.objects.filter(expense_id=response.data['id']).values_list('user', 'amount_owed'))
+        self.assertEqual(shares, {self.users[1].id: Decimal('12.50'), self.users[2].id: Decimal('87.50')})
+        balances = dict(GroupBalance.objects.filter(group=self.group).values_list('user', 'balance'))
+        self.assertEqual(balances[self.user.id], Decimal('100.00'))
+        self.assertEqual(balances[self.users[2].id], Decimal('-87.50'))
+        self.assertEqual(balances[self.users[3].id], 0)
+
+        outsider = User.objects.create(username='outsider')
+        response, _ = self.create('exact', [(self.users[1], '50.00'), (outsider, '50.00')])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('split', response.data)
+        self.assertEqual(Expense.objects.count(), 1)
+
+    def test_large_split_costs_the_same_queries_as_a_small_one(self):
+        # Each split adds rollup rows for its participants only; the payer's row exists after the first
+        self.create('equal', [(self.users[0], None)])
+        _, small = self.create('shares', [(user, 1 + index % 3) for index, user in enumerate(self.users[1:3])])
+        # 120 participants keeps every insert within SQLite's 999 parameter limit
+        response, large = self.create('shares', [(user, 1 + index % 3) for index, user in enumerate(self.users[3:123])])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(large, small)
+        amounts = ExpenseShare.objects.filter(expense_id=response.data['id']).values_list('amount_owed', flat=True)
+        self.assertEqual(len(amounts), 120)
+        self.assertEqual(sum(amounts), Decimal('100.00'))
+
+    def test_changing_the_amount_resplits_the_shares(self):
+        member_ids = [user.id for user in self.users[1:4]]
+        response = self.client.post('/api/expenses/', {
+            'title': 'dinner', 'amount': '30.00', 'group': self.group.id, 'split': [{'user': id} for id in member_ids],
+        }, format='json')
+        equal_id = response.data['id']
+        response, _ = self.create('shares', [(self.users[1], 1), (self.users[2], 3)])
+        weighted_id = response.data['id']
+
+        for expense_id, amount in ((equal_id, '90.00'), (weighted_id, '10.00')):
+            response = self.client.patch(f'/api/expenses/{expense_id}/', {'amount': amount}, format='json')
+            self.assertEqual(response.status_code, 200, response.data)
+        shares = dict(ExpenseShare.objects.filter(expense_id=equal_id).values_list('user', 'amount_owed'))
+        self.assertEqual(shares, dict.fromkeys(member_ids, Decimal('30.00')))
+        shares = dict(ExpenseShare.objects.filter(expense_id=weighted_id).values_list('user', 'amount_owed'))
+        self.assertEqual(shares, {self.users[1].id: Decimal('2.50'), self.users[2].id: Decimal('7.50')})
+
+        balances = dict(GroupBalance.objects.filter(group=self.group).values_list('user', 'balance'))
+        self.assertEqual(sum(balances.values()), 0)
+        self.assertEqual(balances[self.user.id], Decimal('100.00'))
+        self.assertEqual(balances[self.users[2].id], Decimal('-37.50'))
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.total_expenses, Decimal('100.00'))
+        booked = set(SpendingRollup.objects.values_list('month', 'user', 'category', 'paid', 'owed', 'expense_count'))
+        call_command('rebuild_rollups', group=[self.group.id], stdout=StringIO())
+        self.assertEqual(set(SpendingRollup.objects.values_list('month', 'user', 'category', 'paid', 'owed',
+                                                                'expense_count')), booked)
+
+        response = self.client.patch(f'/api/expenses/{equal_id}/', {'amount': '-1.00'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class SeedLoadTestCase(APITestCase):
+    def test_generated_data_is_consistent(self):
+        call_command('seed_load', users=30, groups=6, expenses=200, friends=4, batch_size=70, stdout=StringIO())
+        self.assertEqual(User.objects.filter(username__startswith='load').count(), 30)
+        self.assertEqual(Expense.objects.count(), 200)
+        self.assertEqual(Friend.objects.count(), 30 * 4)
+        self.assertEqual(set(Friend.objects.values_list('user', 'friend')),
+                         set(Friend.objects.values_list('friend', 'user')))
+        # Shares add up to each expense and the ledger balances out (summed in Python, SQLite sums floats)
+        owed = {}
+        for share in ExpenseShare.objects.all():
+            owed[share.expense_id] = owed.get(share.expense_id, 0) + share.amount_owed
+        self.assertEqual(owed, dict(Expense.objects.values_list('id', 'amount')))
+        for group in Group.objects.all():
+            self.assertEqual(sum(GroupBalance.objects.filter(group=group).values_list('balance', flat=True)), 0)
+        self.assertEqual(sum(SpendingRollup.objects.values_list('paid', flat=True)),
+                         sum(Expense.objects.values_list('amount', flat=True)))
+
+        response = self.client.post('/api/auth/login/', {'username': 'load7', 'password': 'load-test'})
+        self.assertEqual(response.status_code, 200)
+        with self.assertRaises(CommandError):
+            call_command('seed_load', users=2, groups=2, expenses=0, stdout=StringIO())
+
+
+@skipUnless('replica' in settings.DATABASES, 'needs a "replica" database alias, see dung_backend.test_settings')
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_PIN_SECONDS=60)
+class ReplicaRoutingTestCase(APITestCase):
+    """The replica database is never written to, so anything read from it shows up as missing."""
+    databases = {'default', 'replica'} if 'replica' in settings.DATABASES else {'default'}
+
+    def setUp(self):
+        cache.clear()
+        self.user, self.other = seed_users(2)
+        self.group = seed_group(self.user, [self.other])
+        self.url = f'/api/groups/{self.group.id}/expenses/'
+
+    def as_user(self, user):
+        token, _ = Token.objects.get_or_create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def test_safe_requests_read_from_replicas(self):
+        self.as_user(self.user)
+        response = self.client.get('/api/groups/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [])
+
+    def test_writers_are_pinned_to_the_primary(self):
+        self.as_user(self.user)
+        response = self.client.post('/api/expenses/', {'title': 'fresh', 'amount': '9.00', 'group': self.group.id})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([expense['title'] for expense in self.client.get(self.url).data['results']], ['fresh'])
+
+        # Someone who has not written still reads the lagging replica
+        self.as_user(self.other)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+        cache.clear()
+        self.as_user(self.user)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    async def test_async_requests_are_routed_without_a_thread(self):
+        async def view(request):
+            return HttpResponse()
+
+        self.assertTrue(iscoroutinefunction(ReplicaRoutingMiddleware(view)))
+        token = await Token.objects.acreate(user=self.user)
+        response = await self.async_client.get('/api/async/groups/', headers={'Authorization': f'Token {token.key}'})
+        self.assertEqual(json.loads(response.content), [])
+
+    @override_settings(DATABASE_REPLICAS=['replica', 'replica_b'])
+    def test_a_request_reads_from_one_replica(self):
+        router = routers.ReplicaRouter()
+        chosen = set()
+        for _ in range(20):
+            token = routers.begin_request(True)
+            try:
+                aliases = {router.db_for_read(Expense) for _ in range(10)}
+            finally:
+                routers.end_request(token)
+            self.assertEqual(len(aliases), 1)
+            chosen |= aliases
+        self.assertEqual(chosen, {'replica', 'replica_b'})
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from . import views
+from . import async_views, views
 
 router = DefaultRouter()
 router.register(r'groups', views.GroupViewSet, basename='group')
@@ -13,6 +13,19 @@ urlpatterns = [
     path('auth/register/', views.register_view, name='register'),
     path('auth/logout/', views.logout_view, name='logout'),
     path('auth/profile/', views.profile_view, name='profile'),
+    path('auth/cache_stats/', views.auth_cache_stats_view, name='auth_cache_stats'),
+    path('dashboard/', views.dashboard_view, name='dashboard'),
+    path('users/search/', views.user_search_view, name='user_search'),
+    path('events/ticket/', views.event_ticket_view, name='event_ticket'),
+    path('metrics/', views.metrics_view, name='metrics'),
+    # Async (ASGI) versions of the hot read endpoints, see expenses.async_views
+    path('async/auth/login/', async_views.login, name='async_login'),
+    path('async/auth/profile/', async_views.profile, name='async_profile'),
+    path('async/groups/', async_views.group_list, name='async_group_list'),
+    path('async/groups/<int:pk>/', async_views.group_details, name='async_group_details'),
+    path('async/groups/<int:pk>/details/', async_views.group_details),
+    path('async/groups/<int:pk>/balances/', async_views.group_balances, name='async_group_balances'),
+    path('async/expenses/', async_views.expense_list, name='async_expense_list'),
     path('', include(router.urls)),
 ]
 
@@ -0,0 +1,62 @@
+"""
+Per-group version counters and the ETags derived from them.
+
+Any write that changes what a group's endpoints return bumps Group.version,
+so a client holding the ETag of the current version can be answered with a
+304 after reading a single integer from the group row.
+"""
+from functools import wraps
+
+from django.db.models import F
+from django.utils.cache import parse_etags
+from rest_framework import status
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+
+from .models import Group
+
+
+def bump(*group_ids):
+    group_ids = {group_id for group_id in group_ids if group_id is not None}
+    if group_ids:
+        Group.objects.filter(pk__in=group_ids).update(version=F('version') + 1)
+
+
+def group_etag(group_id, version):
+    return f'W/"group-{group_id}-v{version}"'
+
+
+def conditional_response(request, groups, group_id, build_response):
+    """
+    Answer ``If-None-Match`` for a group-scoped endpoint.
+
+    ``groups`` is the queryset of groups the user may see. The version is read
+    before the response is built, so a concurrent write can only make the ETag
+    older than the body, never newer.
+    """
+    try:
+        group_id = int(group_id)
+    except (TypeError, ValueError):
+        raise NotFound()
+    version = groups.filter(pk=group_id).values_list('version', flat=True).first()
+    if version is None:
+        raise NotFound()
+
+    etag = group_etag(group_id, version)
+    client_etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if etag in client_etags or etag.removeprefix('W/') in client_etags or '*' in client_etags:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = build_response()
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def etag_by_group_version(view_method):
+    """Decorate a GroupViewSet detail route so it carries the group's ETag and honours If-None-Match."""
+    @wraps(view_method)
+    def wrapper(viewset, request, *args, **kwargs):
+        return conditional_response(request, viewset.visible_groups(), kwargs.get('pk'),
+                                    lambda: view_method(viewset, request, *args, **kwargs))
+    return wrapper
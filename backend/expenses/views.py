@@ -1,13 +1,38 @@
 from rest_framework import viewsets, status, serializers
-from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.decorators import action, api_view, permission_classes, renderer_classes
+from rest_framework.generics import get_object_or_404
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.authtoken.models import Token
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
-from django.db.models import Q
-from .models import Group, Expense, ExpenseShare, Friend, FriendRequest
-from .serializers import GroupSerializer, ExpenseSerializer, UserSerializer, FriendRequestSerializer
+from collections import defaultdict
+from decimal import Decimal
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.urls import reverse
+from django.utils.http import urlencode
+from . import (events, exporter, fragments, friends, importer, ledger, metrics, notifications, push, rollups, search,
+               splits, versioning)
+from .authentication import token_cache
+from .fieldsets import SparseFieldsetMixin
+from .idempotency import IdempotentViewSetMixin, idempotent
+from .models import Group, Expense, ExpenseShare, Friend, FriendRequest, Settlement
+from .serializers import (GroupSerializer, ExpenseSerializer, ExpenseBatchSerializer, UserSerializer,
+                          FriendRequestSerializer, PaymentSerializer, SettlementSerializer)
+from .pagination import ExpenseCursorPagination
+from .queries import visible_groups
+from .renderers import CSVRenderer, NDJSONRenderer, PrometheusRenderer
+from .settlement import plan_settlements
+from .versioning import etag_by_group_version
+
+# Upper bound on expenses accepted by ExpenseViewSet.batch in one request
+MAX_EXPENSE_BATCH = 500
+# Rows per INSERT statement when writing expense shares in bulk
+SHARE_INSERT_BATCH = 2000
+# Upper bound on ?top= for GroupViewSet.stats
+MAX_TOP_SPENDERS = 100
 
 # Authentication Views
 @api_view(['POST'])
@@ -81,6 +106,7 @@ def register_view(request):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent
 def logout_view(request):
     try:
         # Delete the user's token
@@ -104,16 +130,132 @@ def profile_view(request):
     })
 
 
-class GroupViewSet(viewsets.ModelViewSet):
+DASHBOARD_SECTIONS = ('profile', 'groups', 'friends', 'friend_requests', 'expenses')
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def dashboard_view(request):
+    """
+    Everything the dashboard needs in one round trip.
+
+    ``?include=`` picks a comma separated subset of DASHBOARD_SECTIONS (all by
+    default); ``expenses`` is the first page of ``?group=``'s expenses and is
+    only returned when a group is given.
+    """
+    include = request.query_params.get('include')
+    sections = {s.strip() for s in include.split(',') if s.strip()} if include else set(DASHBOARD_SECTIONS)
+    unknown = sections - set(DASHBOARD_SECTIONS)
+    if unknown:
+        return Response({'error': f"Unknown section(s): {', '.join(sorted(unknown))}"},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    user = request.user
+    data = {}
+    if 'profile' in sections:
+        data['profile'] = UserSerializer(user).data
+    if 'groups' in sections:
+        data['groups'] = fragments.render_groups(visible_groups(user))
+    if 'friends' in sections:
+        data['friends'] = UserSerializer(friends.friends_of(user), many=True).data
+    if 'friend_requests' in sections:
+        requests = (FriendRequest.objects.filter(to_user=user, accepted=False)
+                    .select_related('from_user', 'to_user'))
+        data['friend_requests'] = FriendRequestSerializer(requests, many=True).data
+
+    group_id = request.query_params.get('group')
+    if 'expenses' in sections and group_id is not None:
+        try:
+            group_id = int(group_id)
+        except ValueError:
+            return Response({'error': 'group must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        expenses = (Expense.objects.filter(group_id=group_id, group__members=user)
+                    .select_related('paid_by').prefetch_related('participants'))
+        paginator = ExpenseCursorPagination()
+        # The next pages come from the expense listing, not from the dashboard
+        query = {'group': group_id}
+        if paginator.page_size_query_param in request.query_params:
+            query[paginator.page_size_query_param] = request.query_params[paginator.page_size_query_param]
+        paginator.base_url = request.build_absolute_uri(f"{reverse('expense-list')}?{urlencode(query)}")
+        page = paginator.paginate_queryset(expenses, request)
+        data['expenses'] = paginator.get_paginated_response(
+            ExpenseSerializer(page, many=True).data).data
+
+    return Response(data)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def user_search_view(request):
+    """Typeahead for usernames: ``?q=`` matches username, first or last name; friends and co-members first"""
+    try:
+        limit = int(request.query_params.get('limit', search.DEFAULT_RESULTS))
+    except ValueError:
+        return Response({'error': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+    rows = search.search_users(request.user, request.query_params.get('q', ''),
+                               limit=max(1, min(limit, search.MAX_RESULTS)))
+    return Response([{
+        'user': {field: row[field] for field in search.FIELDS},
+        'is_friend': row['is_friend'],
+        'is_co_member': row['is_co_member'],
+    } for row in rows])
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def event_ticket_view(request):
+    """A single-use ticket for opening the event stream, which browsers cannot send a token header to"""
+    return Response({'ticket': push.issue_ticket(request.user), 'expires_in': push.ticket_seconds()})
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def auth_cache_stats_view(request):
+    return Response(token_cache.stats())
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+@renderer_classes([PrometheusRenderer])
+def metrics_view(request):
+    """Request and token cache metrics in the Prometheus text format"""
+    return Response(metrics.registry.render())
+
+
+def with_expense_users(expenses, fieldset):
+    """Load the users ExpenseSerializer renders for ``expenses``, leaving out those ``fieldset`` does not need."""
+    if fieldset.expands('paid_by'):
+        expenses = expenses.select_related('paid_by')
+    if fieldset.expands('participants'):
+        # As ids they are read by Fieldset.apply instead
+        expenses = expenses.prefetch_related('participants')
+    return expenses
+
+
+class GroupViewSet(SparseFieldsetMixin, IdempotentViewSetMixin, viewsets.ModelViewSet):
     serializer_class = GroupSerializer
     permission_classes = [IsAuthenticated]
 
-    def get_queryset(self):
+    # Actions that render GroupSerializer and therefore need the nested users loaded up front;
+    # reads are assembled from expenses.fragments instead
+    serialized_actions = ('update', 'partial_update')
+
+    def visible_groups(self):
         # Only return groups where user is a member or creator
-        return Group.objects.filter(
-            Q(members=self.request.user) |
-            Q(created_by=self.request.user)
-        ).distinct()
+        return visible_groups(self.request.user)
+
+    def get_queryset(self):
+        queryset = self.visible_groups()
+        if self.action in self.serialized_actions:
+            queryset = queryset.select_related('created_by').prefetch_related('members')
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        return Response(fragments.render_groups(self.filter_queryset(self.get_queryset()), self.get_fieldset()))
+
+    @etag_by_group_version
+    def retrieve(self, request, *args, **kwargs):
+        return Response(fragments.render_group(self.get_object(), self.get_fieldset()))
 
     def perform_create(self, serializer):
         # Set the creator as the user making the request
@@ -134,7 +276,7 @@ class GroupViewSet(viewsets.ModelViewSet):
             return Response({'error': 'Group not found'},
                             status=status.HTTP_404_NOT_FOUND)
 
-        if user in group.members.all():
+        if group.members.filter(pk=user.pk).exists():
             return Response({'message': 'You are already a member of this group'},
                             status=status.HTTP_400_BAD_REQUEST)
 
@@ -163,15 +305,17 @@ class GroupViewSet(viewsets.ModelViewSet):
                             status=status.HTTP_404_NOT_FOUND)
 
     @action(detail=True, methods=['get'])
+    @etag_by_group_version
     def balances(self, request, pk=None):
         """Get balance summary for all members in the group"""
         group = self.get_object()
+        entries = group.balance_entries.select_related('user').order_by('user__username')
         balances = []
 
-        for member in group.members.all():
-            balance = group.get_member_balance(member)
+        for entry in entries:
+            balance = entry.balance
             balances.append({
-                'user': UserSerializer(member).data,
+                'user': UserSerializer(entry.user).data,
                 'balance': str(balance),
                 'status': 'owes' if balance < 0 else 'owed' if balance > 0 else 'settled'
             })
@@ -183,24 +327,149 @@ class GroupViewSet(viewsets.ModelViewSet):
         })
 
     @action(detail=True, methods=['get'])
+    @etag_by_group_version
+    def stats(self, request, pk=None):
+        """Spending by month, category and member between the ?start= and ?end= months (inclusive)"""
+        group = self.get_object()
+        try:
+            start, end = (rollups.parse_month(request.query_params[name]) if request.query_params.get(name)
+                          else None for name in ('start', 'end'))
+            top = int(request.query_params.get('top', 5))
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        if start is not None and end is not None and start > end:
+            return Response({'error': 'start must not be after end'}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= top <= MAX_TOP_SPENDERS:
+            return Response({'error': f'top must be between 1 and {MAX_TOP_SPENDERS}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        summary = rollups.summarize(group, start, end, top=top)
+
+        def member(entry):
+            return {'user': UserSerializer(entry['user']).data, 'paid': str(entry['paid']),
+                    'owed': str(entry['owed']), 'expense_count': entry['expense_count']}
+
+        return Response({
+            'group': group.name,
+            'start': start and f'{start:%Y-%m}',
+            'end': end and f'{end:%Y-%m}',
+            'total': str(summary['total']),
+            'expense_count': summary['expense_count'],
+            'by_month': [{**entry, 'month': f"{entry['month']:%Y-%m}", 'total': str(entry['total'])}
+                         for entry in summary['by_month']],
+            'by_category': [{**entry, 'total': str(entry['total'])} for entry in summary['by_category']],
+            'by_member': [member(entry) for entry in summary['by_member']],
+            'top_spenders': [member(entry) for entry in summary['top_spenders']],
+        })
+
+    @action(detail=True, methods=['get'])
+    def settle_plan(self, request, pk=None):
+        """Get the smallest set of payments that settles every balance in the group"""
+        group = self.get_object()
+        entries = group.balance_entries.select_related('user').exclude(balance=0)
+        users = {entry.user_id: entry.user for entry in entries}
+        transfers = plan_settlements({entry.user_id: entry.balance for entry in entries})
+
+        return Response({
+            'group': group.name,
+            'transfers': [{
+                'from_user': UserSerializer(users[transfer.from_user]).data,
+                'to_user': UserSerializer(users[transfer.to_user]).data,
+                'amount': str(transfer.amount)
+            } for transfer in transfers]
+        })
+
+    @action(detail=True, methods=['post'])
+    def settle(self, request, pk=None):
+        """Record one or more settlement payments between group members"""
+        group = self.get_object()
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Expected a payment, or an object with a list of payments'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        payments = request.data.get('payments')
+        if payments is None:
+            payments = [request.data]
+        if not isinstance(payments, list) or not payments:
+            return Response({'error': 'At least one payment is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        serializer = PaymentSerializer(data=payments, many=True)
+        if not serializer.is_valid():
+            return Response({'error': 'Each payment needs to_user and a positive amount with at most two decimals',
+                             'payments': serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        member_ids = set(group.members.values_list('id', flat=True))
+        settlements = []
+        for payment in serializer.validated_data:
+            from_user = payment.get('from_user', request.user.id)
+            to_user = payment['to_user']
+            amount = payment['amount']
+            if from_user == to_user or not {from_user, to_user} <= member_ids:
+                return Response({'error': 'Payments must be between two different group members'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            if request.user.id not in (from_user, to_user) and group.created_by_id != request.user.id:
+                return Response({'error': 'You can only record payments you made or received'},
+                                status=status.HTTP_403_FORBIDDEN)
+            settlements.append(Settlement(group=group, from_user_id=from_user, to_user_id=to_user, amount=amount))
+
+        with transaction.atomic():
+            Settlement.objects.bulk_create(settlements)
+            ledger.apply_deltas(group.id, ledger.settlement_deltas(settlements))
+
+        created = Settlement.objects.filter(pk__in=[s.pk for s in settlements]).select_related('from_user', 'to_user')
+        return Response(SettlementSerializer(created, many=True).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['post'], url_path='import', parser_classes=[MultiPartParser])
+    def import_expenses(self, request, pk=None):
+        """Import historical expenses from an uploaded CSV or NDJSON file"""
+        group = self.get_object()
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'error': 'A CSV or NDJSON file is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        file_format = request.data.get('format') or importer.detect_format(upload.name)
+        if file_format not in importer.FORMATS:
+            return Response({'error': f"Unsupported format, expected one of {', '.join(importer.FORMATS)}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        report = importer.import_expenses(group, importer.read_rows(upload, file_format), paid_by=request.user)
+        return Response(report.as_dict())
+
+    @action(detail=True, methods=['get'], renderer_classes=[CSVRenderer, NDJSONRenderer])
+    def export(self, request, pk=None):
+        """Stream the group's full expense history, one line per share, as CSV or NDJSON"""
+        group = self.get_object()
+        rows = exporter.share_rows(group)
+        if request.accepted_renderer.format == 'ndjson':
+            response = StreamingHttpResponse(exporter.stream_ndjson(rows), content_type='application/x-ndjson')
+        else:
+            response = StreamingHttpResponse(exporter.stream_csv(rows), content_type='text/csv')
+        response['Content-Disposition'] = (
+            f'attachment; filename="group-{group.id}-expenses.{request.accepted_renderer.format}"')
+        return response
+
+    @action(detail=True, methods=['get'])
+    @etag_by_group_version
     def expenses(self, request, pk=None):
         """Get all expenses for this group"""
         group = self.get_object()
-        expenses = Expense.objects.filter(group=group).order_by('-date')
-        serializer = ExpenseSerializer(expenses, many=True)
-        return Response(serializer.data)
+        fieldset = self.get_fieldset()
+        paginator = ExpenseCursorPagination()
+        expenses = with_expense_users(Expense.objects.filter(group=group), fieldset)
+        page = paginator.paginate_queryset(expenses, request, view=self)
+        serializer = fieldset.apply(ExpenseSerializer(page, many=True))
+        return paginator.get_paginated_response(serializer.data)
 
     @action(detail=True, methods=['get'])
+    @etag_by_group_version
     def details(self, request, pk=None):
         """Get detailed information about the group"""
-        group = self.get_object()
-        serializer = self.get_serializer(group)
-        return Response(serializer.data)
+        return Response(fragments.render_group(self.get_object(), self.get_fieldset()))
 
 
-class ExpenseViewSet(viewsets.ModelViewSet):
+class ExpenseViewSet(SparseFieldsetMixin, IdempotentViewSetMixin, viewsets.ModelViewSet):
     serializer_class = ExpenseSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = ExpenseCursorPagination
 
     def get_queryset(self):
         queryset = Expense.objects.all()
@@ -214,13 +483,20 @@ class ExpenseViewSet(viewsets.ModelViewSet):
         else:
             # Return expenses from all groups the user is a member of
             queryset = queryset.filter(group__members=self.request.user)
-        return queryset.distinct()
+        return with_expense_users(queryset.distinct(), self.get_fieldset())
+
+    def list(self, request, *args, **kwargs):
+        group_id = request.query_params.get('group')
+        if group_id is None:
+            return super().list(request, *args, **kwargs)
+        return versioning.conditional_response(request, Group.objects.filter(members=request.user), group_id,
+                                               lambda: super(ExpenseViewSet, self).list(request, *args, **kwargs))
 
-    @action(detail=True, methods=['post'])
     def perform_create(self, serializer):
         # Validate that user is member of the group
         group = serializer.validated_data['group']
-        if not group.members.filter(id=self.request.user.id).exists():
+        member_ids = list(group.members.values_list('id', flat=True))
+        if self.request.user.id not in member_ids:
             raise serializers.ValidationError("You are not a member of this group")
         amount = serializer.validated_data.get('amount')
         if not amount:
@@ -228,39 +504,159 @@ class ExpenseViewSet(viewsets.ModelViewSet):
         if amount <= 0:
             raise serializers.ValidationError("Amount must be greater than zero")
 
-        print("debuggg")
-        # Save expense with current user as payer
-        expense = serializer.save(paid_by=self.request.user, group=group, amount=amount)
+        mode = serializer.validated_data.pop('split_mode', splits.EQUAL)
+        entries = serializer.validated_data.pop('split', None)
+        try:
+            allocation = splits.allocate_for_group(amount, mode, entries, member_ids)
+        except splits.SplitError as exc:
+            raise serializers.ValidationError({'split': [str(exc)]})
+
+        with transaction.atomic():
+            # Save expense with current user as payer
+            expense = serializer.save(paid_by=self.request.user, group=group, amount=amount)
+
+            # The whole split is written with one insert, however many participants it has
+            shares = splits.build_shares(expense, allocation)
+            ExpenseShare.objects.bulk_create(shares, batch_size=SHARE_INSERT_BATCH)
+            # bulk_create bypasses the ledger and rollup signals, so book the shares here
+            ledger.apply_deltas(group.id, ledger.share_deltas(allocation))
+            rollups.book_expenses([], shares)
+
+            recipients = [user_id for user_id, _ in allocation if user_id != self.request.user.id]
+            notifications.enqueue('expense_added', recipients, {
+                'group': group.name, 'title': expense.title, 'amount': str(expense.amount),
+                'paid_by': self.request.user.username,
+            })
 
-        # Automatically add all group members as participants
-        expense.participants.set(group.members.all())
+        return expense
 
-        # Calculate equal split among all participants
-        total_participants = group.members.count()
+    def perform_update(self, serializer):
+        expense = serializer.instance
+        amount = serializer.validated_data.get('amount', expense.amount)
+        if amount <= 0:
+            raise serializers.ValidationError("Amount must be greater than zero")
+        if ledger.to_cents(amount) == ledger.to_cents(expense.amount):
+            serializer.save()
+            return
+
+        with transaction.atomic():
+            shares = list(ExpenseShare.objects.select_for_update().filter(expense=expense).order_by('user_id'))
+            try:
+                allocation = dict(splits.reallocate(amount, [(share.user_id, share.amount_owed) for share in shares]))
+            except splits.SplitError as exc:
+                raise serializers.ValidationError({'amount': [str(exc)]})
+            # Books the payer's side and any move to another group, month or category
+            expense = serializer.save()
+
+            # The shares are rewritten with one statement, so their side is booked here
+            deltas, rollup_deltas = {}, rollups.RollupDeltas()
+            for share in shares:
+                change = allocation[share.user_id] - ledger.to_cents(share.amount_owed)
+                share.amount_owed = allocation[share.user_id]
+                deltas[share.user_id] = deltas.get(share.user_id, 0) - change
+                rollup_deltas.share(expense.date, expense.icon, share.user_id, change)
+            ExpenseShare.objects.bulk_update(shares, ['amount_owed'])
+            if expense.paid_by_id is not None:
+                ledger.apply_deltas(expense.group_id, deltas)
+            rollups.apply_deltas(expense.group_id, rollup_deltas)
 
-        if total_participants > 0:
-            amount_per_person = expense.amount / total_participants
-        else:
-            raise serializers.ValidationError("Group must have at least one member")
-
-        # Create ExpenseShare records for each participant
-        for member in group.members.all():
-            ExpenseShare.objects.create(
-                expense=expense,
-                user=member,
-                amount_owed=amount_per_person
-            )
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """Create many expenses at once, each split equally among its group's members unless it gives a split"""
+        items = request.data.get('expenses') if isinstance(request.data, dict) else request.data
+        if not isinstance(items, list) or not items:
+            return Response({'error': 'A list of expenses is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > MAX_EXPENSE_BATCH:
+            return Response({'error': f'At most {MAX_EXPENSE_BATCH} expenses can be created per request'},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-        return expense
+        serializer = ExpenseBatchSerializer(data=items, many=True)
+        serializer.is_valid(raise_exception=True)
+        for index, item in enumerate(serializer.validated_data):
+            if item['amount'] <= 0:
+                return Response({'error': f'Expense {index}: amount must be greater than zero'},
+                                status=status.HTTP_400_BAD_REQUEST)
 
-class FriendViewSet(viewsets.ModelViewSet):
+        # One query for the membership of every group in the batch
+        group_ids = {item['group'] for item in serializer.validated_data}
+        members = defaultdict(list)
+        memberships = Group.members.through.objects.filter(group_id__in=group_ids)
+        for group_id, user_id in memberships.values_list('group_id', 'user_id'):
+            members[group_id].append(user_id)
+        forbidden = sorted(group_id for group_id in group_ids if request.user.id not in members[group_id])
+        if forbidden:
+            return Response({'error': f"You are not a member of group(s) {', '.join(map(str, forbidden))}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        allocations = []
+        for index, item in enumerate(serializer.validated_data):
+            try:
+                allocations.append(splits.allocate_for_group(item['amount'], item['split_mode'], item.get('split'),
+                                                             members[item['group']]))
+            except splits.SplitError as exc:
+                return Response({'error': f'Expense {index}: {exc}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            expenses = Expense.objects.bulk_create([
+                Expense(title=item['title'], amount=item['amount'], description=item.get('description', ''),
+                        group_id=item['group'], paid_by=request.user)
+                for item in serializer.validated_data
+            ])
+            shares = []
+            totals = defaultdict(Decimal)
+            counts = defaultdict(int)
+            owed = defaultdict(list)
+            for expense, allocation in zip(expenses, allocations):
+                expense_shares = splits.build_shares(expense, allocation)
+                shares.extend(expense_shares)
+                totals[expense.group_id] += expense.amount
+                counts[expense.group_id] += 1
+                owed[expense.group_id].extend((share.user_id, share.amount_owed) for share in expense_shares)
+            ExpenseShare.objects.bulk_create(shares, batch_size=SHARE_INSERT_BATCH)
+
+            # bulk_create bypasses the ledger and rollup signals, so book every group's totals here
+            rollups.book_expenses(expenses, shares)
+            group_names = dict(Group.objects.filter(pk__in=group_ids).values_list('id', 'name'))
+            for group_id, total in totals.items():
+                ledger.apply_deltas(group_id, ledger.expense_deltas(request.user.id, total, owed[group_id]), total)
+                recipients = sorted({user_id for user_id, _ in owed[group_id] if user_id != request.user.id})
+                notifications.enqueue('expenses_added', recipients, {
+                    'group': group_names[group_id], 'count': counts[group_id],
+                    'amount': str(total), 'paid_by': request.user.username,
+                })
+                events.publish(group_id, events.EXPENSES_ADDED, {'count': counts[group_id], 'amount': str(total)})
+
+        created = (Expense.objects.filter(pk__in=[expense.pk for expense in expenses])
+                   .select_related('paid_by').prefetch_related('participants').order_by('pk'))
+        return Response(ExpenseSerializer(created, many=True).data, status=status.HTTP_201_CREATED)
+
+class FriendViewSet(SparseFieldsetMixin, IdempotentViewSetMixin, viewsets.ModelViewSet):
     serializer_class = UserSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        friends_obj = Friend.objects.filter(user=self.request.user)
-        friends = [friend.friend for friend in friends_obj]
-        return User.objects.filter(id__in=[friend.id for friend in friends])
+        return friends.friends_of(self.request.user)
+
+    @action(detail=False, methods=['get'])
+    def suggestions(self, request):
+        """People the user may know, ranked by mutual friends and shared groups"""
+        try:
+            limit = int(request.query_params.get('limit', friends.DEFAULT_SUGGESTIONS))
+        except ValueError:
+            return Response({'error': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        candidates = friends.suggestions(request.user, limit=max(1, min(limit, friends.MAX_SUGGESTIONS)))
+        return Response([{
+            'user': UserSerializer(candidate).data,
+            'mutual_friends': candidate.mutual_friends,
+            'shared_groups': candidate.shared_groups,
+        } for candidate in candidates])
+
+    @action(detail=True, methods=['get'])
+    def mutual(self, request, pk=None):
+        """Friends the user has in common with another user"""
+        other = get_object_or_404(User, pk=pk)
+        mutual = friends.mutual_friends(request.user, other).order_by('username')
+        return Response(UserSerializer(mutual, many=True).data)
 
     @action(detail=False, methods=['post'])
     def add_friend(self, request, pk=None):
@@ -283,10 +679,12 @@ class FriendViewSet(viewsets.ModelViewSet):
             if Friend.objects.filter(user=request.user, friend=friend).exists():
                 return Response({'error': 'This user is already your friend'},
                                 status=status.HTTP_400_BAD_REQUEST)
-            FriendRequest.objects.create(
-                from_user=request.user,
-                to_user=friend,
-            )
+            with transaction.atomic():
+                FriendRequest.objects.create(
+                    from_user=request.user,
+                    to_user=friend,
+                )
+                notifications.enqueue('friend_request', [friend.id], {'from_user': request.user.username})
             return Response({'message': 'Friend request sent'})
         except User.DoesNotExist:
             return Response({'error': 'User not found'},
@@ -294,12 +692,15 @@ class FriendViewSet(viewsets.ModelViewSet):
 
 
 
-class FriendRequestsViewSet(viewsets.ModelViewSet):
+class FriendRequestsViewSet(SparseFieldsetMixin, IdempotentViewSetMixin, viewsets.ModelViewSet):
     serializer_class = FriendRequestSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return FriendRequest.objects.filter(to_user=self.request.user, accepted=False)
+        queryset = FriendRequest.objects.filter(to_user=self.request.user, accepted=False)
+        # select_related() without arguments would follow every foreign key
+        users = [name for name in ('from_user', 'to_user') if self.get_fieldset().expands(name)]
+        return queryset.select_related(*users) if users else queryset
 
     @action(detail=False, methods=['post'])
     def accept(self, request, pk=None):
@@ -313,10 +714,13 @@ class FriendRequestsViewSet(viewsets.ModelViewSet):
             if friend_request.to_user != request.user:
                 return Response({'error': 'You cannot accept this request'},
                                 status=status.HTTP_403_FORBIDDEN)
-            friend_request.accepted = True
-            friend_request.save()
-            Friend.objects.create(user=request.user, friend=friend_request.from_user)
-            Friend.objects.create(user=friend_request.from_user, friend=request.user)
+            with transaction.atomic():
+                friend_request.accepted = True
+                friend_request.save()
+                Friend.objects.create(user=request.user, friend=friend_request.from_user)
+                Friend.objects.create(user=friend_request.from_user, friend=request.user)
+                notifications.enqueue('friend_request_accepted', [friend_request.from_user_id],
+                                      {'by_user': request.user.username})
             return Response({'message': 'Friend request accepted'})
         except FriendRequest.DoesNotExist:
             return Response({'error': 'Friend request not found'},
@@ -23,17 +23,65 @@ function App({onLogout}) {
   useEffect(() => {
     if (token) {
       axios.defaults.headers.common['Authorization'] = `Token ${token}`;
-      // Verify token is still valid
-      verifyToken();
-      // Fetch groups after token verification
-      fetchGroups();
-      fetchFriends();
-      fetchFriendRequests();
+      // Verify the token and load everything the page needs in one request
+      fetchDashboard();
     } else {
       setLoading(false);
     }
   }, [token]);
 
+  // Follow the open group's changes, including other members', instead of polling.
+  // The stream is served by the ASGI app; under a WSGI server it fails and is retried now and then.
+  // EventSource cannot send the token header, so each connection is opened with a single-use ticket.
+  const selectedGroupId = selectedGroup ? selectedGroup.id : null;
+  useEffect(() => {
+    if (!token || !selectedGroupId) return;
+    let source = null;
+    let retry = null;
+    let closed = false;
+    const refreshExpenses = () => fetchExpenses(selectedGroupId);
+    const refreshGroup = () => fetchGroup(selectedGroupId);
+    const connect = async () => {
+      try {
+        const response = await axios.post(`${API_BASE}/events/ticket/`);
+        if (closed) return;
+        source = new EventSource(`${API_BASE}/events/?group=${selectedGroupId}&ticket=${response.data.ticket}`);
+        ['expense_added', 'expenses_added', 'expense_updated', 'expense_deleted'].forEach(type =>
+            source.addEventListener(type, refreshExpenses));
+        ['member_joined', 'member_left'].forEach(type => source.addEventListener(type, refreshGroup));
+        // The ticket is spent, so reconnect with a new one rather than letting EventSource retry
+        source.onerror = () => {
+          source.close();
+          if (!closed) retry = setTimeout(connect, 3000);
+        };
+      } catch (error) {
+        if (!closed) retry = setTimeout(connect, 30000);
+      }
+    };
+    connect();
+    return () => {
+      closed = true;
+      clearTimeout(retry);
+      if (source) source.close();
+    };
+  }, [token, selectedGroupId]);
+
+  const fetchDashboard = async () => {
+    try {
+      const response = await axios.get(`${API_BASE}/dashboard/`);
+      setUser(response.data.profile);
+      setGroups(response.data.groups);
+      setFriends(response.data.friends);
+      setFriendRequests(response.data.friend_requests);
+    } catch (error) {
+      // Token is invalid, remove it
+      localStorage.removeItem('token');
+      setToken(null);
+      delete axios.defaults.headers.common['Authorization'];
+    }
+    setLoading(false);
+  };
+
   const fetchGroups = async () => {
     try {
       const response = await axios.get(`${API_BASE}/groups/`);
@@ -61,23 +109,10 @@ function App({onLogout}) {
     }
   };
 
-  const verifyToken = async () => {
-    try {
-      const response = await axios.get(`${API_BASE}/auth/profile/`);
-      setUser(response.data.user);
-    } catch (error) {
-      // Token is invalid, remove it
-      localStorage.removeItem('token');
-      setToken(null);
-      delete axios.defaults.headers.common['Authorization'];
-    }
-    setLoading(false);
-  };
-
   const fetchExpenses = async (groupId) => {
     try {
       const response = await axios.get(`${API_BASE}/expenses/?group=${groupId}`);
-      setExpenses(response.data);
+      setExpenses(response.data.results);
     } catch (error) {
       console.error('Error fetching expenses:', error);
     }